@@ -1,9 +1,8 @@
 import requests
-import json, uuid, time
+import json, uuid, time, random
 
 from flask import Flask, request, abort,jsonify
 from linebot.v3 import WebhookHandler
-from linebot.v3.exceptions import InvalidSignatureError
 from linebot.v3.messaging import (
     ReplyMessageRequest,
     TextMessage,
@@ -17,9 +16,10 @@ from linebot.v3.webhooks import (
     MessageEvent,
     TextMessageContent,
     PostbackEvent, 
+    FollowEvent,
 )
 
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -29,7 +29,6 @@ from line_client import line_bot_api, handler
 
 from bookings_core import (
     list_appointments_for_date,
-    get_available_slots_for_date,
     create_booking_appointment,
     get_graph_token,
     extract_zd_user_id_from_service_notes
@@ -47,6 +46,7 @@ from zendesk_core import (
 from patient_core import (
     is_registered_patient,
     normalize_phone,
+    cache_registered_patient,
 )
 
 from flows_appointments import (
@@ -63,15 +63,12 @@ from flows_slots import (
     validate_appointment_date,
 )
 
-from flows_reminders import(
-    run_reminder_check,
-    #run_reminder_check_direct
-)
-
-from queue_core import voice_call_queue
+from queue_core import voice_call_queue, reminder_queue
 from flows_voice_calls import process_voice_call_task
 
-from flows_voice_scheduler import build_voice_groups_and_enqueue
+from cron_runs import start_run, update_run, finish_run, get_run
+from line_push_core import get_push_run_stats
+from reminder_checkpoint import get_enqueued_groups
 
 from utils import (
     reply_consent_input, 
@@ -80,14 +77,26 @@ from utils import (
     is_binding_complete
     )
 
-from state_store import get_state, set_state,clear_state
+from state_store import get_state, set_state, update_state, clear_state
 
 
 
 # Demo 測試用
 from voice_demo import trigger_voice_demo
 
-from flows_voice_webhook import handle_livehub_webhook
+from flows_voice_webhook import handle_livehub_webhook, flush_stale_voice_calls
+
+from line_events import verify_signature, dispatch_webhook_events
+from message_router import MessageRouter, MessageContext, get_route_stats
+from profile_cache import get_display_name, warm_profile, refresh_profile
+from booking_prefetch import prefetch_booking_flow
+from availability_cache import get_available_slots_cached, invalidate_slots
+from reply_budget import reply_budget, get_reply_budget_stats
+from voice_dialer import pump_dialer, get_dialer_status
+from voice_retry import feed_due_retries, get_retry_status
+from voice_outcomes import get_day_summary
+from voice_manifest import get_manifest_status
+from worker_pool import get_pool_status
 
 FORCE_ZD_ID_FROM_NOTES = os.environ.get("FORCE_ZD_ID_FROM_NOTES", "0") == "1"
 
@@ -99,6 +108,7 @@ def health_check():
     return "OK", 200
 
 from config import (
+    LINE_WEBHOOK_LOG_BODY_RATE,
     WEEKDAY_ZH,
     BOOKING_DEMO_SERVICE_ID,
     BOOKING_DEMO_STAFF_ID,
@@ -142,7 +152,6 @@ from config import (
     CLINIC_LNG,
     WEEK_IMAGE_URL, 
     CONFIRM_NOTE_KEYWORD,
-    PENDING_REGISTRATIONS,
     DEMO_CUSTOMER_NAME,
     DEMO_CUSTOMER_EMAIL,
     DEMO_CUSTOMER_PHONE
@@ -177,7 +186,6 @@ def reply_date_range_buttons(event, info_text: str):
     )
 
 
-
 # ========= Webhook 入口 =========
 
 @app.route("/callback", methods=['POST'])
@@ -187,45 +195,55 @@ def callback():
 
     # get request body as text
     body = request.get_data(as_text=True)
-
-    # --- DEBUG TRACE (minimal) ---
     req_id = uuid.uuid4().hex[:8]
-    evt_id = None
-    msg_id = None
-    evt_ts = None
+
+    # 只驗簽就回 200；event 交給 thread pool / line_events queue 處理，
+    # 不讓 Graph / Zendesk 的延遲卡住 LINE 的 webhook（太慢 LINE 會重送）
+    if not verify_signature(body, signature):
+        app.logger.info("Invalid signature. Please check your channel access token/channel secret.")
+        abort(400)
+
+    # 整包只 parse 這一次，之後 trace / dispatch / handler 都用這個 dict
     try:
         payload = json.loads(body)
-        events = payload.get("events") or []
-        if events:
-            e0 = events[0]
-            evt_id = e0.get("webhookEventId")
-            evt_ts = e0.get("timestamp")
-            msg = e0.get("message") or {}
-            msg_id = msg.get("id")
     except Exception as e:
         app.logger.warning(f"[TRACE][{req_id}] json parse fail: {e}")
+        abort(400)
 
+    # --- DEBUG TRACE (minimal) ---
+    events = payload.get("events") or []
+    e0 = events[0] if events else {}
     app.logger.info(
         f"[TRACE][{req_id}] incoming webhook "
-        f"evt_id={evt_id} msg_id={msg_id} ts={evt_ts} "
-        f"len_body={len(body)}"
+        f"evt_id={e0.get('webhookEventId')} msg_id={(e0.get('message') or {}).get('id')} "
+        f"ts={e0.get('timestamp')} events={len(events)} len_body={len(body)}"
     )
+    # 完整 body 很長又每次都要組字串，只抽樣記
+    if LINE_WEBHOOK_LOG_BODY_RATE > 0 and random.random() < LINE_WEBHOOK_LOG_BODY_RATE:
+        app.logger.info(f"[TRACE][{req_id}] Request body: {body}")
     # --- END TRACE ---
 
-    app.logger.info("Request body: " + body)
-
-    # handle webhook body
-    try:
-        handler.handle(body, signature)
-    except InvalidSignatureError:
-        app.logger.info("Invalid signature. Please check your channel access token/channel secret.")
-        abort(400)
+    count = dispatch_webhook_events(payload)
+    app.logger.info(f"[TRACE][{req_id}] dispatched events={count}")
 
     return "OK"
 
 # ======================================
 #  LINE Event Handlers 區/訊息處理
 # ======================================
+# handle_message 的路由表（指令 / 流程步驟 → handler），每個 route 都有計時
+message_router = MessageRouter()
+
+# 使用者主動中斷流程
+CANCEL_FLOW_TEXTS = {"取消建檔", "取消流程", "取消"}
+
+# ===== 流程中保護：避免把「線上約診/取消預約...」當成姓名或手機 =====
+PENDING_BLOCKED_COMMANDS = {
+    "線上約診", "約診查詢", "取消預約", "取消預約流程", "查詢診所位置",
+    "我要預約本週", "我要預約下週", "我要預約兩週後", "我要預約三週後", "其他日期",
+}
+
+
 @handler.add(MessageEvent, message=TextMessageContent)
 def handle_message(event: MessageEvent):
     text = (event.message.text or "").strip()
@@ -241,416 +259,604 @@ def handle_message(event: MessageEvent):
         f"[HANDLE] evt_id={evt_id} msg_id={msg_id} ts={ts} uid={uid} text={text}"
     )
 
-    # === 0. 檢查是否處於首次建檔流程 ===
-    line_user_id_for_state = None
-    if event.source and hasattr(event.source, "user_id"):
-        line_user_id_for_state = event.source.user_id
-
-    # === -1. 使用者主動中斷建檔流程 ===
-    if text in {"取消建檔", "取消流程", "取消"}:
-        # if line_user_id_for_state and line_user_id_for_state in PENDING_REGISTRATIONS:
-        #     del PENDING_REGISTRATIONS[line_user_id_for_state]
-        #     line_bot_api.reply_message(
-        #         ReplyMessageRequest(
-        #             reply_token=event.reply_token,
-        #             messages=[TextMessage(
-        #                 text="已為您取消建檔流程，謝謝。"
-        #             )]
-        #         )
-        #     )
-        # else:
-        #     line_bot_api.reply_message(
-        #         ReplyMessageRequest(
-        #             reply_token=event.reply_token,
-        #             messages=[TextMessage(
-        #                 text="目前沒有正在進行的建檔流程。\n如需開始建檔，請輸入「測試身分」。"
-        #             )]
-        #         )
-        #     )
-        # return
-        cleared = clear_pending_state(line_user_id_for_state)
-        app.logger.info(f"[取消建檔] uid={line_user_id_for_state} cleared={cleared}")
-
-        if cleared:
-            msg = "已為您取消建檔流程，謝謝。"
+    # 第一次互動（或快取過期）就先在背景把 LINE profile 抓進快取，預約時用得到
+    warm_profile(uid)
+
+    # === 0. 檢查是否處於首次建檔流程（None = 沒有進行中的流程） ===
+    state = get_state(uid) or None
+    ctx = MessageContext(event, text, uid, state)
+
+    # 順序跟原本的 if/elif 一樣：取消 → 流程中的步驟 → 指令 → 預設回覆
+    if text in CANCEL_FLOW_TEXTS:
+        route = ("cancel_flow", _cmd_cancel_flow)
+    elif ctx.state is not None:
+        if text in PENDING_BLOCKED_COMMANDS:
+            route = ("pending_blocked", _reply_pending_blocked)
         else:
-            msg = "目前沒有正在進行的流程。\n如需開始預約，請輸入「線上約診」。"
+            route = message_router.resolve_step(ctx.state.get("step"))
+    else:
+        route = message_router.resolve_command(ctx) or message_router.resolve_default()
+
+    # 查空檔 / 確認預約這類慢的 route 超過 reply budget 會先回「查詢中」，結果改 push
+    with reply_budget(route[0], event):
+        return message_router.run(route, ctx)
+
+
+# ======================================
+#  取消 / 流程中（PENDING_REGISTRATIONS 的每一個 step）
+# ======================================
+
+def _cmd_cancel_flow(ctx: MessageContext):
+    """
+    === -1. 使用者主動中斷建檔流程 ===
+    """
+    event = ctx.event
+    line_user_id_for_state = ctx.line_user_id
+    # if line_user_id_for_state and line_user_id_for_state in PENDING_REGISTRATIONS:
+    #     del PENDING_REGISTRATIONS[line_user_id_for_state]
+    #     line_bot_api.reply_message(
+    #         ReplyMessageRequest(
+    #             reply_token=event.reply_token,
+    #             messages=[TextMessage(
+    #                 text="已為您取消建檔流程，謝謝。"
+    #             )]
+    #         )
+    #     )
+    # else:
+    #     line_bot_api.reply_message(
+    #         ReplyMessageRequest(
+    #             reply_token=event.reply_token,
+    #             messages=[TextMessage(
+    #                 text="目前沒有正在進行的建檔流程。\n如需開始建檔，請輸入「測試身分」。"
+    #             )]
+    #         )
+    #     )
+    # return
+    cleared = clear_pending_state(line_user_id_for_state)
+    app.logger.info(f"[取消建檔] uid={line_user_id_for_state} cleared={cleared}")
+
+    if cleared:
+        msg = "已為您取消建檔流程，謝謝。"
+    else:
+        msg = "目前沒有正在進行的流程。\n如需開始預約，請輸入「線上約診」。"
+
+    line_bot_api.reply_message(
+        ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[TextMessage(text=msg)]
+        )
+    )
+    return
+
+
+def _reply_pending_blocked(ctx: MessageContext):
+    event = ctx.event
+    line_bot_api.reply_message(
+        ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[TextMessage(text="您目前正在填寫資料中。\n如要取消請按「取消」或輸入「取消建檔」。")]
+        )
+    )
+
+
+@message_router.step("wait_consent_new_name", "wait_consent_name_after_phone", "wait_consent_phone")
+def _step_wait_consent(ctx: MessageContext):
+    """
+    ===== 等待同意：使用者若直接輸入，不要 reset，提示按按鈕 =====
+    """
+    event = ctx.event
+    line_bot_api.reply_message(
+        ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[TextMessage(text="請先按下方按鈕「好的，我要開始輸入」後再輸入喔。若要取消請輸入「取消」。")]
+        )
+    )
+    return
+
+
+@message_router.step("ask_name")
+def _step_ask_name(ctx: MessageContext):
+    """
+    0-1. 問姓名
+    """
+    event = ctx.event
+    text = ctx.text
+    line_user_id_for_state = ctx.line_user_id
+    state = ctx.state
+    name = text.strip()
+    if not name:
+        line_bot_api.reply_message(
+            ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text="姓名不能是空白，請再次輸入您的姓名。")]
+            )
+        )
+        return
+
+    # 先把姓名寫進 Zendesk，同時標記 profile_status = need_phone
+    if line_user_id_for_state:
+        try:
+            user = upsert_zendesk_user_basic_profile(
+                line_user_id=line_user_id_for_state,
+                name=name,
+                phone=None,
+                profile_status=PROFILE_STATUS_NEED_PHONE,
+            )
+            if user and user.get("id"):
+                state["zendesk_user_id"] = user.get("id")
+            if not user:
+                app.logger.warning("[handle_message] 寫入 Zendesk 姓名失敗，但仍繼續問手機")
+        except Exception as e:
+            app.logger.error(f"[handle_message] 更新 Zendesk user 姓名失敗: {e}")
+            # 不中斷流程，仍然繼續問手機
+
+    state["name"] = name
+    state["step"] = "ask_phone"
+    set_state(line_user_id_for_state, state)
+
+    reply_text = f"{name} 您好，請輸入您的手機號碼（格式：09xxxxxxxx）："
+
+    line_bot_api.reply_message(
+        ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[TextMessage(text=reply_text)]
+        )
+    )
+    return
+
+
+@message_router.step("ask_name_after_phone")
+def _step_ask_name_after_phone(ctx: MessageContext):
+    """
+    0-1.5 問姓名（手機已經有了，補姓名用）
+    """
+    event = ctx.event
+    text = ctx.text
+    line_user_id_for_state = ctx.line_user_id
+    state = ctx.state
+    name = text.strip()
+    if not is_valid_name(name):
+        line_bot_api.reply_message(
+            ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text="請輸入您的真實姓名（不可空白）。")]
+            )
+        )
+        return
 
+    zendesk_user_id = state.get("zendesk_user_id")
+    if not zendesk_user_id:
+        # 保守：如果意外沒有 user_id，就回到問手機重新走
+        update_state(line_user_id_for_state, step="ask_phone")
         line_bot_api.reply_message(
             ReplyMessageRequest(
                 reply_token=event.reply_token,
-                messages=[TextMessage(text=msg)]
+                messages=[TextMessage(text="資料狀態異常，請重新輸入手機號碼（09xxxxxxxx）：")]
             )
         )
         return
 
+    # 更新 Zendesk：name + profile_status=complete（手機已經有了）
+    base_url, headers = _build_zendesk_headers()
+    url = f"{base_url}/api/v2/users/{zendesk_user_id}.json"
+    payload = {
+        "user": {
+            "name": name,
+            "phone": (state.get("phone") or "").strip(),
+            "external_id": line_user_id_for_state,
+            "user_fields": {
+                ZENDESK_UF_LINE_USER_ID_KEY: line_user_id_for_state,
+                ZENDESK_UF_PROFILE_STATUS_KEY: (PROFILE_STATUS_COMPLETE if is_valid_name(name) else PROFILE_STATUS_NEED_NAME),
+            },
+        }
+    }
 
-    if line_user_id_for_state and line_user_id_for_state in PENDING_REGISTRATIONS:
-        state = PENDING_REGISTRATIONS[line_user_id_for_state]
-        step = state.get("step")
-        # ===== 流程中保護：避免把「線上約診/取消預約...」當成姓名或手機 =====
-        flow_commands = {
-            "線上約診", "約診查詢", "取消預約", "取消預約流程", "查詢診所位置",
-            "我要預約本週", "我要預約下週", "我要預約兩週後", "我要預約三週後", "其他日期",
+    try:
+        resp = requests.put(url, headers=headers, json=payload, timeout=10)
+        app.logger.info(f"[ask_name_after_phone][PUT] status={resp.status_code} body={resp.text[:300]}")
+        resp.raise_for_status()
+    except Exception as e:
+        app.logger.error(f"[ask_name_after_phone] 更新 Zendesk 姓名失敗 user_id={zendesk_user_id}: {e}")
+        line_bot_api.reply_message(
+            ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text="更新姓名時發生問題，請稍後再試。")]
+            )
+        )
+        return
+
+    # 成功 → 清狀態 → 進入選日期範圍（跟你原本完成建檔一致）
+    clear_state(line_user_id_for_state)
+
+    phone_display = state.get("phone") or "（已留存）"
+    info_text = (
+        "已為您完成基本資料建檔\n"
+        f"姓名：{name}\n"
+        f"手機：{phone_display}\n\n"
+        "接下來請選擇要預約的日期範圍："
+    )
+
+    reply_date_range_buttons(event,info_text)
+
+    return
+
+
+@message_router.step("confirm_name_after_claim")
+def _step_confirm_name_after_claim(ctx: MessageContext):
+    """
+    期待：姓名正確 / 我要修改姓名
+    """
+    event = ctx.event
+    text = ctx.text
+    line_user_id_for_state = ctx.line_user_id
+    state = ctx.state
+    if text not in {"姓名正確", "我要修改姓名"}:
+        line_bot_api.reply_message(
+            ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text="請點選按鈕：姓名正確 / 我要修改姓名")]
+            )
+        )
+        return
+
+    zendesk_user_id = state.get("zendesk_user_id")
+    phone = (state.get("phone") or "").strip()
+    found_name = (state.get("found_name") or "").strip()
+
+    if not zendesk_user_id:
+        clear_state(line_user_id_for_state)
+        line_bot_api.reply_message(
+            ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text="資料狀態異常，請重新輸入「線上約診」開始。")]
+            )
+        )
+        return
+
+    # 使用者選「我要修改姓名」→ 直接進入補姓名
+    if text == "我要修改姓名":
+        # ask_name_after_phone 會負責把 name + phone + external_id 一次寫入 Zendesk
+        update_state(line_user_id_for_state, step="ask_name_after_phone")
+
+        line_bot_api.reply_message(
+            ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text="請輸入您要更新的真實姓名（全名）：")]
+            )
+        )
+        return
+
+    # 使用者選「姓名正確」→ 只做綁定（external_id / user_fields），不改名
+    base_url, headers = _build_zendesk_headers()
+    url = f"{base_url}/api/v2/users/{zendesk_user_id}.json"
+
+    payload = {
+        "user": {
+            "external_id": line_user_id_for_state,
+            "user_fields": {
+                ZENDESK_UF_LINE_USER_ID_KEY: line_user_id_for_state,
+                ZENDESK_UF_PROFILE_STATUS_KEY: (PROFILE_STATUS_COMPLETE if is_valid_name(found_name) else PROFILE_STATUS_NEED_NAME),
+            },
         }
-        if text in flow_commands:
+    }
+
+    # 如果 state 有 phone，就一起補上（不然 Zendesk 有些資料會留空）
+    if phone:
+        payload["user"]["phone"] = phone
+
+    try:
+        resp = requests.put(url, headers=headers, json=payload, timeout=10)
+        app.logger.info(f"[confirm_name_after_claim][PUT] status={resp.status_code} body={resp.text[:300]}")
+        resp.raise_for_status()
+    except Exception as e:
+        app.logger.error(f"[confirm_name_after_claim] bind failed user_id={zendesk_user_id}: {e}")
+        line_bot_api.reply_message(
+            ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text="綁定資料時發生問題，請稍後再試。")]
+            )
+        )
+        return
+
+    clear_state(line_user_id_for_state)
+
+    info_text = (
+        f"{found_name or '貴賓'} 您好，已為您完成身分綁定。\n"
+        f"手機：{phone or '（已確認）'}\n\n"
+        "請選擇要預約的日期範圍："
+    )
+    reply_date_range_buttons(event, info_text)
+    return
+
+
+@message_router.step("ask_name_for_multi_claim")
+def _step_ask_name_for_multi_claim(ctx: MessageContext):
+    """
+    同一支手機對應多筆資料 → 用姓名縮小範圍
+    """
+    event = ctx.event
+    text = ctx.text
+    line_user_id_for_state = ctx.line_user_id
+    state = ctx.state
+    name = text.strip()
+
+    candidates = state.get("candidates") or []
+    phone = state.get("phone") or ""
+    mode = (state.get("mode") or "").strip()
+
+    # already_bound：不做姓名格式檢查，直接拿來比對；比對結果最後都導客服
+    if mode != "already_bound":
+        if not is_valid_name(name):
             line_bot_api.reply_message(
                 ReplyMessageRequest(
                     reply_token=event.reply_token,
-                    messages=[TextMessage(text="您目前正在填寫資料中。\n如要取消請按「取消」或輸入「取消建檔」。")]
+                    messages=[TextMessage(text="請輸入您的真實姓名（全名），以便確認資料。")]
                 )
             )
             return
-        
-        # ===== 等待同意：使用者若直接輸入，不要 reset，提示按按鈕 =====
-        if step in {"wait_consent_new_name", "wait_consent_name_after_phone", "wait_consent_phone"}:
+
+
+    # 用「全等」比對（最保守，不做模糊匹配）
+    matched = []
+    for u in candidates:
+        u_name = (u.get("name") or "").strip()
+        if u_name == name:
+            matched.append(u)
+
+    if len(matched) == 1:
+        if mode == "already_bound":
+            clear_state(line_user_id_for_state)
             line_bot_api.reply_message(
                 ReplyMessageRequest(
                     reply_token=event.reply_token,
-                    messages=[TextMessage(text="請先按下方按鈕「好的，我要開始輸入」後再輸入喔。若要取消請輸入「取消」。")]
+                    messages=[TextMessage(text="此手機號碼已綁定其他帳號，系統無法線上轉移綁定，請聯繫診所客服協助處理。")]
                 )
             )
             return
 
-        # 0-1. 問姓名
-        if step == "ask_name":
-            name = text.strip()
-            if not name:
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text="姓名不能是空白，請再次輸入您的姓名。")]
-                    )
+        found = matched[0]
+        found_name = (found.get("name") or "").strip()
+
+        # ✅ 姓名 placeholder → 直接補姓名
+        if not is_valid_name(found_name):
+            set_state(line_user_id_for_state, {
+                "step": "ask_name_after_phone",
+                "zendesk_user_id": found.get("id"),
+                "phone": phone,
+                "found_name": found_name,
+            })
+            line_bot_api.reply_message(
+                ReplyMessageRequest(
+                    reply_token=event.reply_token,
+                    messages=[TextMessage(text="已確認您的手機，請輸入您的真實姓名（全名）：")]
                 )
-                return
+            )
+            return
 
-            # 先把姓名寫進 Zendesk，同時標記 profile_status = need_phone
-            if line_user_id_for_state:
-                try:
-                    user = upsert_zendesk_user_basic_profile(
-                        line_user_id=line_user_id_for_state,
-                        name=name,
-                        phone=None,
-                        profile_status=PROFILE_STATUS_NEED_PHONE,
-                    )
-                    if user and user.get("id"):
-                        state["zendesk_user_id"] = user.get("id")
-                    if not user:
-                        app.logger.warning("[handle_message] 寫入 Zendesk 姓名失敗，但仍繼續問手機")
-                except Exception as e:
-                    app.logger.error(f"[handle_message] 更新 Zendesk user 姓名失敗: {e}")
-                    # 不中斷流程，仍然繼續問手機
+        # ✅ 姓名有效 → 進入確認姓名
+        set_state(line_user_id_for_state, {
+            "step": "confirm_name_after_claim",
+            "zendesk_user_id": found.get("id"),
+            "phone": phone,
+            "found_name": found_name,
+        })
 
-            state["name"] = name
-            state["step"] = "ask_phone"
-            PENDING_REGISTRATIONS[line_user_id_for_state] = state
+        buttons_template = ButtonsTemplate(
+            title="確認姓名",
+            text=f"我們找到您的資料：\n姓名：{found_name}\n手機：{phone}\n\n姓名是否正確？",
+            actions=[
+                MessageAction(label="正確", text="姓名正確"),
+                MessageAction(label="我要修改", text="我要修改姓名"),
+            ],
+        )
+        line_bot_api.reply_message(
+            ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TemplateMessage(alt_text="確認姓名", template=buttons_template)]
+            )
+        )
+        return
 
-            reply_text = f"{name} 您好，請輸入您的手機號碼（格式：09xxxxxxxx）："
 
+    if len(matched) == 0:
+        if mode == "already_bound":
+            clear_state(line_user_id_for_state)
             line_bot_api.reply_message(
                 ReplyMessageRequest(
                     reply_token=event.reply_token,
-                    messages=[TextMessage(text=reply_text)]
+                    messages=[TextMessage(text="此手機號碼已綁定其他帳號，系統無法線上轉移綁定，請聯繫診所客服協助處理。")]
                 )
             )
             return
-        
-        # 0-1.5 問姓名（手機已經有了，補姓名用）
-        elif step == "ask_name_after_phone":
-            name = text.strip()
-            if not is_valid_name(name):
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text="請輸入您的真實姓名（不可空白）。")]
-                    )
-                )
-                return
 
-            zendesk_user_id = state.get("zendesk_user_id")
-            if not zendesk_user_id:
-                # 保守：如果意外沒有 user_id，就回到問手機重新走
-                state["step"] = "ask_phone"
-                PENDING_REGISTRATIONS[line_user_id_for_state] = state
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text="資料狀態異常，請重新輸入手機號碼（09xxxxxxxx）：")]
-                    )
-                )
-                return
+        line_bot_api.reply_message(
+            ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text="找不到符合此姓名的資料。請確認後重新輸入姓名，或聯繫診所協助。")]
+            )
+        )
+        return
 
-            # 更新 Zendesk：name + profile_status=complete（手機已經有了）
-            base_url, headers = _build_zendesk_headers()
-            url = f"{base_url}/api/v2/users/{zendesk_user_id}.json"
-            payload = {
-                "user": {
-                    "name": name,
-                    "phone": (state.get("phone") or "").strip(),
-                    "external_id": line_user_id_for_state,
-                    "user_fields": {
-                        ZENDESK_UF_LINE_USER_ID_KEY: line_user_id_for_state,
-                        ZENDESK_UF_PROFILE_STATUS_KEY: (PROFILE_STATUS_COMPLETE if is_valid_name(name) else PROFILE_STATUS_NEED_NAME),
-                    },
-                }
-            }
+    # matched > 1：同手機+同姓名仍多筆，只能擋
+    line_bot_api.reply_message(
+        ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[TextMessage(text="此姓名仍對應多筆資料，請聯繫診所協助確認。")]
+        )
+    )
+    return
 
-            try:
-                resp = requests.put(url, headers=headers, json=payload, timeout=10)
-                app.logger.info(f"[ask_name_after_phone][PUT] status={resp.status_code} body={resp.text[:300]}")
-                resp.raise_for_status()
-            except Exception as e:
-                app.logger.error(f"[ask_name_after_phone] 更新 Zendesk 姓名失敗 user_id={zendesk_user_id}: {e}")
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text="更新姓名時發生問題，請稍後再試。")]
-                    )
-                )
-                return
 
-            # 成功 → 清狀態 → 進入選日期範圍（跟你原本完成建檔一致）
-            del PENDING_REGISTRATIONS[line_user_id_for_state]
+@message_router.step("ask_phone")
+def _step_ask_phone(ctx: MessageContext):
+    """
+    0-2. 問手機
+    """
+    event = ctx.event
+    text = ctx.text
+    line_user_id_for_state = ctx.line_user_id
+    state = ctx.state
+    phone_raw = text.strip()
+    digits = normalize_phone(phone_raw)
+
+    if not (len(digits) == 10 and digits.startswith("09")):
+        line_bot_api.reply_message(
+            ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text="手機格式不正確，請以 09xxxxxxxx 格式重新輸入。")]
+            )
+        )
+        return
+    # === A路線：先用手機找 Zendesk seed 老客，做認領 ===
+    # 只有在「此 LINE 尚未綁定」時才做認領，避免老用戶更新資料時誤觸
 
-            phone_display = state.get("phone") or "（已留存）"
-            info_text = (
-                "已為您完成基本資料建檔\n"
-                f"姓名：{name}\n"
-                f"手機：{phone_display}\n\n"
-                "接下來請選擇要預約的日期範圍："
+    try:
+        bound_count, bound_user = search_zendesk_user_by_line_id(line_user_id_for_state, retries=1)
+    except Exception as e:
+        app.logger.error(f"[ask_phone][claim] search by line_id failed: {e}")
+        bound_user = None
+    # ===== Guard：若此 LINE 已有綁定中的 user（不論 complete/need_name），不允許更換手機去認領別人 =====
+    # 目的：避免「先留了一支手機（或半成品）→ 下一次輸入另一支手機」造成搶綁與資料錯亂
+    if bound_user:
+        ufs = bound_user.get("user_fields") or {}
+        bound_phone = normalize_phone(bound_user.get("phone") or "")
+        bound_profile = (ufs.get(ZENDESK_UF_PROFILE_STATUS_KEY) or "").strip()
+
+        # ✅ 若 Zendesk 已留 phone，且使用者輸入的 digits 與既有 phone 不同 → 直接擋
+        if bound_phone and bound_phone != digits:
+            line_bot_api.reply_message(
+                ReplyMessageRequest(
+                    reply_token=event.reply_token,
+                    messages=[TextMessage(text="此帳號已綁定其他手機號碼，系統不允許線上更換。請聯繫診所客服協助處理。")]
+                )
             )
+            return
 
-            reply_date_range_buttons(event,info_text)
-            
+        # ✅ 若 profile_status 不是 complete（例如 need_name）→ 直接導向補姓名（不要走認領）
+        bound_name = (bound_user.get("name") or "").strip()
+        if bound_profile != PROFILE_STATUS_COMPLETE or (not is_valid_name(bound_name)):
+            set_state(line_user_id_for_state, {
+                "step": "wait_consent_name_after_phone",
+                "zendesk_user_id": bound_user.get("id"),
+                "phone": (bound_phone or digits),
+            })
+            reply_consent_input(
+                line_bot_api=line_bot_api,
+                event=event,
+                title="補齊姓名",
+                text="我們已確認您的手機。為完成身分綁定，請先補上您的真實姓名（全名）。\n按下「好的，我要開始輸入」後再輸入姓名。",
+                ok_data="CONSENT_NAME_AFTER_PHONE",
+                cancel_data="CANCEL_FLOW",
+            )
             return
 
-        # elif step == "confirm_existing_by_phone":
-        #     # 期待使用者回覆：是我本人 / 不是我
-        #     if text not in {"是我本人", "不是我"}:
-        #         line_bot_api.reply_message(
-        #             ReplyMessageRequest(
-        #                 reply_token=event.reply_token,
-        #                 messages=[TextMessage(text="請點選按鈕確認：是我本人 / 不是我")]
-        #             )
-        #         )
-        #         return
-
-        #     # 取出狀態資料
-        #     zendesk_user_id = state.get("zendesk_user_id")
-        #     phone = state.get("phone")  # digits
-        #     found_name = (state.get("found_name") or "").strip()
-
-        #     if text == "不是我":
-        #         # 回到輸入手機
-        #         PENDING_REGISTRATIONS[line_user_id_for_state] = {"step": "ask_phone"}
-        #         line_bot_api.reply_message(
-        #             ReplyMessageRequest(
-        #                 reply_token=event.reply_token,
-        #                 messages=[TextMessage(text="了解，請重新輸入您的手機號碼（09xxxxxxxx）：")]
-        #             )
-        #         )
-        #         return
-
-        #     # === 是我本人：把這筆 Zendesk user 綁到此 LINE (external_id + user_fields.line_user_id) ===
-        #     if not zendesk_user_id or not phone:
-        #         del PENDING_REGISTRATIONS[line_user_id_for_state]
-        #         line_bot_api.reply_message(
-        #             ReplyMessageRequest(
-        #                 reply_token=event.reply_token,
-        #                 messages=[TextMessage(text="資料狀態異常，請重新輸入「線上約診」再試一次。")]
-        #             )
-        #         )
-        #         return
-
-        #     base_url, headers = _build_zendesk_headers()
-        #     url = f"{base_url}/api/v2/users/{zendesk_user_id}.json"
-
-        #     payload = {
-        #         "user": {
-        #             "external_id": line_user_id_for_state,
-        #             "user_fields": {
-        #                 ZENDESK_UF_LINE_USER_ID_KEY: line_user_id_for_state,
-        #                 # 狀態你想留就留，但放行不要靠它
-        #                 ZENDESK_UF_PROFILE_STATUS_KEY: (PROFILE_STATUS_COMPLETE if is_valid_name(found_name) else PROFILE_STATUS_NEED_NAME),
-        #             },
-        #         }
-        #     }
-
-        #     try:
-        #         resp = requests.put(url, headers=headers, json=payload, timeout=10)
-        #         app.logger.info(f"[claim][PUT] status={resp.status_code} body={resp.text[:300]}")
-        #         resp.raise_for_status()
-        #         updated = (resp.json() or {}).get("user") or {}
-        #     except Exception as e:
-        #         app.logger.error(f"[claim] bind failed user_id={zendesk_user_id}: {e}")
-        #         line_bot_api.reply_message(
-        #             ReplyMessageRequest(
-        #                 reply_token=event.reply_token,
-        #                 messages=[TextMessage(text="綁定資料時發生問題，請稍後再試或聯繫診所。")]
-        #             )
-        #         )
-        #         return
-
-        #     name_now = (updated.get("name") or "").strip()
-        #     phone_now = (updated.get("phone") or phone or "").strip()
-
-        #     # 若姓名仍是 placeholder → 要求補姓名
-        #     if not is_valid_name(name_now):
-        #         state["step"] = "ask_name_after_phone"
-        #         state["zendesk_user_id"] = zendesk_user_id
-        #         state["phone"] = phone_now
-
-        #         PENDING_REGISTRATIONS[line_user_id_for_state] = state
-        #         app.logger.info(f"[confirm_existing_by_phone] set step=ask_name_after_phone uid={line_user_id_for_state} zd_user_id={zendesk_user_id} phone={phone_now}")
-
-        #         line_bot_api.reply_message(
-        #             ReplyMessageRequest(
-        #                 reply_token=event.reply_token,
-        #                 messages=[TextMessage(text="手機已確認，請再輸入您的真實姓名（全名）：")]
-        #             )
-        #         )
-        #         return
-
-        #     # ✅ 姓名有效 → 清狀態 → 放行
-        #     del PENDING_REGISTRATIONS[line_user_id_for_state]
-        #     info_text = (
-        #         f"{name_now} 您好，已為您完成身分綁定。\n"
-        #         f"手機：{phone_now}\n\n"
-        #         "請選擇要預約的日期範圍："
-        #     )
-        #     reply_date_range_buttons(event, info_text)
-        #     return
-
-        elif step == "confirm_name_after_claim":
-            # 期待：姓名正確 / 我要修改姓名
-            if text not in {"姓名正確", "我要修改姓名"}:
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text="請點選按鈕：姓名正確 / 我要修改姓名")]
-                    )
-                )
-                return
+        reply_date_range_buttons(event, "已確認您的身分，請選擇要預約的日期範圍：")
+        return
 
-            zendesk_user_id = state.get("zendesk_user_id")
-            phone = (state.get("phone") or "").strip()
-            found_name = (state.get("found_name") or "").strip()
 
-            if not zendesk_user_id:
-                del PENDING_REGISTRATIONS[line_user_id_for_state]
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text="資料狀態異常，請重新輸入「線上約診」開始。")]
-                    )
+    if not bound_user:
+        try:
+            candidates = search_zendesk_users_by_phone(digits)  # 你已經放在 zendesk_core
+        except Exception as e:
+            app.logger.error(f"[ask_phone][claim] search by phone failed: {e}")
+            candidates = []
+
+        # 只允許認領「external_id 空白」的（避免搶綁）
+        unbound = []
+        for u in candidates:
+            ext = (u.get("external_id") or "").strip()
+            if not ext:
+                unbound.append(u)
+
+        if len(unbound) == 1:
+            found = unbound[0]
+            found_name = (found.get("name") or "").strip()
+
+            # ✅ Case 1：姓名是 placeholder → 直接補姓名（要同意開關）
+            if not is_valid_name(found_name):
+                set_state(line_user_id_for_state, {
+                    "step": "wait_consent_name_after_phone",
+                    "zendesk_user_id": found.get("id"),
+                    "phone": digits,
+                })
+                reply_consent_input(
+                    line_bot_api=line_bot_api,
+                    event=event,
+                    title="補齊姓名",
+                    text="已找到您的資料（手機已確認）。\n為完成身分綁定，請補上您的真實姓名（全名）。\n按下「好的，我要開始輸入」後再輸入姓名。",
+                    ok_data="CONSENT_NAME_AFTER_PHONE",
+                    cancel_data="CANCEL_FLOW",
                 )
                 return
 
-            # 使用者選「我要修改姓名」→ 直接進入補姓名
-            if text == "我要修改姓名":
-                state["step"] = "ask_name_after_phone"
-                # ask_name_after_phone 會負責把 name + phone + external_id 一次寫入 Zendesk
-                PENDING_REGISTRATIONS[line_user_id_for_state] = state
 
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text="請輸入您要更新的真實姓名（全名）：")]
-                    )
-                )
-                return
-
-            # 使用者選「姓名正確」→ 只做綁定（external_id / user_fields），不改名
-            base_url, headers = _build_zendesk_headers()
-            url = f"{base_url}/api/v2/users/{zendesk_user_id}.json"
-
-            payload = {
-                "user": {
-                    "external_id": line_user_id_for_state,
-                    "user_fields": {
-                        ZENDESK_UF_LINE_USER_ID_KEY: line_user_id_for_state,
-                        ZENDESK_UF_PROFILE_STATUS_KEY: (PROFILE_STATUS_COMPLETE if is_valid_name(found_name) else PROFILE_STATUS_NEED_NAME),
-                    },
-                }
-            }
+            # ✅ Case 2：姓名有效 → 進入「確認姓名是否正確」的按鈕
+            set_state(line_user_id_for_state, {
+                "step": "confirm_name_after_claim",
+                "zendesk_user_id": found.get("id"),
+                "phone": digits,
+                "found_name": found_name,
+            })
 
-            # 如果 state 有 phone，就一起補上（不然 Zendesk 有些資料會留空）
-            if phone:
-                payload["user"]["phone"] = phone
-
-            try:
-                resp = requests.put(url, headers=headers, json=payload, timeout=10)
-                app.logger.info(f"[confirm_name_after_claim][PUT] status={resp.status_code} body={resp.text[:300]}")
-                resp.raise_for_status()
-            except Exception as e:
-                app.logger.error(f"[confirm_name_after_claim] bind failed user_id={zendesk_user_id}: {e}")
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text="綁定資料時發生問題，請稍後再試。")]
-                    )
+            buttons_template = ButtonsTemplate(
+                title="確認姓名",
+                text=f"我們找到您的資料：\n姓名：{found_name}\n手機：{digits}\n\n姓名是否正確？",
+                actions=[
+                    MessageAction(label="正確", text="姓名正確"),
+                    MessageAction(label="我要修改", text="我要修改姓名"),
+                ],
+            )
+            line_bot_api.reply_message(
+                ReplyMessageRequest(
+                    reply_token=event.reply_token,
+                    messages=[TemplateMessage(alt_text="確認姓名", template=buttons_template)]
                 )
-                return
-
-            del PENDING_REGISTRATIONS[line_user_id_for_state]
-
-            info_text = (
-                f"{found_name or '貴賓'} 您好，已為您完成身分綁定。\n"
-                f"手機：{phone or '（已確認）'}\n\n"
-                "請選擇要預約的日期範圍："
             )
-            reply_date_range_buttons(event, info_text)
             return
 
-        
-        elif step == "ask_name_for_multi_claim":
-            name = text.strip()
-
-            candidates = state.get("candidates") or []
-            phone = state.get("phone") or ""
-            mode = (state.get("mode") or "").strip()
-
-            # already_bound：不做姓名格式檢查，直接拿來比對；比對結果最後都導客服
-            if mode != "already_bound":
-                if not is_valid_name(name):
-                    line_bot_api.reply_message(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(text="請輸入您的真實姓名（全名），以便確認資料。")]
-                        )
-                    )
-                    return
 
+        if len(unbound) > 1:
+            # 進入「多筆資料 → 輸入姓名縮小範圍」
+            set_state(line_user_id_for_state, {
+                "step": "ask_name_for_multi_claim",
+                "phone": digits,
+                "candidates": [
+                    {"id": u.get("id"), "name": u.get("name") or ""}
+                    for u in unbound
+                ],
+            })
+            line_bot_api.reply_message(
+                ReplyMessageRequest(
+                    reply_token=event.reply_token,
+                    messages=[TextMessage(text="此手機號碼對應多筆資料，請輸入您的姓名（全名）以確認身分：")]
+                )
+            )
+            return
 
-            # 用「全等」比對（最保守，不做模糊匹配）
-            matched = []
+        # candidates 有資料但都已綁 external_id（代表被別人認領過）
+        # candidates 有資料但都已綁 external_id
+         # candidates 有資料但都已綁 external_id（可能是本人舊綁定，也可能被別人綁走）
+        if candidates and len(unbound) == 0:
+            # 先看是不是「已綁到自己」：是的話直接放行（不用再比對姓名）
+            mine = []
             for u in candidates:
-                u_name = (u.get("name") or "").strip()
-                if u_name == name:
-                    matched.append(u)
+                ext = (u.get("external_id") or "").strip()
+                if ext and ext == line_user_id_for_state:
+                    mine.append(u)
 
-            if len(matched) == 1:
-                if mode == "already_bound":
-                    del PENDING_REGISTRATIONS[line_user_id_for_state]
-                    line_bot_api.reply_message(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(text="此手機號碼已綁定其他帳號，系統無法線上轉移綁定，請聯繫診所客服協助處理。")]
-                        )
-                    )
-                    return
-                
-                found = matched[0]
+            if len(mine) == 1:
+                found = mine[0]
                 found_name = (found.get("name") or "").strip()
+                found_phone = normalize_phone(found.get("phone") or digits)
 
-                # ✅ 姓名 placeholder → 直接補姓名
+                # 姓名不完整 → 走補姓名（之後會寫回並綁定）
                 if not is_valid_name(found_name):
-                    PENDING_REGISTRATIONS[line_user_id_for_state] = {
+                    set_state(line_user_id_for_state, {
                         "step": "ask_name_after_phone",
                         "zendesk_user_id": found.get("id"),
-                        "phone": phone,
+                        "phone": found_phone,
                         "found_name": found_name,
-                    }
+                    })
                     line_bot_api.reply_message(
                         ReplyMessageRequest(
                             reply_token=event.reply_token,
@@ -659,677 +865,571 @@ def handle_message(event: MessageEvent):
                     )
                     return
 
-                # ✅ 姓名有效 → 進入確認姓名
-                PENDING_REGISTRATIONS[line_user_id_for_state] = {
-                    "step": "confirm_name_after_claim",
-                    "zendesk_user_id": found.get("id"),
-                    "phone": phone,
-                    "found_name": found_name,
-                }
-
-                buttons_template = ButtonsTemplate(
-                    title="確認姓名",
-                    text=f"我們找到您的資料：\n姓名：{found_name}\n手機：{phone}\n\n姓名是否正確？",
-                    actions=[
-                        MessageAction(label="正確", text="姓名正確"),
-                        MessageAction(label="我要修改", text="我要修改姓名"),
-                    ],
-                )
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TemplateMessage(alt_text="確認姓名", template=buttons_template)]
-                    )
-                )
+                # 姓名完整 → 直接放行預約
+                reply_date_range_buttons(event, f"{found_name} 您好，\n請選擇要預約的日期範圍：")
                 return
 
-
-            if len(matched) == 0:
-                if mode == "already_bound":
-                    del PENDING_REGISTRATIONS[line_user_id_for_state]
-                    line_bot_api.reply_message(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(text="此手機號碼已綁定其他帳號，系統無法線上轉移綁定，請聯繫診所客服協助處理。")]
-                        )
-                    )
-                    return
-                
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text="找不到符合此姓名的資料。請確認後重新輸入姓名，或聯繫診所協助。")]
-                    )
-                )
-                return
-
-            # matched > 1：同手機+同姓名仍多筆，只能擋
+            # 不是綁到自己（或多筆混雜）→ 依規格：先輸入姓名比對，失敗才叫客服
+            set_state(line_user_id_for_state, {
+                "step": "ask_name_for_multi_claim",
+                "phone": digits,
+                "candidates": [{"id": u.get("id"), "name": u.get("name") or "", "external_id": (u.get("external_id") or "")} for u in candidates],
+                "mode": "already_bound",  # 用來讓後續分支知道這是「已綁走」情境
+            })
             line_bot_api.reply_message(
                 ReplyMessageRequest(
                     reply_token=event.reply_token,
-                    messages=[TextMessage(text="此姓名仍對應多筆資料，請聯繫診所協助確認。")]
+                    messages=[TextMessage(text="此手機號碼已有資料。為了確認身分，請輸入您的姓名（全名）：")]
                 )
             )
             return
 
-        # 0-2. 問手機
-        elif step == "ask_phone":
-            phone_raw = text.strip()
-            digits = normalize_phone(phone_raw)
 
-            if not (len(digits) == 10 and digits.startswith("09")):
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text="手機格式不正確，請以 09xxxxxxxx 格式重新輸入。")]
-                    )
-                )
-                return
-            # === A路線：先用手機找 Zendesk seed 老客，做認領 ===
-            # 只有在「此 LINE 尚未綁定」時才做認領，避免老用戶更新資料時誤觸
+    # === 若沒有找到可認領的 seed 老客,才進入原本的新朋友流程 ===
+    name = state.get("name") or "未填姓名"
+    profile_status_value = PROFILE_STATUS_COMPLETE if is_valid_name(name) else PROFILE_STATUS_NEED_NAME
+
+    # 寫進 Zendesk：phone + profile_status=complete
+    user = None
+    zendesk_user_id = state.get("zendesk_user_id")
+
+    # 優先：直接更新剛剛那一筆（不靠 search）
+    if line_user_id_for_state and zendesk_user_id:
+        base_url, headers = _build_zendesk_headers()
+        app.logger.info(f"[ask_phone] will update zendesk_user_id={zendesk_user_id} line_user_id={line_user_id_for_state}")
+        url = f"{base_url}/api/v2/users/{zendesk_user_id}.json"
+
+        payload = {
+            "user": {
+                "name": name,
+                "phone": digits,
+                "external_id": line_user_id_for_state,
+                "user_fields": {
+                    ZENDESK_UF_LINE_USER_ID_KEY: line_user_id_for_state,
+                    ZENDESK_UF_PROFILE_STATUS_KEY: profile_status_value,
+                },
+            }
+        }
 
-            try:
-                bound_count, bound_user = search_zendesk_user_by_line_id(line_user_id_for_state, retries=1)
-            except Exception as e:
-                app.logger.error(f"[ask_phone][claim] search by line_id failed: {e}")
-                bound_user = None
-            # ===== Guard：若此 LINE 已有綁定中的 user（不論 complete/need_name），不允許更換手機去認領別人 =====
-            # 目的：避免「先留了一支手機（或半成品）→ 下一次輸入另一支手機」造成搶綁與資料錯亂
-            if bound_user:
-                ufs = bound_user.get("user_fields") or {}
-                bound_phone = normalize_phone(bound_user.get("phone") or "")
-                bound_profile = (ufs.get(ZENDESK_UF_PROFILE_STATUS_KEY) or "").strip()
-
-                # ✅ 若 Zendesk 已留 phone，且使用者輸入的 digits 與既有 phone 不同 → 直接擋
-                if bound_phone and bound_phone != digits:
-                    line_bot_api.reply_message(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(text="此帳號已綁定其他手機號碼，系統不允許線上更換。請聯繫診所客服協助處理。")]
-                        )
-                    )
-                    return
+        try:
+            resp = requests.put(url, headers=headers, json=payload, timeout=10)
+            app.logger.info(f"[ask_phone][PUT] status={resp.status_code} body={resp.text[:300]}")
+            resp.raise_for_status()
+            user = (resp.json() or {}).get("user")
+            app.logger.info(f"[ask_phone] 更新 Zendesk user_id={zendesk_user_id} 成功")
+        except Exception as e:
+            app.logger.error(f"[ask_phone] 更新 Zendesk user_id={zendesk_user_id} 失敗: {e}")
+            user = None
 
-                # ✅ 若 profile_status 不是 complete（例如 need_name）→ 直接導向補姓名（不要走認領）
-                bound_name = (bound_user.get("name") or "").strip()
-                if bound_profile != PROFILE_STATUS_COMPLETE or (not is_valid_name(bound_name)):
-                    PENDING_REGISTRATIONS[line_user_id_for_state] = {
-                        "step": "wait_consent_name_after_phone",
-                        "zendesk_user_id": bound_user.get("id"),
-                        "phone": (bound_phone or digits),
-                    }
-                    reply_consent_input(
-                        line_bot_api=line_bot_api,
-                        event=event,
-                        title="補齊姓名",
-                        text="我們已確認您的手機。為完成身分綁定，請先補上您的真實姓名（全名）。\n按下「好的，我要開始輸入」後再輸入姓名。",
-                        ok_data="CONSENT_NAME_AFTER_PHONE",
-                        cancel_data="CANCEL_FLOW",
-                    )
-                    return
-                
-                reply_date_range_buttons(event, "已確認您的身分，請選擇要預約的日期範圍：")
-                return
+    # 保險：真的失敗才退回 upsert
+    if not user and line_user_id_for_state:
+        try:
+            user = upsert_zendesk_user_basic_profile(
+                line_user_id=line_user_id_for_state,
+                name=name,
+                phone=digits,
+                profile_status=profile_status_value,
+                # profile_status=PROFILE_STATUS_COMPLETE,
+            )
+        except Exception as e:
+            app.logger.error(f"[handle_message] 更新 Zendesk user 手機失敗: {e}")
+            user = None
 
 
-            if not bound_user:
-                try:
-                    candidates = search_zendesk_users_by_phone(digits)  # 你已經放在 zendesk_core
-                except Exception as e:
-                    app.logger.error(f"[ask_phone][claim] search by phone failed: {e}")
-                    candidates = []
-
-                # 只允許認領「external_id 空白」的（避免搶綁）
-                unbound = []
-                for u in candidates:
-                    ext = (u.get("external_id") or "").strip()
-                    if not ext:
-                        unbound.append(u)
-
-                if len(unbound) == 1:
-                    found = unbound[0]
-                    found_name = (found.get("name") or "").strip()
-
-                    # ✅ Case 1：姓名是 placeholder → 直接補姓名（要同意開關）
-                    if not is_valid_name(found_name):
-                        PENDING_REGISTRATIONS[line_user_id_for_state] = {
-                            "step": "wait_consent_name_after_phone",
-                            "zendesk_user_id": found.get("id"),
-                            "phone": digits,
-                        }
-                        reply_consent_input(
-                            line_bot_api=line_bot_api,
-                            event=event,
-                            title="補齊姓名",
-                            text="已找到您的資料（手機已確認）。\n為完成身分綁定，請補上您的真實姓名（全名）。\n按下「好的，我要開始輸入」後再輸入姓名。",
-                            ok_data="CONSENT_NAME_AFTER_PHONE",
-                            cancel_data="CANCEL_FLOW",
-                        )
-                        return
 
+    if not user:
+        line_bot_api.reply_message(
+            ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text="建立病患資料時發生問題，請稍後再試。")]
+            )
+        )
+        return
 
-                    # ✅ Case 2：姓名有效 → 進入「確認姓名是否正確」的按鈕
-                    PENDING_REGISTRATIONS[line_user_id_for_state] = {
-                        "step": "confirm_name_after_claim",
-                        "zendesk_user_id": found.get("id"),
-                        "phone": digits,
-                        "found_name": found_name,
-                    }
-
-                    buttons_template = ButtonsTemplate(
-                        title="確認姓名",
-                        text=f"我們找到您的資料：\n姓名：{found_name}\n手機：{digits}\n\n姓名是否正確？",
-                        actions=[
-                            MessageAction(label="正確", text="姓名正確"),
-                            MessageAction(label="我要修改", text="我要修改姓名"),
-                        ],
-                    )
-                    line_bot_api.reply_message(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TemplateMessage(alt_text="確認姓名", template=buttons_template)]
-                        )
-                    )
-                    return
+    # 成功 → 清除狀態
+    # ✅ 不看 flow：只要姓名無效（含 未填姓名）→ 補姓名（要同意開關）
+    if not is_valid_name(name):
+        update_state(
+            line_user_id_for_state,
+            zendesk_user_id=user.get("id") or state.get("zendesk_user_id"),
+            phone=digits,
+            step="wait_consent_name_after_phone",
+        )
 
+        reply_consent_input(
+            line_bot_api=line_bot_api,
+            event=event,
+            title="補齊姓名",
+            text="手機已確認。\n為完成身分綁定，請補上您的真實姓名（全名）。\n按下「好的，我要開始輸入」後再輸入姓名。",
+            ok_data="CONSENT_NAME_AFTER_PHONE",
+            cancel_data="CANCEL_FLOW",
+        )
+        return
 
-                if len(unbound) > 1:
-                    # 進入「多筆資料 → 輸入姓名縮小範圍」
-                    PENDING_REGISTRATIONS[line_user_id_for_state] = {
-                        "step": "ask_name_for_multi_claim",
-                        "phone": digits,
-                        "candidates": [
-                            {"id": u.get("id"), "name": u.get("name") or ""}
-                            for u in unbound
-                        ],
-                    }
-                    line_bot_api.reply_message(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(text="此手機號碼對應多筆資料，請輸入您的姓名（全名）以確認身分：")]
-                        )
-                    )
-                    return
 
-                # candidates 有資料但都已綁 external_id（代表被別人認領過）
-                # candidates 有資料但都已綁 external_id
-                 # candidates 有資料但都已綁 external_id（可能是本人舊綁定，也可能被別人綁走）
-                if candidates and len(unbound) == 0:
-                    # 先看是不是「已綁到自己」：是的話直接放行（不用再比對姓名）
-                    mine = []
-                    for u in candidates:
-                        ext = (u.get("external_id") or "").strip()
-                        if ext and ext == line_user_id_for_state:
-                            mine.append(u)
-
-                    if len(mine) == 1:
-                        found = mine[0]
-                        found_name = (found.get("name") or "").strip()
-                        found_phone = normalize_phone(found.get("phone") or digits)
-
-                        # 姓名不完整 → 走補姓名（之後會寫回並綁定）
-                        if not is_valid_name(found_name):
-                            PENDING_REGISTRATIONS[line_user_id_for_state] = {
-                                "step": "ask_name_after_phone",
-                                "zendesk_user_id": found.get("id"),
-                                "phone": found_phone,
-                                "found_name": found_name,
-                            }
-                            line_bot_api.reply_message(
-                                ReplyMessageRequest(
-                                    reply_token=event.reply_token,
-                                    messages=[TextMessage(text="已確認您的手機，請輸入您的真實姓名（全名）：")]
-                                )
-                            )
-                            return
-
-                        # 姓名完整 → 直接放行預約
-                        reply_date_range_buttons(event, f"{found_name} 您好，\n請選擇要預約的日期範圍：")
-                        return
-
-                    # 不是綁到自己（或多筆混雜）→ 依規格：先輸入姓名比對，失敗才叫客服
-                    PENDING_REGISTRATIONS[line_user_id_for_state] = {
-                        "step": "ask_name_for_multi_claim",
-                        "phone": digits,
-                        "candidates": [{"id": u.get("id"), "name": u.get("name") or "", "external_id": (u.get("external_id") or "")} for u in candidates],
-                        "mode": "already_bound",  # 用來讓後續分支知道這是「已綁走」情境
-                    }
-                    line_bot_api.reply_message(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(text="此手機號碼已有資料。為了確認身分，請輸入您的姓名（全名）：")]
-                        )
-                    )
-                    return
-                
+    # 姓名有效 → 清狀態 → 放行選日期範圍
+    clear_state(line_user_id_for_state)
 
-            # === 若沒有找到可認領的 seed 老客,才進入原本的新朋友流程 ===
-            name = state.get("name") or "未填姓名"
-            profile_status_value = PROFILE_STATUS_COMPLETE if is_valid_name(name) else PROFILE_STATUS_NEED_NAME
+    info_text = (
+        "已為您完成基本資料建檔\n"
+        f"姓名：{name}\n"
+        f"手機：{digits}\n\n"
+        "接下來請選擇要預約的日期範圍："
+    )
 
-            # 寫進 Zendesk：phone + profile_status=complete
-            user = None
-            zendesk_user_id = state.get("zendesk_user_id")
-
-            # 優先：直接更新剛剛那一筆（不靠 search）
-            if line_user_id_for_state and zendesk_user_id:
-                base_url, headers = _build_zendesk_headers()
-                app.logger.info(f"[ask_phone] will update zendesk_user_id={zendesk_user_id} line_user_id={line_user_id_for_state}")
-                url = f"{base_url}/api/v2/users/{zendesk_user_id}.json"
-
-                payload = {
-                    "user": {
-                        "name": name,
-                        "phone": digits,
-                        "external_id": line_user_id_for_state,
-                        "user_fields": {
-                            ZENDESK_UF_LINE_USER_ID_KEY: line_user_id_for_state,
-                            ZENDESK_UF_PROFILE_STATUS_KEY: profile_status_value,
-                        },
-                    }
-                }
+    reply_date_range_buttons(event, info_text)
+    return
 
-                try:
-                    resp = requests.put(url, headers=headers, json=payload, timeout=10)
-                    app.logger.info(f"[ask_phone][PUT] status={resp.status_code} body={resp.text[:300]}")
-                    resp.raise_for_status()
-                    user = (resp.json() or {}).get("user")
-                    app.logger.info(f"[ask_phone] 更新 Zendesk user_id={zendesk_user_id} 成功")
-                except Exception as e:
-                    app.logger.error(f"[ask_phone] 更新 Zendesk user_id={zendesk_user_id} 失敗: {e}")
-                    user = None
-
-            # 保險：真的失敗才退回 upsert
-            if not user and line_user_id_for_state:
-                try:
-                    user = upsert_zendesk_user_basic_profile(
-                        line_user_id=line_user_id_for_state,
-                        name=name,
-                        phone=digits,
-                        profile_status=profile_status_value,
-                        # profile_status=PROFILE_STATUS_COMPLETE,
-                    )
-                except Exception as e:
-                    app.logger.error(f"[handle_message] 更新 Zendesk user 手機失敗: {e}")
-                    user = None
 
-           
+@message_router.step_default
+def _step_unknown(ctx: MessageContext):
+    """
+    0-3. 例外 step → reset
+    """
+    event = ctx.event
+    line_user_id_for_state = ctx.line_user_id
+    clear_state(line_user_id_for_state)
+    line_bot_api.reply_message(
+        ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[TextMessage(text="資料狀態異常，請重新輸入「線上約診」開始流程。")]
+        )
+    )
+    return
 
-            if not user:
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text="建立病患資料時發生問題，請稍後再試。")]
-                    )
-                )
-                return
 
-            # 成功 → 清除狀態
-            # ✅ 不看 flow：只要姓名無效（含 未填姓名）→ 補姓名（要同意開關）
-            if not is_valid_name(name):
-                state["zendesk_user_id"] = user.get("id") or state.get("zendesk_user_id")
-                state["phone"] = digits
-                state["step"] = "wait_consent_name_after_phone"
-                PENDING_REGISTRATIONS[line_user_id_for_state] = state
+# ======================================
+#  指令（exact / pattern / prefix）
+# ======================================
 
-                reply_consent_input(
-                    line_bot_api=line_bot_api,
-                    event=event,
-                    title="補齊姓名",
-                    text="手機已確認。\n為完成身分綁定，請補上您的真實姓名（全名）。\n按下「好的，我要開始輸入」後再輸入姓名。",
-                    ok_data="CONSENT_NAME_AFTER_PHONE",
-                    cancel_data="CANCEL_FLOW",
-                )
-                return
+@message_router.exact("測試token")
+def _cmd_test_token(ctx: MessageContext):
+    """
+    === 測試：從後端跟 Entra 拿 Graph token ===
+    """
+    event = ctx.event
+    try:
+        token = get_graph_token()
+        app.logger.info(f"GRAPH ACCESS TOKEN (HEAD): {token[:30]}...")
+        line_bot_api.reply_message(
+            ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text="成功取得 Graph token")]
+            )
+        )
+    except Exception as e:
+        app.logger.error(f"Graph token 申請失敗: {e}")
+        line_bot_api.reply_message(
+            ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text="Graph token 申請失敗，請稍後再試")]
+            )
+        )
+    return
 
 
-            # 姓名有效 → 清狀態 → 放行選日期範圍
-            del PENDING_REGISTRATIONS[line_user_id_for_state]
+@message_router.pattern(r"^查\s+(\d{4}-\d{2}-\d{2})$")
+def _cmd_query_date(ctx: MessageContext):
+    """
+    === 查詢某天預約 ===
+    """
+    event = ctx.event
+    date_str = ctx.match.group(1)
+    try:
+        appts = list_appointments_for_date(date_str)
+        reply_text = f"{date_str} 有 {len(appts)} 筆預約"
+    except Exception as e:
+        app.logger.error(f"查預約失敗: {e}")
+        reply_text = "查預約失敗，請稍後再試"
 
-            info_text = (
-                "已為您完成基本資料建檔\n"
-                f"姓名：{name}\n"
-                f"手機：{digits}\n\n"
-                "接下來請選擇要預約的日期範圍："
-            )
+    line_bot_api.reply_message(
+        ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[TextMessage(text=reply_text)]
+        )
+    )
 
-            reply_date_range_buttons(event, info_text)
-            return
 
-        # 0-3. 例外 step → reset
-        else:
-            del PENDING_REGISTRATIONS[line_user_id_for_state]
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text="資料狀態異常，請重新輸入「線上約診」開始流程。")]
-                )
-            )
-            return
+@message_router.prefix("查 ")
+def _cmd_query_date_usage(ctx: MessageContext):
+    """
+    「查 」後面不是 YYYY-MM-DD → 提示格式（不用打 Graph）
+    """
+    event = ctx.event
+    line_bot_api.reply_message(
+        ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[TextMessage(text="請輸入：查 YYYY-MM-DD，例：查 2025-01-15")]
+        )
+    )
 
-    # === 測試：從後端跟 Entra 拿 Graph token ===
-    if text == "測試token":
-        try:
-            token = get_graph_token()
-            app.logger.info(f"GRAPH ACCESS TOKEN (HEAD): {token[:30]}...")
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text="成功取得 Graph token")]
-                )
-            )
-        except Exception as e:
-            app.logger.error(f"Graph token 申請失敗: {e}")
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text="Graph token 申請失敗，請稍後再試")]
-                )
-            )
-        return
 
-    # === 查詢某天預約 ===
-    if text.startswith("查 "):
-        parts = text.split()
-        if len(parts) >= 2:
-            date_str = parts[1]
-            try:
-                appts = list_appointments_for_date(date_str)
-                reply_text = f"{date_str} 有 {len(appts)} 筆預約"
-            except Exception as e:
-                app.logger.error(f"查預約失敗: {e}")
-                reply_text = "查預約失敗，請稍後再試"
+@message_router.pattern(r"^預約\s+(\d{4}-\d{2}-\d{2})$")
+@message_router.prefix("預約 ")
+def _cmd_book_date(ctx: MessageContext):
+    """
+    === 預約 YYYY-MM-DD：顯示 Carousel（限制三週內＋需已建檔）
+    格式不對的（只命中 prefix）交給 validate_appointment_date 回錯誤訊息
+    """
+    event = ctx.event
+    date_str = ctx.match.group(1) if ctx.match else ctx.arg
 
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=reply_text)]
-                )
+    # 取得 LINE userId
+    line_user_id = ctx.line_user_id
+
+    # 1. 檢查是否已有 Zendesk 病患資料（避免未建檔客戶亂預約）
+    if not is_registered_patient(line_user_id):
+        line_bot_api.reply_message(
+            ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[
+                    TextMessage(
+                        text="目前系統尚未有您的基本資料，請先點選「線上約診」完成建檔，再進行預約喔。"
+                    )
+                ],
             )
-        else:
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text="請輸入：查 YYYY-MM-DD，例：查 2025-01-15")]
-                )
+        )
+        return
+
+    # 2. 驗證日期（格式正確／三週內／非過去）
+    ok, msg = validate_appointment_date(date_str)
+    if not ok:
+        line_bot_api.reply_message(
+            ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text=msg)],
             )
+        )
         return
 
-    # === 預約 YYYY-MM-DD：顯示 Carousel（限制三週內＋需已建檔）
-    elif text.startswith("預約 "):
-        date_str = text.replace("預約", "").strip()
+    # 3. 通過檢查才真的去查某天的時段
+    try:
+        available_slots = get_available_slots_cached(date_str)
+        if not available_slots:
+            reply_msg = TextMessage(text=f"{date_str} 沒有可預約時段")
+        else:
+            reply_msg = build_slots_carousel(date_str, available_slots)
+    except Exception as e:
+        app.logger.error(f"取得可預約時段失敗: {e}")
+        reply_msg = TextMessage(text="取得可預約時段失敗，請稍後再試")
 
-        # 取得 LINE userId
-        line_user_id = None
-        if event.source and hasattr(event.source, "user_id"):
-            line_user_id = event.source.user_id
+    # 回傳 Carousel 或是錯誤訊息
+    line_bot_api.reply_message(
+        ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[reply_msg],
+        )
+    )
+    return
 
-        # 1. 檢查是否已有 Zendesk 病患資料（避免未建檔客戶亂預約）
-        if not is_registered_patient(line_user_id):
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[
-                        TextMessage(
-                            text="目前系統尚未有您的基本資料，請先點選「線上約診」完成建檔，再進行預約喔。"
-                        )
-                    ],
-                )
-            )
-            return
 
-        # 2. 驗證日期（格式正確／三週內／非過去）
-        ok, msg = validate_appointment_date(date_str)
-        if not ok:
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=msg)],
-                )
+@message_router.exact("線上約診")
+def _cmd_online_booking(ctx: MessageContext):
+    """
+    === ① 線上約診：先判斷 Zendesk 有沒有這個病患 ===
+    """
+    event = ctx.event
+    # 1-1 取得 LINE userId
+    line_user_id = ctx.line_user_id
+
+    if not line_user_id:
+        # 理論上 1:1 聊天一定有 user_id，這裡只是保險用
+        line_bot_api.reply_message(
+            ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text="找不到 LINE userId，請改用 1 對 1 聊天測試。")]
             )
-            return
+        )
+        return
 
-        # 3. 通過檢查才真的去查某天的時段
-        try:
-            available_slots = get_available_slots_for_date(date_str)
-            if not available_slots:
-                reply_msg = TextMessage(text=f"{date_str} 沒有可預約時段")
-            else:
-                reply_msg = build_slots_carousel(date_str, available_slots)
-        except Exception as e:
-            app.logger.error(f"取得可預約時段失敗: {e}")
-            reply_msg = TextMessage(text="取得可預約時段失敗，請稍後再試")
+    # 下一步幾乎都是選週次 → 趁現在背景先把前兩週的時段查好（不等結果，跟下面查 Zendesk 同時跑）
+    prefetch_booking_flow(line_user_id)
 
-        # 回傳 Carousel 或是錯誤訊息
+    # 1-2 先到 Zendesk 查這個 line_user_id 是否已建檔
+    try:
+        count, user = search_zendesk_user_by_line_id(line_user_id, retries=1)
+    except Exception as e:
+        app.logger.error(f"查詢 Zendesk 使用者失敗: {e}")
         line_bot_api.reply_message(
             ReplyMessageRequest(
                 reply_token=event.reply_token,
-                messages=[reply_msg],
+                messages=[TextMessage(text="後端查詢病患資料發生錯誤，請稍後再試。")]
             )
         )
         return
 
-    # === ① 線上約診：先判斷 Zendesk 有沒有這個病患 ===
-    elif text == "線上約診":
-        # 1-1 取得 LINE userId
-        line_user_id = None
-        if event.source and hasattr(event.source, "user_id"):
-            line_user_id = event.source.user_id
+    # 已建檔的就先放進短期快取，之後「預約 / 我想預約 / 確認預約」檢查身分時不用再查 Zendesk
+    cache_registered_patient(line_user_id, user)
 
-        if not line_user_id:
-            # 理論上 1:1 聊天一定有 user_id，這裡只是保險用
+    app.logger.info(
+    f"[線上約診][debug] line_user_id={line_user_id} count={count} "
+    f"user_none={user is None} user_id={(user or {}).get('id')} "
+    f"uf_line={((user or {}).get('user_fields') or {}).get(ZENDESK_UF_LINE_USER_ID_KEY)} "
+    f"profile_status={((user or {}).get('user_fields') or {}).get(ZENDESK_UF_PROFILE_STATUS_KEY)} "
+    f"name={(user or {}).get('name')} phone={(user or {}).get('phone')}"
+    )
+
+    # 1-3 沒找到或拿不到 user → 視為新病患，啟動首次建檔流程（問姓名）
+
+    # === 規格：已綁定完成者 → 直接放行；其他一律先要電話 ===
+    # === 規格：已綁定完成者 → 直接放行；若已確認手機但缺姓名 → 直接補姓名；其餘才走電話 consent ===
+
+    if user:
+        user_fields = user.get("user_fields") or {}
+        phone_raw = (user.get("phone") or "").strip()
+        phone_digits = normalize_phone(phone_raw)
+        name = (user.get("name") or "").strip()
+        profile_status = user_fields.get(ZENDESK_UF_PROFILE_STATUS_KEY)
+
+        phone_ok = (len(phone_digits) == 10 and phone_digits.startswith("09"))
+        name_ok = is_valid_name(name)
+
+        # ✅ Case 1：已經有 phone（已確認）但 name 需要補（need_name / placeholder）
+        if phone_ok and (not name_ok or profile_status == PROFILE_STATUS_NEED_NAME):
+            set_state(line_user_id, {
+                "step": "ask_name_after_phone",
+                "zendesk_user_id": user.get("id"),
+                "phone": phone_digits,
+            })
             line_bot_api.reply_message(
                 ReplyMessageRequest(
                     reply_token=event.reply_token,
-                    messages=[TextMessage(text="找不到 LINE userId，請改用 1 對 1 聊天測試。")]
+                    messages=[TextMessage(text="系統中已有您的資料（手機已確認），請輸入您的真實姓名（全名）：")]
                 )
             )
             return
 
-        # 1-2 先到 Zendesk 查這個 line_user_id 是否已建檔
-        try:
-            count, user = search_zendesk_user_by_line_id(line_user_id, retries=1)
-        except Exception as e:
-            app.logger.error(f"查詢 Zendesk 使用者失敗: {e}")
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text="後端查詢病患資料發生錯誤，請稍後再試。")]
-                )
+        # ✅ Case 2：已綁定完成者 → 直接放行
+        if is_binding_complete(user, line_user_id):
+            info_text = (
+                f"{name or '貴賓'} 您好，系統中已有您的資料：\n"
+                f"手機：{phone_raw or '（已留存）'}\n\n"
+                "請選擇要預約的日期範圍："
             )
+            reply_date_range_buttons(event, info_text)
             return
 
-        app.logger.info(
-        f"[線上約診][debug] line_user_id={line_user_id} count={count} "
-        f"user_none={user is None} user_id={(user or {}).get('id')} "
-        f"uf_line={((user or {}).get('user_fields') or {}).get(ZENDESK_UF_LINE_USER_ID_KEY)} "
-        f"profile_status={((user or {}).get('user_fields') or {}).get(ZENDESK_UF_PROFILE_STATUS_KEY)} "
-        f"name={(user or {}).get('name')} phone={(user or {}).get('phone')}"
-        )
-
-        # 1-3 沒找到或拿不到 user → 視為新病患，啟動首次建檔流程（問姓名）
+    # ✅ Case 3：其餘（查不到、沒有 phone、未綁、等等）→ 才走 consent → ask_phone
+    set_state(line_user_id, {"step": "wait_consent_phone"})
 
-        # === 規格：已綁定完成者 → 直接放行；其他一律先要電話 ===
-        # === 規格：已綁定完成者 → 直接放行；若已確認手機但缺姓名 → 直接補姓名；其餘才走電話 consent ===
+    reply_consent_input(
+        line_bot_api=line_bot_api,
+        event=event,
+        title="線上預約",
+        text=(
+            "第一次使用線上約診，請先輸入您的手機號碼以查詢身分。\n"
+            "按下「好的，我要開始輸入」後再輸入手機。"
+        ),
+        ok_data="CONSENT_PHONE",
+        cancel_data="CANCEL_FLOW",
+    )
+    return
 
-        if user:
-            user_fields = user.get("user_fields") or {}
-            phone_raw = (user.get("phone") or "").strip()
-            phone_digits = normalize_phone(phone_raw)
-            name = (user.get("name") or "").strip()
-            profile_status = user_fields.get(ZENDESK_UF_PROFILE_STATUS_KEY)
 
-            phone_ok = (len(phone_digits) == 10 and phone_digits.startswith("09"))
-            name_ok = is_valid_name(name)
 
-            # ✅ Case 1：已經有 phone（已確認）但 name 需要補（need_name / placeholder）
-            if phone_ok and (not name_ok or profile_status == PROFILE_STATUS_NEED_NAME):
-                PENDING_REGISTRATIONS[line_user_id] = {
-                    "step": "ask_name_after_phone",
-                    "zendesk_user_id": user.get("id"),
-                    "phone": phone_digits,
-                }
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text="系統中已有您的資料（手機已確認），請輸入您的真實姓名（全名）：")]
-                    )
-                )
-                return
+    # # ❗其他全部情況：一律先問手機
+    # PENDING_REGISTRATIONS[line_user_id] = {
+    #     "step": "ask_phone",
+    # }
+
+    # reply_text = (
+    #     "為了確認您的身分，請先輸入手機號碼（格式：09xxxxxxxx）：\n\n"
+    #     "如需取消，請輸入「取消建檔」"
+    # )
+
+    # line_bot_api.reply_message(
+    #     ReplyMessageRequest(
+    #         reply_token=event.reply_token,
+    #         messages=[TextMessage(text=reply_text)]
+    #     )
+    # )
+    # return
+    # ❗其他全部情況：先送「同意輸入手機」按鈕（不直接打開 ask_phone）
+    # === 新朋友：Zendesk 查不到這個 external_id ===
+    # reply_consent_input(
+    #     line_bot_api=line_bot_api,
+    #     event=event,
+    #     title="建立個人資料",
+    #     text=(
+    #         f"{display_name} 您好，歡迎使用線上預約服務。\n"
+    #         "接下來需要您輸入姓名與手機以完成建檔。\n"
+    #         "按下「好的，我要開始輸入」後再輸入姓名。"
+    #     ),
+    #     ok_data="CONSENT_NEW_NAME",
+    #     cancel_data="CANCEL_FLOW",
+    # )
+    # return
+
+
+@message_router.exact("測試身分")
+def _cmd_test_identity(ctx: MessageContext):
+    """
+    === 測試：用目前這個 LINE 使用者去 Zendesk 查身分 ===
+    """
+    event = ctx.event
+    # 1. 從 event 取得 LINE userId
+    line_user_id = ctx.line_user_id
 
-            # ✅ Case 2：已綁定完成者 → 直接放行
-            if is_binding_complete(user, line_user_id):
-                info_text = (
-                    f"{name or '貴賓'} 您好，系統中已有您的資料：\n"
-                    f"手機：{phone_raw or '（已留存）'}\n\n"
-                    "請選擇要預約的日期範圍："
-                )
-                reply_date_range_buttons(event, info_text)
-                return
+    if not line_user_id:
+        # 理論上 1:1 聊天一定有 user_id，這裡只是保險
+        line_bot_api.reply_message(
+            ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text="找不到 LINE userId，請改用 1 對 1 聊天測試。")]
+            )
+        )
+        return
 
-        # ✅ Case 3：其餘（查不到、沒有 phone、未綁、等等）→ 才走 consent → ask_phone
-        PENDING_REGISTRATIONS[line_user_id] = {"step": "wait_consent_phone"}
+    # 2. 先到 Zendesk 查這個 line_user_id 是否已經建過檔
+    try:
+        count, user = search_zendesk_user_by_line_id(line_user_id)
+    except Exception as e:
+        app.logger.error(f"查詢 Zendesk 使用者失敗: {e}")
+        line_bot_api.reply_message(
+            ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text="後端查詢病患資料發生錯誤，請稍後再試。")]
+            )
+        )
+        return
 
-        reply_consent_input(
-            line_bot_api=line_bot_api,
-            event=event,
-            title="線上預約",
-            text=(
-                "第一次使用線上約診，請先輸入您的手機號碼以查詢身分。\n"
-                "按下「好的，我要開始輸入」後再輸入手機。"
-            ),
-            ok_data="CONSENT_PHONE",
-            cancel_data="CANCEL_FLOW",
+    # 2-1. 已經是老病患 → 先簡單回覆（之後可以在這裡直接串預約）
+    if count > 0 and user is not None:
+        name = user.get("name") or "貴賓"
+        phone = user.get("phone") or "（未留電話）"
+        reply_text = (
+            f"{name} 您好，系統中已有您的資料：\n"
+            f"手機：{phone}\n\n"
+            "之後預約將會直接使用這份資料。"
+        )
+        line_bot_api.reply_message(
+            ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text=reply_text)]
+            )
         )
         return
 
+    # 2-2. 找不到 → 視為第一次使用，需要建檔
+    # 這裡多一步：呼叫 LINE profile 拿 displayName 來打招呼
+    # 先看 profile 快取，沒有才打一次 LINE API；拿不到就維持預設「您好」
+    display_name = get_display_name(line_user_id, allow_fetch=True) or "您好"
+
+    # 3. 把狀態記在 state_store 裡，進入 ask_name 流程
+    set_state(line_user_id, {
+        "step": "ask_name",
+        "display_name": display_name,
+    })
+
+    reply_text = (
+        f"{display_name} 您好，歡迎使用線上預約服務。\n"
+        "請先完成基本資料建檔再使用本服務。\n\n"
+        "請輸入您的姓名（全名）："
+    )
+
+    line_bot_api.reply_message(
+        ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[TextMessage(text=reply_text)]
+        )
+    )
+    return
+
+
+@message_router.exact("其他日期")
+def _cmd_other_dates(ctx: MessageContext):
+    """
+    === ②-1 其他日期：再提供兩週後／三週後選項 ===
+    """
+    event = ctx.event
+    buttons_template = ButtonsTemplate(
+        title="選擇其他日期",
+        text="請選擇要預約的日期範圍：",
+        thumbnail_image_url=WEEK_IMAGE_URL,
+        actions=[
+            MessageAction(label="兩週後", text="我要預約兩週後"),
+            MessageAction(label="三週後", text="我要預約三週後"),
+        ],
+    )
 
+    line_bot_api.reply_message(
+        ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[
+                TemplateMessage(
+                    alt_text="選擇其他日期",
+                    template=buttons_template
+                )
+            ]
+        )
+    )
+    return
 
-        # # ❗其他全部情況：一律先問手機
-        # PENDING_REGISTRATIONS[line_user_id] = {
-        #     "step": "ask_phone",
-        # }
 
-        # reply_text = (
-        #     "為了確認您的身分，請先輸入手機號碼（格式：09xxxxxxxx）：\n\n"
-        #     "如需取消，請輸入「取消建檔」"
-        # )
 
-        # line_bot_api.reply_message(
-        #     ReplyMessageRequest(
-        #         reply_token=event.reply_token,
-        #         messages=[TextMessage(text=reply_text)]
-        #     )
-        # )
-        # return
-        # ❗其他全部情況：先送「同意輸入手機」按鈕（不直接打開 ask_phone）
-        # === 新朋友：Zendesk 查不到這個 external_id ===
-        # reply_consent_input(
-        #     line_bot_api=line_bot_api,
-        #     event=event,
-        #     title="建立個人資料",
-        #     text=(
-        #         f"{display_name} 您好，歡迎使用線上預約服務。\n"
-        #         "接下來需要您輸入姓名與手機以完成建檔。\n"
-        #         "按下「好的，我要開始輸入」後再輸入姓名。"
-        #     ),
-        #     ok_data="CONSENT_NEW_NAME",
-        #     cancel_data="CANCEL_FLOW",
-        # )
-        # return
+# === ② 我要預約本週 / ③ 下週 / ③-2 兩週後 / ③-3 三週後 ===
+WEEK_COMMANDS = {
+    "我要預約本週": 0,
+    "我要預約下週": 1,
+    "我要預約兩週後": 2,
+    "我要預約三週後": 3,
+}
 
 
+@message_router.exact(*WEEK_COMMANDS)
+def _cmd_book_week(ctx: MessageContext):
+    show_dates_for_week(WEEK_COMMANDS[ctx.text], ctx.event)
 
 
+@message_router.prefix("我想預約")
+def _cmd_pick_slot(ctx: MessageContext):
+    """
+    === 我想預約 YYYY-MM-DD HH:MM（需限制三週內＋需已建檔） ===
+    """
+    event = ctx.event
+    payload = ctx.arg
+    parts = payload.split()
 
-    # === 測試：用目前這個 LINE 使用者去 Zendesk 查身分 ===
-    elif text == "測試身分":
-        # 1. 從 event 取得 LINE userId
-        line_user_id = None
-        if event.source and hasattr(event.source, "user_id"):
-            line_user_id = event.source.user_id
+    # 是否符合「YYYY-MM-DD HH:MM」格式
+    if len(parts) == 2 and parts[0].count("-") == 2 and ":" in parts[1]:
+        date_str, time_str = parts
+        display_date = date_str.replace("-", "/")
 
-        if not line_user_id:
-            # 理論上 1:1 聊天一定有 user_id，這裡只是保險
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text="找不到 LINE userId，請改用 1 對 1 聊天測試。")]
-                )
-            )
-            return
+        # 取得 userId
+        line_user_id = ctx.line_user_id
 
-        # 2. 先到 Zendesk 查這個 line_user_id 是否已經建過檔
-        try:
-            count, user = search_zendesk_user_by_line_id(line_user_id)
-        except Exception as e:
-            app.logger.error(f"查詢 Zendesk 使用者失敗: {e}")
+        # 1. 檢查是否已有 Zendesk 病患資料（避免未建檔亂預約）
+        if not is_registered_patient(line_user_id):
             line_bot_api.reply_message(
                 ReplyMessageRequest(
                     reply_token=event.reply_token,
-                    messages=[TextMessage(text="後端查詢病患資料發生錯誤，請稍後再試。")]
+                    messages=[
+                        TextMessage(
+                            text="目前系統尚未有您的基本資料，請先點選「線上約診」完成建檔，再進行預約喔。"
+                        )
+                    ],
                 )
             )
             return
 
-        # 2-1. 已經是老病患 → 先簡單回覆（之後可以在這裡直接串預約）
-        if count > 0 and user is not None:
-            name = user.get("name") or "貴賓"
-            phone = user.get("phone") or "（未留電話）"
-            reply_text = (
-                f"{name} 您好，系統中已有您的資料：\n"
-                f"手機：{phone}\n\n"
-                "之後預約將會直接使用這份資料。"
-            )
+        # 2. 日期驗證（三週內／非過去）
+        ok, msg = validate_appointment_date(date_str)
+        if not ok:
             line_bot_api.reply_message(
                 ReplyMessageRequest(
                     reply_token=event.reply_token,
-                    messages=[TextMessage(text=reply_text)]
+                    messages=[TextMessage(text=msg)],
                 )
             )
             return
 
-        # 2-2. 找不到 → 視為第一次使用，需要建檔
-        # 這裡多一步：呼叫 LINE profile 拿 displayName 來打招呼
-        display_name = "您好"
-        try:
-            profile = line_bot_api.get_profile(user_id=line_user_id)
-            # v3 SDK 通常是 display_name
-            if profile and getattr(profile, "display_name", None):
-                display_name = profile.display_name
-        except Exception as e:
-            app.logger.error(f"取得 LINE Profile 失敗: {e}")
-            # 拿不到就維持預設「您好」
-
-        # 3. 把狀態記在 PENDING_REGISTRATIONS 裡，進入 ask_name 流程
-        PENDING_REGISTRATIONS[line_user_id] = {
-            "step": "ask_name",
-            "display_name": display_name,
-        }
-
-        reply_text = (
-            f"{display_name} 您好，歡迎使用線上預約服務。\n"
-            "請先完成基本資料建檔再使用本服務。\n\n"
-            "請輸入您的姓名（全名）："
-        )
-
-        line_bot_api.reply_message(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[TextMessage(text=reply_text)]
-            )
-        )
-        return
-
-    # === ②-1 其他日期：再提供兩週後／三週後選項 ===
-    elif text == "其他日期":
+        # 3. 通過檢查，顯示「預約確認」按鈕（此處只是確認，不會直接預約）
         buttons_template = ButtonsTemplate(
-            title="選擇其他日期",
-            text="請選擇要預約的日期範圍：",
-            thumbnail_image_url=WEEK_IMAGE_URL,
+            title="預約確認",
+            text=f"您選擇的時段是：\n{display_date} {time_str}\n\n是否確認預約？",
             actions=[
-                MessageAction(label="兩週後", text="我要預約兩週後"),
-                MessageAction(label="三週後", text="我要預約三週後"),
+                MessageAction(label="確認預約", text=f"確認預約 {date_str} {time_str}"),
+                MessageAction(label="取消", text="取消預約流程"),
             ],
         )
 
@@ -1338,443 +1438,372 @@ def handle_message(event: MessageEvent):
                 reply_token=event.reply_token,
                 messages=[
                     TemplateMessage(
-                        alt_text="選擇其他日期",
-                        template=buttons_template
+                        alt_text="預約確認", template=buttons_template
                     )
-                ]
+                ],
             )
         )
         return
 
-
-    # === ② 我要預約本週 ===
-    elif text == "我要預約本週":
-        show_dates_for_week(0, event)
-        return
-
-    # === ③ 我要預約下週 ===
-    elif text == "我要預約下週":
-        show_dates_for_week(1, event)
-        return
-
-    # === ③-2 我要預約兩週後 ===
-    elif text == "我要預約兩週後":
-        show_dates_for_week(2, event)
+    # 格式不正確 → 直接提示
+    else:
+        line_bot_api.reply_message(
+            ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[
+                    TextMessage(text="請用格式：我想預約 YYYY-MM-DD HH:MM")
+                ],
+            )
+        )
         return
 
-    # === ③-3 我要預約三週後 ===
-    elif text == "我要預約三週後":
-        show_dates_for_week(3, event)
-        return
 
-    # === 我想預約 YYYY-MM-DD HH:MM（需限制三週內＋需已建檔） ===
-    elif text.startswith("我想預約"):
-        payload = text.replace("我想預約", "").strip()
-        parts = payload.split()
+@message_router.exact("取消預約流程")
+def _cmd_cancel_booking_flow(ctx: MessageContext):
+    """
+    === 使用者取消預約流程（我想預約 → 預約確認 → 取消） ===
+    """
+    event = ctx.event
+    buttons_template = ButtonsTemplate(
+        title="已經取消約診流程",
+        text="若需預約看診，請點擊「線上約診」。",
+        actions=[
+            MessageAction(
+                label="線上約診",
+                text="線上約診"
+            ),
+        ],
+    )
 
-        # 是否符合「YYYY-MM-DD HH:MM」格式
-        if len(parts) == 2 and parts[0].count("-") == 2 and ":" in parts[1]:
-            date_str, time_str = parts
-            display_date = date_str.replace("-", "/")
+    line_bot_api.reply_message(
+        ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[
+                TemplateMessage(
+                    alt_text="已取消預約流程",
+                    template=buttons_template
+                )
+            ]
+        )
+    )   
+    return
 
-            # 取得 userId
-            line_user_id = None
-            if event.source and hasattr(event.source, "user_id"):
-                line_user_id = event.source.user_id
 
-            # 1. 檢查是否已有 Zendesk 病患資料（避免未建檔亂預約）
-            if not is_registered_patient(line_user_id):
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[
-                            TextMessage(
-                                text="目前系統尚未有您的基本資料，請先點選「線上約診」完成建檔，再進行預約喔。"
-                            )
-                        ],
-                    )
-                )
-                return
+@message_router.prefix("確認預約")
+def _cmd_confirm_booking(ctx: MessageContext):
+    """
+    === ⑤ 確認預約 ===
+    """
+    event = ctx.event
+    payload = ctx.arg
+    parts = payload.split()
 
-            # 2. 日期驗證（三週內／非過去）
-            ok, msg = validate_appointment_date(date_str)
-            if not ok:
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=msg)],
-                    )
-                )
-                return
+    if len(parts) == 2 and parts[0].count("-") == 2 and ":" in parts[1]:
+        date_str, time_str = parts
+        display_date = date_str.replace("-", "/")
 
-            # 3. 通過檢查，顯示「預約確認」按鈕（此處只是確認，不會直接預約）
-            buttons_template = ButtonsTemplate(
-                title="預約確認",
-                text=f"您選擇的時段是：\n{display_date} {time_str}\n\n是否確認預約？",
-                actions=[
-                    MessageAction(label="確認預約", text=f"確認預約 {date_str} {time_str}"),
-                    MessageAction(label="取消", text="取消預約流程"),
-                ],
-            )
+        # ① 先拿 LINE userId
+        line_user_id = ctx.line_user_id
 
+        # ② 檢查是否已在 Zendesk 建檔（防止未建檔暴力確認）
+        if not is_registered_patient(line_user_id):
             line_bot_api.reply_message(
                 ReplyMessageRequest(
                     reply_token=event.reply_token,
                     messages=[
-                        TemplateMessage(
-                            alt_text="預約確認", template=buttons_template
+                        TextMessage(
+                            text="目前系統尚未有您的基本資料，請先點選「線上約診」完成建檔，再進行預約喔。"
                         )
                     ],
                 )
             )
             return
 
-        # 格式不正確 → 直接提示
-        else:
+        # ③ 檢查日期是否合法（三週內／非過去）
+        ok, msg = validate_appointment_date(date_str)
+        if not ok:
             line_bot_api.reply_message(
                 ReplyMessageRequest(
                     reply_token=event.reply_token,
-                    messages=[
-                        TextMessage(text="請用格式：我想預約 YYYY-MM-DD HH:MM")
-                    ],
+                    messages=[TextMessage(text=msg)],
                 )
             )
             return
-        
-    # === 使用者取消預約流程（我想預約 → 預約確認 → 取消） ===
-    elif text == "取消預約流程":
-        buttons_template = ButtonsTemplate(
-            title="已經取消約診流程",
-            text="若需預約看診，請點擊「線上約診」。",
-            actions=[
-                MessageAction(
-                    label="線上約診",
-                    text="線上約診"
-                ),
-            ],
-        )
 
-        line_bot_api.reply_message(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[
-                    TemplateMessage(
-                        alt_text="已取消預約流程",
-                        template=buttons_template
-                    )
-                ]
+        # ④ 檢查該時段目前是否仍可預約（防止暴力輸入或已被別人搶走）
+        if not is_slot_available(date_str, time_str):
+            line_bot_api.reply_message(
+                ReplyMessageRequest(
+                    reply_token=event.reply_token,
+                    messages=[
+                        TextMessage(
+                            text="很抱歉，您選擇的時段已滿或無法預約，請重新選擇其他時段。"
+                        )
+                    ],
+                )
             )
-        )   
-        return 
+            return
 
-    # === ⑤ 確認預約 ===
-    elif text.startswith("確認預約"):
-        payload = text.replace("確認預約", "").strip()
-        parts = payload.split()
+        # ⑤ 預設先用 DEMO（避免真的炸掉）
+        customer_name = DEMO_CUSTOMER_NAME
+        customer_phone = DEMO_CUSTOMER_PHONE
+        line_display_name = None
+        # 初始化 Zendesk 客戶 ID
+        zendesk_customer_id = None
 
-        if len(parts) == 2 and parts[0].count("-") == 2 and ":" in parts[1]:
-            date_str, time_str = parts
-            display_date = date_str.replace("-", "/")
+        # ⑥ 如果拿得到 line_user_id，就去 Zendesk 找 user
+        if line_user_id:
+            try:
+                zd_count, zd_user = search_zendesk_user_by_line_id(line_user_id)
+                if zd_user:
+                    # Zendesk 裡的 name / phone
+                    zd_name = zd_user.get("name") or customer_name
+                    zd_phone = zd_user.get("phone") or customer_phone
+                    customer_name = zd_name
+                    customer_phone = zd_phone
+                    # 關鍵：從 Zendesk User 物件中取得 ID
+                    zendesk_customer_id = zd_user.get("id")
 
-            # ① 先拿 LINE userId
-            line_user_id = None
-            if event.source and hasattr(event.source, "user_id"):
-                line_user_id = event.source.user_id
+            except Exception as e:
+                app.logger.error(f"用 line_user_id 查 Zendesk user 失敗: {e}")
 
-            # ② 檢查是否已在 Zendesk 建檔（防止未建檔暴力確認）
-            if not is_registered_patient(line_user_id):
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[
-                            TextMessage(
-                                text="目前系統尚未有您的基本資料，請先點選「線上約診」完成建檔，再進行預約喔。"
-                            )
-                        ],
-                    )
-                )
-                return
+            # ⑦ 再拿 LINE 顯示名稱（例如 Kevin）：只讀 profile 快取，不等 LINE API
+            #    （快取沒有時會排背景刷新，這次就只用 Zendesk 姓名）
+            line_display_name = get_display_name(line_user_id)
 
-            # ③ 檢查日期是否合法（三週內／非過去）
-            ok, msg = validate_appointment_date(date_str)
-            if not ok:
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=msg)],
-                    )
-                )
-                return
+        # ⑧ 呼叫新的 create_booking_appointment（會寫入 LINE_USER 到 serviceNotes）
+        try:
+            created = create_booking_appointment(
+                date_str=date_str,
+                time_str=time_str,
+                customer_name=customer_name,
+                customer_phone=customer_phone,
+                # 傳入 Zendesk 客戶 ID 給 Bookings API 函式 (讓它能繼續傳給 Zendesk Ticket 函式)
+                zendesk_customer_id=zendesk_customer_id,
+                line_display_name=line_display_name,
+                line_user_id=line_user_id,
+            )
+            appt_id = created.get("id", "（沒有取得 ID）")
+            # 這天少了一個時段，列時段的快取要重查
+            invalidate_slots(date_str)
+            # ===== DEBUG：強制走 notes 兜底（只在本機測試用）=====
+            if FORCE_ZD_ID_FROM_NOTES:
+                app.logger.info("[debug] FORCE_ZD_ID_FROM_NOTES=1 -> ignore zendesk_customer_id and recover from notes")
+                zendesk_customer_id = None
 
-            # ④ 檢查該時段目前是否仍可預約（防止暴力輸入或已被別人搶走）
-            if not is_slot_available(date_str, time_str):
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[
-                            TextMessage(
-                                text="很抱歉，您選擇的時段已滿或無法預約，請重新選擇其他時段。"
-                            )
-                        ],
-                    )
-                )
-                return
 
-            # ⑤ 預設先用 DEMO（避免真的炸掉）
-            customer_name = DEMO_CUSTOMER_NAME
-            customer_phone = DEMO_CUSTOMER_PHONE
-            line_display_name = None
-            # 初始化 Zendesk 客戶 ID
-            zendesk_customer_id = None
-
-            # ⑥ 如果拿得到 line_user_id，就去 Zendesk 找 user
-            if line_user_id:
-                try:
-                    zd_count, zd_user = search_zendesk_user_by_line_id(line_user_id)
-                    if zd_user:
-                        # Zendesk 裡的 name / phone
-                        zd_name = zd_user.get("name") or customer_name
-                        zd_phone = zd_user.get("phone") or customer_phone
-                        customer_name = zd_name
-                        customer_phone = zd_phone
-                        # 關鍵：從 Zendesk User 物件中取得 ID
-                        zendesk_customer_id = zd_user.get("id")
-
-                except Exception as e:
-                    app.logger.error(f"用 line_user_id 查 Zendesk user 失敗: {e}")
-
-                # ⑦ 再嘗試拿 LINE 顯示名稱（例如 Kevin）
-                try:
-                    profile = line_bot_api.get_profile(line_user_id)
-                    if profile and hasattr(profile, "display_name"):
-                        line_display_name = profile.display_name
-                except Exception as e:
-                    app.logger.error(f"取得 LINE profile 失敗: {e}")
-
-            # ⑧ 呼叫新的 create_booking_appointment（會寫入 LINE_USER 到 serviceNotes）
             try:
-                created = create_booking_appointment(
-                    date_str=date_str,
-                    time_str=time_str,
-                    customer_name=customer_name,
-                    customer_phone=customer_phone,
-                    # 傳入 Zendesk 客戶 ID 給 Bookings API 函式 (讓它能繼續傳給 Zendesk Ticket 函式)
-                    zendesk_customer_id=zendesk_customer_id,
-                    line_display_name=line_display_name,
-                    line_user_id=line_user_id,
-                )
-                appt_id = created.get("id", "（沒有取得 ID）")
-                # ===== DEBUG：強制走 notes 兜底（只在本機測試用）=====
-                if FORCE_ZD_ID_FROM_NOTES:
-                    app.logger.info("[debug] FORCE_ZD_ID_FROM_NOTES=1 -> ignore zendesk_customer_id and recover from notes")
-                    zendesk_customer_id = None
-
-
-                try:
-                        booking_id = created.get("id")
-                        if not booking_id:
-                            app.logger.error(
-                                "[handle_message] Bookings 預約建立成功，但沒有取得 booking id，無法建立 Zendesk ticket"
+                    booking_id = created.get("id")
+                    if not booking_id:
+                        app.logger.error(
+                            "[handle_message] Bookings 預約建立成功，但沒有取得 booking id，無法建立 Zendesk ticket"
+                        )
+                    else:
+                        # 如果當下 zendesk_customer_id 沒拿到，就從 serviceNotes 抽 [ZD_USER]
+                        zid = None
+                        zid_source=None
+                        if zendesk_customer_id:
+                            try:
+                                zid = int(zendesk_customer_id)
+                                zid_source = "param"
+                            except ValueError:
+                                app.logger.error(
+                                    f"[handle_message] Zendesk User ID 不是整數: {zendesk_customer_id}，改用 serviceNotes 取Zendesk User ID"
+                                )
+                                zid = None
+                                zid_source=None
+
+                        #2) 再用 serviceNotes recover
+                        if not zid:
+                            recovered = extract_zd_user_id_from_service_notes(created.get("serviceNotes"))
+                            if recovered:
+                                zid = recovered
+                                zid_source = "notes"
+                                app.logger.info(f"[handle_message] 從 serviceNotes 取得 Zendesk User ID: {zid}")
+
+                        # 3) 決定要不要建票
+                        if not zid:
+                            app.logger.warning(
+                                "[handle_message] 未取得 Zendesk User ID（含 serviceNotes），跳過建立預約 Ticket 流程。"
                             )
                         else:
-                            # 如果當下 zendesk_customer_id 沒拿到，就從 serviceNotes 抽 [ZD_USER]
-                            zid = None
-                            zid_source=None
-                            if zendesk_customer_id:
-                                try:
-                                    zid = int(zendesk_customer_id)
-                                    zid_source = "param"
-                                except ValueError:
-                                    app.logger.error(
-                                        f"[handle_message] Zendesk User ID 不是整數: {zendesk_customer_id}，改用 serviceNotes 取Zendesk User ID"
-                                    )
-                                    zid = None
-                                    zid_source=None
-
-                            #2) 再用 serviceNotes recover
-                            if not zid:
-                                recovered = extract_zd_user_id_from_service_notes(created.get("serviceNotes"))
-                                if recovered:
-                                    zid = recovered
-                                    zid_source = "notes"
-                                    app.logger.info(f"[handle_message] 從 serviceNotes 取得 Zendesk User ID: {zid}")
-
-                            # 3) 決定要不要建票
-                            if not zid:
-                                app.logger.warning(
-                                    "[handle_message] 未取得 Zendesk User ID（含 serviceNotes），跳過建立預約 Ticket 流程。"
-                                )
-                            else:
-                                # 用使用者剛選的本地時間組一個 datetime，當作門診時間
-                                app.logger.info(f"[ticket][zid] source={zid_source} zid={zid} booking_id={booking_id}")
-                                local_start_dt = datetime.strptime(
-                                    f"{date_str} {time_str}", "%Y-%m-%d %H:%M"
-                                )
+                            # 用使用者剛選的本地時間組一個 datetime，當作門診時間
+                            app.logger.info(f"[ticket][zid] source={zid_source} zid={zid} booking_id={booking_id}")
+                            local_start_dt = datetime.strptime(
+                                f"{date_str} {time_str}", "%Y-%m-%d %H:%M"
+                            )
 
-                                ticket_result = create_zendesk_appointment_ticket(
-                                    booking_id=booking_id,
-                                    local_start_dt=local_start_dt,
-                                    zendesk_customer_id=zid,
-                                    customer_name=customer_name,
-                                )
-                                app.logger.info(
-                                    f"[handle_message] 建立預約 Ticket 結果: {ticket_result}"
-                                )
+                            ticket_result = create_zendesk_appointment_ticket(
+                                booking_id=booking_id,
+                                local_start_dt=local_start_dt,
+                                zendesk_customer_id=zid,
+                                customer_name=customer_name,
+                            )
+                            app.logger.info(
+                                f"[handle_message] 建立預約 Ticket 結果: {ticket_result}"
+                            )
 
-                except Exception as e:
-                    app.logger.error(
-                        f"[handle_message] 建立 Zendesk Ticket 發生錯誤（不影響病患畫面）: {e}"
-                    )
+            except Exception as e:
+                app.logger.error(
+                    f"[handle_message] 建立 Zendesk Ticket 發生錯誤（不影響病患畫面）: {e}"
+                )
 
 
-                # 這裡顯示給病患看的姓名，沿用 booking_customer_name 的邏輯
-                if line_display_name:
-                    display_name = f"{customer_name}（{line_display_name}）"
-                else:
-                    display_name = customer_name
+            # 這裡顯示給病患看的姓名，沿用 booking_customer_name 的邏輯
+            if line_display_name:
+                display_name = f"{customer_name}（{line_display_name}）"
+            else:
+                display_name = customer_name
 
-                detail_text = (
-                    "已為您完成預約，請準時報到。\n"
-                    f"姓名：{display_name}\n"
-                    f"時段：{display_date} {time_str}"
-                )
+            detail_text = (
+                "已為您完成預約，請準時報到。\n"
+                f"姓名：{display_name}\n"
+                f"時段：{display_date} {time_str}"
+            )
 
-                buttons_template = ButtonsTemplate(
-                    title="診所位置",
-                    text="如需導航，請點選下方按鈕。",
-                    actions=[
-                        MessageAction(label="位置導航", text="查詢診所位置")
-                    ],
-                )
+            buttons_template = ButtonsTemplate(
+                title="診所位置",
+                text="如需導航，請點選下方按鈕。",
+                actions=[
+                    MessageAction(label="位置導航", text="查詢診所位置")
+                ],
+            )
 
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[
-                            TextMessage(text=detail_text),
-                            TemplateMessage(
-                                alt_text="診所位置導航",
-                                template=buttons_template,
-                            ),
-                        ],
-                    )
+            line_bot_api.reply_message(
+                ReplyMessageRequest(
+                    reply_token=event.reply_token,
+                    messages=[
+                        TextMessage(text=detail_text),
+                        TemplateMessage(
+                            alt_text="診所位置導航",
+                            template=buttons_template,
+                        ),
+                    ],
                 )
-                return
+            )
+            return
 
-            except Exception as e:
-                app.logger.error(f"建立 Bookings 預約失敗: {e}")
-                reply_text = "未成功預約，請重新操作"
+        except Exception as e:
+            app.logger.error(f"建立 Bookings 預約失敗: {e}")
+            reply_text = "未成功預約，請重新操作"
 
-        else:
-            reply_text = "格式：確認預約 YYYY-MM-DD HH:MM"
+    else:
+        reply_text = "格式：確認預約 YYYY-MM-DD HH:MM"
 
-        line_bot_api.reply_message(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[TextMessage(text=reply_text)],
-            )
+    line_bot_api.reply_message(
+        ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[TextMessage(text=reply_text)],
         )
-        return
-    
-    # === 約診查詢 ===
-    elif text == "約診查詢":
-        return flow_query_next_appointment(event, text)
+    )
+    return
 
-    # === ⑤-1 取消約診 ===
-    elif text.startswith("取消約診"):
-        return flow_cancel_request(event, text)
 
-    elif text.startswith("確認取消"):
-        line_bot_api.reply_message(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[TextMessage(text="請先點選「約診查詢」確認約診狀態。")]
-            )
-        )
-        return
+@message_router.exact("約診查詢")
+def _cmd_query_appointment(ctx: MessageContext):
+    """
+    === 約診查詢 ===
+    """
+    return flow_query_next_appointment(ctx.event, ctx.text)
 
 
-    # === ⑦ 確認回診 ===
-    elif text.startswith("確認回診"):
-        line_bot_api.reply_message(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[TextMessage(text="請先點選「約診查詢」確認約診狀態。")]
-            )
-        )
-        return
+@message_router.prefix("取消約診")
+def _cmd_cancel_appointment(ctx: MessageContext):
+    """
+    === ⑤-1 取消約診 ===
+    """
+    return flow_cancel_request(ctx.event, ctx.text)
 
 
-    # === 查詢診所位置 ===
-    elif text == "查詢診所位置":
-        location_message = LocationMessage(
-            title=CLINIC_NAME,
-            address=CLINIC_ADDRESS,
-            latitude=CLINIC_LAT,
-            longitude=CLINIC_LNG
-        )
-        line_bot_api.reply_message(
-            ReplyMessageRequest(reply_token=event.reply_token, messages=[location_message])
+@message_router.prefix("確認取消", "確認回診")
+def _cmd_confirm_without_query(ctx: MessageContext):
+    """
+    === 確認取消 / ⑦ 確認回診：要先從「約診查詢」進來 ===
+    """
+    event = ctx.event
+    line_bot_api.reply_message(
+        ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[TextMessage(text="請先點選「約診查詢」確認約診狀態。")]
         )
-        return
+    )
 
-    # === 診所資訊 ===
-    elif text == "診所資訊":
-        short_text = f"地址：{CLINIC_ADDRESS}\n點擊下方查看地圖位置"
 
-        clinic_info_template = ButtonsTemplate(
-            thumbnail_image_url=CLINIC_IMAGE_URL,
-            title=CLINIC_NAME,
-            text=short_text,
-            actions=[MessageAction(label="查看地圖位置", text="查看地圖位置")]
-        )
+@message_router.exact("查詢診所位置", "查看地圖位置")
+def _cmd_clinic_location(ctx: MessageContext):
+    """
+    === 查詢診所位置 / 查看地圖位置 ===
+    """
+    event = ctx.event
+    location_message = LocationMessage(
+        title=CLINIC_NAME,
+        address=CLINIC_ADDRESS,
+        latitude=CLINIC_LAT,
+        longitude=CLINIC_LNG
+    )
+    line_bot_api.reply_message(
+        ReplyMessageRequest(reply_token=event.reply_token, messages=[location_message])
+    )
+    return
 
-        opening_hours_message = TextMessage(
-            text=(
-                "門診時間：\n"
-                "週一～週六\n"
-                "早診 09:00–12:00\n"
-                "午診 14:00–17:00\n"
-                "晚診 18:00–21:00"
-            )
-        )
 
-        location_message = LocationMessage(
-            title=CLINIC_NAME,
-            address=CLINIC_ADDRESS,
-            latitude=CLINIC_LAT,
-            longitude=CLINIC_LNG
-        )
+@message_router.exact("診所資訊")
+def _cmd_clinic_info(ctx: MessageContext):
+    """
+    === 診所資訊 ===
+    """
+    event = ctx.event
+    short_text = f"地址：{CLINIC_ADDRESS}\n點擊下方查看地圖位置"
+
+    clinic_info_template = ButtonsTemplate(
+        thumbnail_image_url=CLINIC_IMAGE_URL,
+        title=CLINIC_NAME,
+        text=short_text,
+        actions=[MessageAction(label="查看地圖位置", text="查看地圖位置")]
+    )
 
-        line_bot_api.reply_message(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[
-                    TemplateMessage(alt_text="診所資訊", template=clinic_info_template),
-                    opening_hours_message,
-                    location_message
-                ]
-            )
+    opening_hours_message = TextMessage(
+        text=(
+            "門診時間：\n"
+            "週一～週六\n"
+            "早診 09:00–12:00\n"
+            "午診 14:00–17:00\n"
+            "晚診 18:00–21:00"
         )
-        return
+    )
 
-    # === 查看地圖位置 ===
-    elif text == "查看地圖位置":
-        location_message = LocationMessage(
-            title=CLINIC_NAME,
-            address=CLINIC_ADDRESS,
-            latitude=CLINIC_LAT,
-            longitude=CLINIC_LNG
-        )
-        line_bot_api.reply_message(
-            ReplyMessageRequest(reply_token=event.reply_token, messages=[location_message])
+    location_message = LocationMessage(
+        title=CLINIC_NAME,
+        address=CLINIC_ADDRESS,
+        latitude=CLINIC_LAT,
+        longitude=CLINIC_LNG
+    )
+
+    line_bot_api.reply_message(
+        ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[
+                TemplateMessage(alt_text="診所資訊", template=clinic_info_template),
+                opening_hours_message,
+                location_message
+            ]
         )
-        return
+    )
+    return
+
+
+@message_router.default
+def _cmd_default(ctx: MessageContext):
+    """
+    沒有命中任何指令
+    """
+    event = ctx.event
+    uid = ctx.line_user_id
 
     # === fallback：使用者直接輸入手機，但尚未進入任何流程 ===
     if uid:
-        digits = normalize_phone(text)
-        if len(digits) == 10 and digits.startswith("09") and uid not in PENDING_REGISTRATIONS:
+        digits = normalize_phone(ctx.text)
+        if len(digits) == 10 and digits.startswith("09") and not get_state(uid):
             app.logger.info(f"[fallback-phone] uid={uid} digits={digits}")
             line_bot_api.reply_message(
                 ReplyMessageRequest(
@@ -1797,8 +1826,26 @@ def handle_message(event: MessageEvent):
 
 
 
+
+@handler.add(FollowEvent)
+def handle_follow(event):
+    """
+    加好友 / 解除封鎖：先把 LINE profile 抓進快取（不回訊息，歡迎詞由 LINE 後台設定）
+    """
+    line_user_id = getattr(event.source, "user_id", None)
+    app.logger.info(f"[FOLLOW] uid={line_user_id}")
+    refresh_profile(line_user_id)
+
+
 @handler.add(PostbackEvent)
 def handle_postback(event):
+    data = event.postback.data or ""
+    # flow 名稱用 data 冒號前的部分（CONFIRM_APPT:xxx → postback:CONFIRM_APPT）
+    with reply_budget(f"postback:{data.split(':', 1)[0]}", event):
+        return _handle_postback(event)
+
+
+def _handle_postback(event):
     data = event.postback.data or ""
     line_user_id = getattr(event.source, "user_id", None)
 
@@ -1822,7 +1869,6 @@ def handle_postback(event):
             return
         enter_input_step(
             line_bot_api=line_bot_api,
-            pending_dict=PENDING_REGISTRATIONS,
             event=event,
             line_user_id=line_user_id,
             step="ask_phone",
@@ -1868,7 +1914,6 @@ def handle_postback(event):
 
         enter_input_step(
             line_bot_api=line_bot_api,
-            pending_dict=PENDING_REGISTRATIONS,
             event=event,
             line_user_id=line_user_id,
             step="ask_name_after_phone",
@@ -1884,7 +1929,7 @@ def handle_postback(event):
         if not line_user_id:
             return
 
-        state = PENDING_REGISTRATIONS.get(line_user_id) or {}
+        state = get_state(line_user_id)
 
         # ✅ fallback：state 不見也能重建（避免 bad_state）
         if not state:
@@ -1900,7 +1945,7 @@ def handle_postback(event):
                     "zendesk_user_id": user.get("id"),
                     "phone": normalize_phone(user.get("phone") or ""),
                 }
-                PENDING_REGISTRATIONS[line_user_id] = state
+                set_state(line_user_id, state)
                 app.logger.info(
                     f"[CONSENT_NAME_AFTER_PHONE][fallback] rebuilt uid={line_user_id} "
                     f"user_id={state.get('zendesk_user_id')} phone={state.get('phone')}"
@@ -1941,7 +1986,6 @@ def handle_postback(event):
 
         enter_input_step(
             line_bot_api=line_bot_api,
-            pending_dict=PENDING_REGISTRATIONS,
             event=event,
             line_user_id=line_user_id,
             step="ask_name_after_phone",
@@ -2004,8 +2048,59 @@ def cron_run_reminder():
         except ValueError:
             custom_days = None
 
-    count = run_reminder_check(days_before=custom_days)
-    return {"status": "ok", "processed": count}, 200
+    # 掃描改到 reminder worker 跑，這裡只開 run + enqueue，馬上回 run_id
+    run_id, running_id = start_run("reminder", params={"days": custom_days})
+    if not run_id:
+        return {"status": "already_running", "run_id": running_id}, 409
+
+    try:
+        job = reminder_queue.enqueue(
+            "flows_reminders.run_reminder_scan_job",
+            run_id,
+            custom_days,
+        )
+    except Exception as e:
+        app.logger.error(f"[cron_run_reminder] enqueue 失敗 run_id={run_id}: {e}")
+        finish_run(run_id, status="failed", error=str(e))
+        return {"status": "error", "run_id": run_id}, 500
+
+    update_run(run_id, job_id=job.id)
+    return {"status": "queued", "run_id": run_id, "job_id": job.id}, 202
+
+
+@app.route("/cron/runs/<run_id>", methods=["GET"])
+def cron_run_status(run_id):
+    """
+    查詢某一輪 cron 的進度：狀態、掃描張數、排入組數、錯誤數、各階段耗時。
+    提醒 run 另外附上 LINE 推播統計（sent / retried / failed）。
+    """
+    run = get_run(run_id)
+    if not run:
+        return {"status": "not_found", "run_id": run_id}, 404
+
+    if run.get("kind") == "reminder":
+        run["push"] = get_push_run_stats(run_id)
+        scope = run.get("checkpoint")
+        if scope:
+            # 同一天重跑時，從這裡可以看到已排入幾組
+            run["checkpoint_groups"] = len(get_enqueued_groups(scope))
+    return run, 200
+
+
+@app.route("/metrics/routes", methods=["GET"])
+def metrics_routes():
+    """
+    handle_message 各 route 的呼叫次數、錯誤數、平均耗時（ms）。
+    """
+    return get_route_stats(), 200
+
+
+@app.route("/metrics/reply-budget", methods=["GET"])
+def metrics_reply_budget():
+    """
+    各 flow 從 LINE 送出 event 到處理完的耗時，以及超過 reply budget（改送「查詢中」+ push）的比例。
+    """
+    return get_reply_budget_stats(), 200
 
 
 @app.route("/demo/voice-call")
@@ -2084,6 +2179,7 @@ def webhook_livehub():
     data = request.get_json(silent=True) or {}
     app.logger.info(f"[livehub_webhook] received: {data}")
 
+    # 只驗欄位、存進 Redis 就回；Zendesk 回寫由 voice worker 的 flush_voice_call 做
     try:
         handle_livehub_webhook(data)
     except Exception as e:
@@ -2124,11 +2220,88 @@ def demo_enqueue_voice_from_zendesk():
 def cron_run_voice_reminder():
     # 預設一天前 D1
     days = int(request.args.get("days", "1"))
-    result = build_voice_groups_and_enqueue(days=days)
-    return result, 200
+    # 預設讀 D-3 建好的外撥名單；?source=zendesk 強制重掃 Zendesk
+    source = request.args.get("source", "auto")
+
+    run_id, running_id = start_run("voice", params={"days": days, "source": source})
+    if not run_id:
+        return {"status": "already_running", "run_id": running_id}, 409
+
+    try:
+        job = voice_call_queue.enqueue(
+            "flows_voice_scheduler.run_voice_scan_job",
+            run_id,
+            days,
+            source,
+        )
+    except Exception as e:
+        app.logger.error(f"[cron_run_voice_reminder] enqueue 失敗 run_id={run_id}: {e}")
+        finish_run(run_id, status="failed", error=str(e))
+        return {"status": "error", "run_id": run_id}, 500
+
+    update_run(run_id, job_id=job.id)
+    return {"status": "queued", "run_id": run_id, "job_id": job.id}, 202
+
+
+
+
+@app.route("/cron/voice-dialer/pump", methods=["GET"])
+def cron_voice_dialer_pump():
+    """
+    每幾分鐘打一次：撥號時段一開始、或 webhook 漏掉時，把佇列裡等著的組補撥出去；
+    順便把一直沒收到結束狀態的通話補回寫 Zendesk、到期的重撥送進佇列。
+    """
+    stale_flushed = flush_stale_voice_calls()
+    retries_fed = feed_due_retries()
+    started = pump_dialer()
+    return {
+        "started": started,
+        "stale_flushed": stale_flushed,
+        "retries_fed": retries_fed,
+        **get_dialer_status(),
+        "retry": get_retry_status(),
+    }, 200
+
+
+@app.route("/voice-dialer/status", methods=["GET"])
+def voice_dialer_status():
+    return {**get_dialer_status(), "retry": get_retry_status()}, 200
+
+
+@app.route("/voice/outcomes", methods=["GET"])
+def voice_outcomes_summary():
+    """
+    某天撥出的外撥統計（接通率、LiveHub 回應時間、接聽時間的 p50/p90/p99），不用去翻 Zendesk。
+    例：/voice/outcomes?date=2025-01-31（預設今天）
+    """
+    day = request.args.get("date") or datetime.now().strftime("%Y-%m-%d")
+    try:
+        datetime.strptime(day, "%Y-%m-%d")
+    except ValueError:
+        return {"error": "date 格式要是 YYYY-MM-DD"}, 400
+    return get_day_summary(day), 200
 
 
+@app.route("/voice/manifest", methods=["GET"])
+def voice_manifest_status():
+    """
+    D-1 外撥名單還剩幾個人（D-3 提醒時建立，確認 / 取消會拿掉）。
+    例：/voice/manifest?date=2025-01-31（預設明天）
+    """
+    day = request.args.get("date") or (datetime.now() + timedelta(days=1)).strftime("%Y-%m-%d")
+    try:
+        datetime.strptime(day, "%Y-%m-%d")
+    except ValueError:
+        return {"error": "date 格式要是 YYYY-MM-DD"}, 400
+    return get_manifest_status(day), 200
+
 
+@app.route("/workers/pool", methods=["GET"])
+def workers_pool_status():
+    """
+    worker_pool.py 回報的狀態：每個 queue 的長度、worker 數（目標 / 範圍）、重開次數、每個 worker 的處理量。
+    """
+    return get_pool_status(), 200
 
 
 # 本機用5001，Azure則用賦予的port
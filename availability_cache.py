@@ -0,0 +1,68 @@
+# availability_cache.py
+import json
+
+from flask import current_app as app
+
+from bookings_core import get_available_slots_for_date, forget_appointments_for_date
+from queue_core import redis_conn
+
+from config import AVAILABILITY_CACHE_TTL_SEC
+
+PREFIX = "linebot:avail:"   # linebot:avail:{YYYY-MM-DD} → JSON list，例如 ["09:00", "09:30"]
+
+
+def _key(date_str: str) -> str:
+    return f"{PREFIX}{date_str}"
+
+
+def get_cached_slots(date_str: str) -> list | None:
+    """
+    只讀快取；沒有（或 Redis 有問題）回傳 None。
+    """
+    try:
+        raw = redis_conn.get(_key(date_str))
+    except Exception as e:
+        app.logger.warning(f"[availability_cache] 讀取快取失敗 date={date_str}: {e}")
+        return None
+    if raw is None:
+        return None
+    try:
+        return json.loads(raw)
+    except Exception:
+        return None
+
+
+def refresh_slots(date_str: str) -> list:
+    """
+    打 Graph 重新算一次可預約時段，寫進快取後回傳。
+    """
+    slots = get_available_slots_for_date(date_str)
+    try:
+        redis_conn.set(_key(date_str), json.dumps(slots), ex=AVAILABILITY_CACHE_TTL_SEC)
+    except Exception as e:
+        app.logger.warning(f"[availability_cache] 寫入快取失敗 date={date_str}: {e}")
+    return slots
+
+
+def get_available_slots_cached(date_str: str) -> list:
+    """
+    給「列出日期 / 時段」用：有快取就用快取，沒有才打 Graph。
+    真正要預約前的檢查（is_slot_available）不要用這個，要看即時資料。
+    """
+    slots = get_cached_slots(date_str)
+    if slots is not None:
+        return slots
+    return refresh_slots(date_str)
+
+
+def invalidate_slots(date_str: str) -> None:
+    """
+    某天有新增 / 取消預約後呼叫，下次列時段會重新查。
+    """
+    if not date_str:
+        return
+    forget_appointments_for_date(date_str)
+    try:
+        redis_conn.delete(_key(date_str))
+    except Exception as e:
+        app.logger.warning(f"[availability_cache] 清除快取失敗 date={date_str}: {e}")
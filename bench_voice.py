@@ -0,0 +1,137 @@
+# bench_voice.py
+"""
+外撥壓測（搭配 livehub_simulator.py，不會真的打電話）。
+
+1) webhook：直接對 bot 的 /webhook/livehub 灌假 event，量 ingest 速度
+    python bench_voice.py webhook --url http://localhost:5001/webhook/livehub -n 2000 -c 20
+
+2) dial：排 N 組假的外撥進 voice_dialer，量撥號 throughput 跟 webhook 處理速度（端到端）
+    需要先開：livehub_simulator.py、bot（LIVEHUB_BASE_URL / LIVEHUB_NOTIFY_URL 指向模擬器 / bot）、worker_voice.py
+    撥號時段要涵蓋壓測時間（例：VOICE_CALL_WINDOW_START=00:00 VOICE_CALL_WINDOW_END=23:59）
+    python bench_voice.py dial -n 200 --sim http://localhost:5055
+
+注意：假 ticket id 從 --ticket-base 開始；Zendesk 若有設定，鎖票 / 回寫會打到 Zendesk 並失敗（只留 log）。
+"""
+import argparse
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+def _pct(values: list[float], p: float):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(round(p * (len(values) - 1))))], 1)
+
+
+def bench_webhook(url: str, n: int, concurrency: int, ticket_base: int) -> None:
+    """
+    每通假電話送 ringing → 結束狀態兩個 event，量 bot 回 200 的速度。
+    """
+    statuses = ["no_answer", "busy", "completed", "voicemail"]
+    run = uuid.uuid4().hex[:8]
+
+    def send(i: int) -> float | None:
+        status = "ringing" if i % 2 == 0 else statuses[(i // 2) % len(statuses)]
+        payload = {
+            "callId": f"bench-{run}-{i // 2}",
+            "callStatus": status,
+            "metadata": {"ticketIds": str(ticket_base + i // 2), "appointmentDate": "2099-01-01"},
+        }
+        started = time.perf_counter()
+        try:
+            requests.post(url, json=payload, timeout=10).raise_for_status()
+        except Exception:
+            return None
+        return (time.perf_counter() - started) * 1000.0
+
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(send, range(n)))
+    elapsed = time.time() - started
+
+    ok = [r for r in results if r is not None]
+    print(f"[webhook] sent={n} ok={len(ok)} errors={n - len(ok)} elapsed={elapsed:.2f}s "
+          f"rate={len(ok) / elapsed:.1f}/s")
+    print(f"[webhook] latency_ms p50={_pct(ok, 0.5)} p90={_pct(ok, 0.9)} p99={_pct(ok, 0.99)}")
+
+
+def bench_dial(n: int, sim_url: str, timeout_sec: float, ticket_base: int) -> None:
+    """
+    直接把 N 組排進 voice_dialer（不掃 Zendesk），等模擬器收到 N 通撥號、webhook 都送完。
+    """
+    os.environ.setdefault("VOICE_CALL_WINDOW_START", "00:00")
+    os.environ.setdefault("VOICE_CALL_WINDOW_END", "23:59")
+
+    from app import app
+    from voice_dialer import submit_dial, pump_dialer, get_dialer_status
+
+    requests.post(f"{sim_url}/sim/reset", timeout=5)
+
+    with app.app_context():
+        started = time.time()
+        for i in range(n):
+            tid = ticket_base + i
+            submit_dial(
+                "U_bench",
+                "2099-01-01",
+                [tid],
+                {
+                    "patient_name": "壓測",
+                    "phone": "0900000000",
+                    "requester_id": tid,
+                    "ticket_attempts": {str(tid): 0},
+                },
+            )
+        pump_dialer()
+
+        last = None
+        while time.time() - started < timeout_sec:
+            time.sleep(2)
+            s = requests.get(f"{sim_url}/sim/stats", timeout=5).json()
+            d = get_dialer_status()
+            last = s
+            print(
+                f"[dial] t={time.time() - started:5.1f}s dials={s['dials']} failures={s['dial_failures']} "
+                f"webhooks={s['webhooks_sent']} pending={d['pending']} inflight={len(d['inflight'])}"
+            )
+            if s["dials"] >= n and d["pending"] == 0 and not d["inflight"]:
+                break
+
+    elapsed = time.time() - started
+    if not last:
+        return
+    print(f"[dial] groups={n} elapsed={elapsed:.1f}s dials/s={last['dials'] / elapsed:.2f} "
+          f"webhooks/s={last['webhooks_sent'] / elapsed:.2f}")
+    print(f"[dial] outcomes={last['outcomes']} webhook_ms={last['webhook_ms']}")
+
+
+def main():
+    p = argparse.ArgumentParser(description="外撥 / LiveHub webhook 壓測")
+    sub = p.add_subparsers(dest="cmd", required=True)
+
+    w = sub.add_parser("webhook", help="對 /webhook/livehub 灌假 event")
+    w.add_argument("--url", default="http://localhost:5001/webhook/livehub")
+    w.add_argument("-n", type=int, default=1000)
+    w.add_argument("-c", "--concurrency", type=int, default=10)
+    w.add_argument("--ticket-base", type=int, default=900000000)
+
+    d = sub.add_parser("dial", help="端到端：voice_dialer → 模擬器 → webhook")
+    d.add_argument("-n", type=int, default=100)
+    d.add_argument("--sim", default="http://localhost:5055")
+    d.add_argument("--timeout", type=float, default=600)
+    d.add_argument("--ticket-base", type=int, default=900000000)
+
+    args = p.parse_args()
+    if args.cmd == "webhook":
+        bench_webhook(args.url, args.n, args.concurrency, args.ticket_base)
+    else:
+        bench_dial(args.n, args.sim, args.timeout, args.ticket_base)
+
+
+if __name__ == "__main__":
+    main()
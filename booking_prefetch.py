@@ -0,0 +1,89 @@
+# booking_prefetch.py
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app as app
+
+from availability_cache import get_cached_slots, refresh_slots
+from flows_slots import get_week_candidate_dates
+from queue_core import redis_conn, line_event_queue
+
+from config import BOOKING_PREFETCH_WEEKS, LINE_WEBHOOK_MODE
+
+WARMING_PREFIX = "linebot:avail:warming:"   # 某天正在被預先查詢（避免很多人同時進來重複打 Graph）
+WARMING_LOCK_TTL_SEC = 30
+
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="booking-prefetch")
+
+
+def _bookable_dates(weeks: int) -> list[str]:
+    """
+    前 weeks 個「有候選日期」的週（週六晚上本週已經沒有日期，就往後算）。
+    """
+    dates: list[str] = []
+    found = 0
+    for offset in range(0, 4):
+        candidates = get_week_candidate_dates(offset)
+        if not candidates:
+            continue
+        dates.extend(d.isoformat() for d in candidates)
+        found += 1
+        if found >= weeks:
+            break
+    return dates
+
+
+def _warm_date(date_str: str) -> bool:
+    """
+    快取沒有、也沒有別人正在查 → 查一次。回傳這次有沒有真的打 Graph。
+    """
+    if get_cached_slots(date_str) is not None:
+        return False
+    try:
+        if not redis_conn.set(f"{WARMING_PREFIX}{date_str}", "1", nx=True, ex=WARMING_LOCK_TTL_SEC):
+            return False
+    except Exception as e:
+        app.logger.warning(f"[booking_prefetch] 取得 warming 鎖失敗 date={date_str}: {e}")
+        return False
+    try:
+        refresh_slots(date_str)
+        return True
+    except Exception as e:
+        app.logger.error(f"[booking_prefetch] 預先查時段失敗 date={date_str}: {e}")
+        return False
+    finally:
+        redis_conn.delete(f"{WARMING_PREFIX}{date_str}")
+
+
+def run_booking_prefetch(line_user_id: str | None = None) -> dict:
+    """
+    RQ job / thread：「線上約診」一進來就先把前 BOOKING_PREFETCH_WEEKS 週每一天的可預約時段查好（availability_cache），
+    跟入口查 Zendesk 病患資料同時跑。病患資料由入口查完直接放進 patient_core 的快取，這裡不用再查。
+    """
+    warmed = 0
+    for date_str in _bookable_dates(BOOKING_PREFETCH_WEEKS):
+        if _warm_date(date_str):
+            warmed += 1
+
+    app.logger.info(f"[booking_prefetch] uid={line_user_id} warmed_dates={warmed}")
+    return {"warmed_dates": warmed}
+
+
+def _prefetch_in_thread(flask_app, line_user_id: str | None) -> None:
+    with flask_app.app_context():
+        try:
+            run_booking_prefetch(line_user_id)
+        except Exception as e:
+            app.logger.exception(f"[booking_prefetch] uid={line_user_id} 失敗: {e}")
+
+
+def prefetch_booking_flow(line_user_id: str | None = None) -> None:
+    """
+    在背景跑 run_booking_prefetch，不等結果。
+    """
+    if LINE_WEBHOOK_MODE == "rq":
+        try:
+            line_event_queue.enqueue("booking_prefetch.run_booking_prefetch", line_user_id)
+            return
+        except Exception as e:
+            app.logger.warning(f"[booking_prefetch] enqueue 失敗，改用 thread uid={line_user_id}: {e}")
+    _executor.submit(_prefetch_in_thread, app._get_current_object(), line_user_id)
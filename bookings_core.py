@@ -2,9 +2,14 @@ from datetime import datetime, timedelta
 import os
 import requests
 import re
+import threading
+import time
 from flask import current_app as app  # 用 app.logger
 
+from singleflight import singleflight, forget
+
 from config import (
+    GRAPH_TOKEN_SHARE_TTL_SEC,
     BOOKING_BUSINESS_ID,
     BOOKING_DEMO_SERVICE_ID,
     BOOKING_DEMO_STAFF_ID,
@@ -16,7 +21,27 @@ from config import (
 
 # ======== 跟 Entra 拿 Microsoft Graph 的 access token ========
 
+# token 只放在這個 process 的記憶體裡（不寫 Redis，避免 access token 明文落地）
+_graph_token = {"value": None, "expires_at": 0.0}
+_graph_token_lock = threading.Lock()
+
+
 def get_graph_token():
+    """
+    同時很多人要 token 時只跟 Entra 要一次（同一個 process 的 thread 共用，保留 GRAPH_TOKEN_SHARE_TTL_SEC 秒）。
+    """
+    with _graph_token_lock:
+        if _graph_token["value"] and time.time() < _graph_token["expires_at"]:
+            return _graph_token["value"]
+
+    token = singleflight("graph:token", _fetch_graph_token, local_only=True)
+    with _graph_token_lock:
+        _graph_token["value"] = token
+        _graph_token["expires_at"] = time.time() + GRAPH_TOKEN_SHARE_TTL_SEC
+    return token
+
+
+def _fetch_graph_token():
     tenant_id = os.environ.get("GRAPH_TENANT_ID")
     client_id = os.environ.get("GRAPH_CLIENT_ID")
     client_secret = os.environ.get("GRAPH_CLIENT_SECRET")
@@ -80,8 +105,20 @@ def parse_booking_datetime_to_local(start_dt_str: str) -> datetime | None:
 def list_appointments_for_date(date_str: str) -> list:
     """
     從 Bookings 取得指定日期 (台北時間, YYYY-MM-DD) 的所有預約列表。
+    同一天同時很多人查時，只打一次 Graph，其他人等同一個結果（singleflight）。
     回傳: 預約列表 (list of dict)
     """
+    return singleflight(f"graph:calendar:{date_str}", lambda: _fetch_appointments_for_date(date_str))
+
+
+def forget_appointments_for_date(date_str: str) -> None:
+    """
+    這天剛新增 / 取消預約 → 丟掉還在共用的查詢結果
+    """
+    forget(f"graph:calendar:{date_str}")
+
+
+def _fetch_appointments_for_date(date_str: str) -> list:
     token: str = get_graph_token()
     business_id: str = os.environ.get("BOOKING_BUSINESS_ID") or BOOKING_BUSINESS_ID
 
@@ -61,6 +61,58 @@ ZENDESK_REMINDER_STATE_CANCELLED = "已取消預約"
 # 距離看診幾天前要發提醒（正式版可能是 3，測試可以先改）
 REMINDER_DAYS_BEFORE = int(os.environ.get("REMINDER_DAYS_BEFORE", "3"))
 
+# ======== LINE push 發送速率（所有 worker 共用同一個 token bucket） ========
+LINE_PUSH_RATE_PER_SEC = float(os.environ.get("LINE_PUSH_RATE_PER_SEC", "50"))  # 每秒補幾個 token
+LINE_PUSH_BURST = int(os.environ.get("LINE_PUSH_BURST", "100"))                 # bucket 容量（瞬間最多幾則）
+LINE_PUSH_MAX_RETRIES = int(os.environ.get("LINE_PUSH_MAX_RETRIES", "3"))       # 429 / 5xx 最多重試幾次
+
+# 同一組提醒裡，同時對 Zendesk 寫入的 ticket 數（thread pool 大小）
+ZENDESK_WRITE_CONCURRENCY = int(os.environ.get("ZENDESK_WRITE_CONCURRENCY", "4"))
+# tickets/update_many 是非同步的（回 job_status）：最多等幾秒、每隔幾秒查一次結果
+ZENDESK_JOB_POLL_TIMEOUT_SEC = float(os.environ.get("ZENDESK_JOB_POLL_TIMEOUT_SEC", "20"))
+ZENDESK_JOB_POLL_INTERVAL_SEC = float(os.environ.get("ZENDESK_JOB_POLL_INTERVAL_SEC", "1"))
+
+# 提醒掃描切成幾個 shard（依 requester_id 分），每個 shard 一個 RQ job，可分散到多個 reminder worker
+REMINDER_SCAN_SHARDS = int(os.environ.get("REMINDER_SCAN_SHARDS", "4"))
+
+# ======== LINE webhook 處理方式 ========
+# callback 只驗簽 + 丟出去就回 200，event 在這裡指定的地方處理：
+# - "thread"：同一個 process 的 thread pool（預設）
+# - "rq"：丟到 line_events queue，由 worker_line_events.py 處理
+# - "sync"：跟以前一樣在 request 裡處理完才回
+LINE_WEBHOOK_MODE = os.environ.get("LINE_WEBHOOK_MODE", "thread")
+LINE_EVENT_THREADS = int(os.environ.get("LINE_EVENT_THREADS", "8"))
+# 同一個 webhookEventId 記多久（LINE 重送都在這個時間內）
+LINE_EVENT_DEDUPE_TTL_SEC = int(os.environ.get("LINE_EVENT_DEDUPE_TTL_SEC", str(24 * 60 * 60)))
+# 同一個使用者的 event 一次只給一個 worker 處理；鎖的 TTL（處理中會一直續期，worker 掛掉最多卡這麼久）
+LINE_USER_LOCK_TTL_SEC = int(os.environ.get("LINE_USER_LOCK_TTL_SEC", "60"))
+# event「處理中」的記號留多久（約預期處理時間的 2 倍）；worker 掛掉時不會把之後的重送擋一整天
+LINE_EVENT_PROCESSING_TTL_SEC = int(os.environ.get("LINE_EVENT_PROCESSING_TTL_SEC", str(2 * LINE_USER_LOCK_TTL_SEC)))
+# 從 LINE 送出 event 起超過這個秒數還沒回覆 → 先回「查詢中」，最後結果改用 push
+LINE_REPLY_BUDGET_SEC = float(os.environ.get("LINE_REPLY_BUDGET_SEC", "5"))
+# 提示方式：text = 用 reply token 回一句 LINE_REPLY_INTERIM_TEXT；loading = 顯示讀取動畫（不佔用 reply token）
+LINE_REPLY_INTERIM_MODE = os.environ.get("LINE_REPLY_INTERIM_MODE", "text")
+LINE_REPLY_INTERIM_TEXT = os.environ.get("LINE_REPLY_INTERIM_TEXT", "查詢中，請稍候…")
+# callback 記完整 webhook body 的抽樣比例（0 = 不記，1 = 每次都記；除錯時再打開）
+LINE_WEBHOOK_LOG_BODY_RATE = float(os.environ.get("LINE_WEBHOOK_LOG_BODY_RATE", "0"))
+
+# LINE profile（顯示名稱）快取：留 30 天，超過 1 天的下次讀到時背景刷新
+PROFILE_CACHE_TTL_SEC = int(os.environ.get("PROFILE_CACHE_TTL_SEC", str(30 * 24 * 60 * 60)))
+PROFILE_REFRESH_AFTER_SEC = int(os.environ.get("PROFILE_REFRESH_AFTER_SEC", str(24 * 60 * 60)))
+
+# 可預約時段快取（列日期 / 時段用；真正預約前還是會即時再檢查一次）
+AVAILABILITY_CACHE_TTL_SEC = int(os.environ.get("AVAILABILITY_CACHE_TTL_SEC", "120"))
+# 已建檔病患的 Zendesk 資料快取（只存 name + phone 都齊全的）
+PATIENT_CACHE_TTL_SEC = int(os.environ.get("PATIENT_CACHE_TTL_SEC", "300"))
+# 「線上約診」進來時預先查好前幾週的時段
+BOOKING_PREFETCH_WEEKS = int(os.environ.get("BOOKING_PREFETCH_WEEKS", "2"))
+
+# singleflight：同一個上游查詢同時只打一次，其他人等結果
+SINGLEFLIGHT_SHARE_TTL_SEC = float(os.environ.get("SINGLEFLIGHT_SHARE_TTL_SEC", "1"))   # 結果給其他 process 共用幾秒
+SINGLEFLIGHT_WAIT_SEC = float(os.environ.get("SINGLEFLIGHT_WAIT_SEC", "15"))           # 最多等帶頭的人幾秒
+# Graph token 效期約 1 小時，同一個 process 內共用 5 分鐘很安全（只放記憶體，不寫 Redis）
+GRAPH_TOKEN_SHARE_TTL_SEC = float(os.environ.get("GRAPH_TOKEN_SHARE_TTL_SEC", "300"))
+
 
 
 # ======== 預約時段相關設定（之後要改時段只改這裡） ========
@@ -85,8 +137,7 @@ WEEK_IMAGE_URL = "https://res.cloudinary.com/drbhr7kmb/image/upload/v1763314182/
 # serviceNotes 裡當「確認」的標記字串
 CONFIRM_NOTE_KEYWORD = "Confirmed via LINE"
 
-# 暫存「首次建檔」流程的狀態（key = line_user_id）
-PENDING_REGISTRATIONS = {}
+# 「首次建檔」流程的狀態改存在 Redis：請用 state_store 的 get_state / set_state / update_state / clear_state
 
 CONFIRM_OPEN_DAYS_BEFORE = 3  # 原本 2，現在 +1
 CANCEL_DEADLINE_DAYS_BEFORE = 4  # 原本 3，現在 +1
@@ -106,3 +157,32 @@ DEMO_FAIL_TICKET_ID_NO_RQ = os.getenv("DEMO_FAIL_TICKET_ID_NO_RQ")
 DEMO_FAIL_TICKET_ID_RQ = os.getenv("DEMO_FAIL_TICKET_ID_RQ")
 
 print(f"[CONFIG DEMO] NO_RQ={DEMO_FAIL_TICKET_ID_NO_RQ!r}, RQ={DEMO_FAIL_TICKET_ID_RQ!r}")
+
+# 外撥 dialer：同時最多幾通在通話（LiveHub 線路有限）、可以打電話的時段（本地時間 HH:MM）
+VOICE_MAX_INFLIGHT_CALLS = int(os.environ.get("VOICE_MAX_INFLIGHT_CALLS", "3"))
+VOICE_CALL_WINDOW_START = os.environ.get("VOICE_CALL_WINDOW_START", "09:00")
+VOICE_CALL_WINDOW_END = os.environ.get("VOICE_CALL_WINDOW_END", "20:00")
+# 超過這麼久沒收到結束 webhook 的通話，當作已結束釋放 slot
+VOICE_CALL_STALE_SEC = int(os.environ.get("VOICE_CALL_STALE_SEC", "900"))
+# LiveHub webhook：同一通最後一個 event 後等幾秒再回寫 Zendesk（讓連續幾個結束狀態收斂成最新的一個）
+VOICE_WEBHOOK_SETTLE_SEC = float(os.environ.get("VOICE_WEBHOOK_SETTLE_SEC", "3"))
+# LiveHub 回呼防重送：(call_id, ticket_id, status) 在 Redis 記多久
+VOICE_CALLBACK_DEDUPE_TTL_SEC = int(os.environ.get("VOICE_CALLBACK_DEDUPE_TTL_SEC", str(7 * 24 * 60 * 60)))
+# 沒接 / 忙線 / 撥號失敗的重撥：第 n 次失敗後等幾秒（逗號分隔，超過就用最後一個），同一組撥滿幾通（含第一通）就不再撥
+VOICE_RETRY_BACKOFF_SEC = os.environ.get("VOICE_RETRY_BACKOFF_SEC", "1800,3600,7200")
+VOICE_RETRY_MAX_ATTEMPTS = int(os.environ.get("VOICE_RETRY_MAX_ATTEMPTS", "3"))
+# 撥號優先順序：約診越早越先撥；每多撥過一次往後排幾秒；不知道約診時間時當作幾點
+VOICE_PRIORITY_ATTEMPT_PENALTY_SEC = int(os.environ.get("VOICE_PRIORITY_ATTEMPT_PENALTY_SEC", "1800"))
+VOICE_PRIORITY_DEFAULT_TIME = os.environ.get("VOICE_PRIORITY_DEFAULT_TIME", "12:00")
+# D-3 LINE 提醒時順便把 D-1 外撥名單寫進 Redis；D-1 直接讀名單，不再掃 Zendesk（設 0 關掉，回到每次掃描）
+VOICE_MANIFEST_ENABLED = os.environ.get("VOICE_MANIFEST_ENABLED", "1") == "1"
+
+# worker_pool.py：每個 queue 開幾個 worker（queue:最少:最多），依排隊中的 job 數在範圍內調整
+WORKER_POOL_QUEUES = os.environ.get("WORKER_POOL_QUEUES", "reminders:1:4,voice_calls:1:3,line_events:1:4")
+# 每多幾個排隊中的 job 多開一個 worker；數量變少要持續多久才關一個
+WORKER_POOL_JOBS_PER_WORKER = int(os.environ.get("WORKER_POOL_JOBS_PER_WORKER", "20"))
+WORKER_POOL_SCALE_DOWN_SEC = int(os.environ.get("WORKER_POOL_SCALE_DOWN_SEC", "120"))
+WORKER_POOL_CHECK_SEC = float(os.environ.get("WORKER_POOL_CHECK_SEC", "5"))
+# SIGTERM 後等 worker 做完手上 job 的上限；處理量多久印一次 log
+WORKER_POOL_DRAIN_TIMEOUT_SEC = int(os.environ.get("WORKER_POOL_DRAIN_TIMEOUT_SEC", "120"))
+WORKER_POOL_REPORT_SEC = int(os.environ.get("WORKER_POOL_REPORT_SEC", "60"))
@@ -0,0 +1,151 @@
+# cron_runs.py
+import json
+import time
+import uuid
+from datetime import datetime
+
+from queue_core import redis_conn
+
+RUN_PREFIX = "linebot:cron:run:"     # 每一輪 run 的進度（Redis hash）
+LOCK_PREFIX = "linebot:cron:lock:"   # 同一種 cron 同時只能跑一輪
+RUN_TTL_SEC = 3 * 24 * 60 * 60       # 進度留三天
+DEFAULT_LOCK_TTL_SEC = 30 * 60       # job 掛掉時，鎖最多卡 30 分鐘
+
+# 只有持有者（value == run_id）才能解鎖，避免誤刪下一輪的鎖
+_RELEASE_LOCK_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+_release_lock = redis_conn.register_script(_RELEASE_LOCK_LUA)
+
+
+def _run_key(run_id: str) -> str:
+    return f"{RUN_PREFIX}{run_id}"
+
+
+def _lock_key(kind: str) -> str:
+    return f"{LOCK_PREFIX}{kind}"
+
+
+def _decode(v):
+    return v.decode() if isinstance(v, bytes) else v
+
+
+def new_run_id() -> str:
+    return f"{datetime.now().strftime('%Y%m%d')}-{uuid.uuid4().hex[:8]}"
+
+
+def start_run(kind: str, params: dict | None = None, lock_ttl_sec: int = DEFAULT_LOCK_TTL_SEC) -> tuple[str | None, str | None]:
+    """
+    開一輪新的 run 並拿鎖。
+    回傳 (run_id, None)；若已有同 kind 的 run 在跑，回傳 (None, 正在跑的 run_id)。
+    """
+    run_id = new_run_id()
+    if not redis_conn.set(_lock_key(kind), run_id, nx=True, ex=lock_ttl_sec):
+        return None, _decode(redis_conn.get(_lock_key(kind)))
+
+    pipe = redis_conn.pipeline()
+    pipe.hset(_run_key(run_id), mapping={
+        "kind": kind,
+        "status": "queued",
+        "params": json.dumps(params or {}, ensure_ascii=False),
+        "created_at": str(time.time()),
+    })
+    pipe.expire(_run_key(run_id), RUN_TTL_SEC)
+    pipe.execute()
+    return run_id, None
+
+
+def update_run(run_id: str | None, **fields) -> None:
+    if not run_id or not fields:
+        return
+    redis_conn.hset(_run_key(run_id), mapping={k: str(v) for k, v in fields.items()})
+
+
+def incr_run(run_id: str | None, field: str, amount: int = 1) -> int:
+    """
+    原子累加某個計數欄位，回傳累加後的值（多個 shard 同時寫也不會互蓋）。
+    """
+    if not run_id:
+        return 0
+    return int(redis_conn.hincrby(_run_key(run_id), field, amount))
+
+
+def mark_shard_done(run_id: str | None, shard_index: int) -> tuple[bool, int]:
+    """
+    記錄某個 shard 已完成（SADD，同一個 shard 重跑不會重複算）。
+    回傳 (這次是不是第一次記, 已完成的 shard 數)。
+    """
+    if not run_id:
+        return False, 0
+    key = f"{_run_key(run_id)}:shards"
+    pipe = redis_conn.pipeline()
+    pipe.sadd(key, int(shard_index))
+    pipe.expire(key, RUN_TTL_SEC)
+    pipe.scard(key)
+    added, _, done = pipe.execute()
+    redis_conn.hset(_run_key(run_id), "shards_done", done)
+    return bool(added), int(done)
+
+
+def record_stage(run_id: str | None, stage: str, started_at: float) -> None:
+    """
+    記錄某個階段花了幾秒，例如 stage_search_sec=1.234
+    """
+    if not run_id:
+        return
+    redis_conn.hset(_run_key(run_id), f"stage_{stage}_sec", f"{time.time() - started_at:.3f}")
+
+
+def finish_run(run_id: str | None, status: str = "done", result: dict | None = None, error: str | None = None) -> None:
+    """
+    標記 run 結束並釋放鎖（只釋放自己的鎖）。
+    """
+    if not run_id:
+        return
+    fields = {"status": status, "finished_at": str(time.time())}
+    if result is not None:
+        fields["result"] = json.dumps(result, ensure_ascii=False, default=str)
+    if error:
+        fields["error"] = error[:500]
+    redis_conn.hset(_run_key(run_id), mapping=fields)
+
+    kind = _decode(redis_conn.hget(_run_key(run_id), "kind"))
+    if kind:
+        _release_lock(keys=[_lock_key(kind)], args=[run_id])
+
+
+def get_run(run_id: str) -> dict | None:
+    """
+    讀出 run 的進度；數字欄位轉回 int / float，json 欄位轉回 dict。
+    """
+    raw = redis_conn.hgetall(_run_key(run_id))
+    if not raw:
+        return None
+
+    run = {"run_id": run_id}
+    for k, v in raw.items():
+        k, v = _decode(k), _decode(v)
+        if k in ("params", "result"):
+            try:
+                v = json.loads(v)
+            except Exception:
+                pass
+        elif k.startswith("stage_") or k.endswith("_at"):
+            try:
+                v = float(v)
+            except ValueError:
+                pass
+        else:
+            try:
+                v = int(v)
+            except ValueError:
+                pass
+        run[k] = v
+
+    if "created_at" in run:
+        end = run.get("finished_at") or time.time()
+        run["elapsed_sec"] = round(end - run["created_at"], 3)
+    return run
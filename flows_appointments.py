@@ -33,6 +33,9 @@ from zendesk_core import (
     mark_zendesk_ticket_cancelled,
 )
 
+from availability_cache import invalidate_slots
+from voice_manifest import remove_booking_from_manifest
+
 from patient_core import (
     get_future_appointments_for_line_user,
     get_next_upcoming_appointment_for_line_user,
@@ -399,8 +402,13 @@ def flow_confirm_cancel(event, text: str):
         )
         return
 
+    # 這天多出一個時段，列時段的快取要重查
+    invalidate_slots(local_start.strftime("%Y-%m-%d"))
+
     # --- 同步更新 Zendesk ticket：這筆 booking 已經取消，不用再提醒 ---
     booking_id = appt.get("id") or appt_id
+    # D-1 外撥名單也拿掉（不等 Zendesk 同步）
+    remove_booking_from_manifest(booking_id)
     if booking_id:
         try:
             ticket = find_zendesk_ticket_by_booking_id(booking_id)
@@ -580,6 +588,8 @@ def flow_confirm_visit(event, text: str):
 
     # --- 同步更新 Zendesk ticket 狀態 ---
     booking_id = appt.get("id")
+    # 已經確認回診：D-1 不用再打電話，從外撥名單拿掉
+    remove_booking_from_manifest(booking_id)
     if booking_id:
         try:
             ticket = find_zendesk_ticket_by_booking_id(booking_id)
@@ -1,23 +1,39 @@
 # flows_reminders.py 建議 import
 
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 from queue_core import reminder_queue
-import json, os
+import json, os, time, zlib
 
 import requests
 
 from flask import current_app as app
 
-from line_client import line_bot_api
 from linebot.v3.messaging import (
     TextMessage,
     TemplateMessage,
     CarouselTemplate,
     CarouselColumn,
-    PushMessageRequest,
     PostbackAction,
 )
 
+from line_push_core import dispatch_push, build_retry_key
+from cron_runs import new_run_id, update_run, incr_run, mark_shard_done, record_stage, finish_run, get_run
+from reminder_checkpoint import (
+    checkpoint_scope,
+    load_resolved,
+    save_resolved,
+    mark_group_enqueued,
+    unmark_group,
+    clear_checkpoint,
+)
+from voice_manifest import (
+    mark_manifest_ready,
+    expect_manifest_group,
+    manifest_group_done,
+    add_to_manifest,
+)
+
 # 🔹 Bookings 相關 helper
 from bookings_core import (
     get_appointment_by_id,
@@ -30,6 +46,8 @@ from zendesk_core import (
     search_zendesk_tickets_for_reminder,  # 找 pending tickets
     mark_zendesk_ticket_queued,
     get_line_user_id_from_ticket,
+    get_zendesk_users_by_ids,
+    extract_phone_from_zendesk_user,
     _get_ticket_cf_value,
 )
 
@@ -39,6 +57,10 @@ from config import (
     ZENDESK_CF_REMINDER_STATE,
     ZENDESK_CF_BOOKING_ID,
     REMINDER_DAYS_BEFORE,
+    ZENDESK_WRITE_CONCURRENCY,
+    REMINDER_SCAN_SHARDS,
+    ZENDESK_CF_REMINDER_ATTEMPTS,
+    VOICE_MANIFEST_ENABLED,
 )
 
 
@@ -78,7 +100,6 @@ from linebot.v3.messaging import (
     TemplateMessage,
     ButtonsTemplate,
     PostbackAction,
-    PushMessageRequest,
 )
 
 
@@ -166,12 +187,7 @@ def send_line_reminder(line_user_id: str, appt: dict):
 
     if not columns:
         # 真的一筆都沒組出來（理論上不會），就先只發文字
-        line_bot_api.push_message(
-            PushMessageRequest(
-                to=line_user_id,
-                messages=[text_msg],
-            )
-        )
+        dispatch_push(line_user_id, [text_msg])
         app.logger.info(
             f"[send_line_reminder] 只有文字提醒，line_user_id={line_user_id}, date={date_str}"
         )
@@ -183,22 +199,18 @@ def send_line_reminder(line_user_id: str, appt: dict):
     )
 
     # 真正發送：文字 + Carousel 一起推播
-    line_bot_api.push_message(
-        PushMessageRequest(
-            to=line_user_id,
-            messages=[text_msg, carousel_msg],
-        )
-    )
+    dispatch_push(line_user_id, [text_msg, carousel_msg])
 
     app.logger.info(
         f"[send_line_reminder] 已對 line_user_id={line_user_id} 發送 {date_str} 共 {len(columns)} 筆預約的 Carousel 提醒"
     )
 
-def send_line_reminder_with_appts(line_user_id: str, appts: list[dict]):
+def send_line_reminder_with_appts(line_user_id: str, appts: list[dict], run_id: str | None = None):
     """
     群組版推播（路線1核心）：
     - 不再去查 Bookings
     - 直接用 appts（同一個人同一天的一組）組文字 + Carousel
+    - 推播走 dispatch_push（限速 + 429 重試）；有 run_id 時 retry key 固定，job 重跑也不會重複發
     """
     if not line_user_id:
         app.logger.warning("[send_line_reminder_with_appts] 缺 line_user_id")
@@ -261,13 +273,10 @@ def send_line_reminder_with_appts(line_user_id: str, appts: list[dict]):
             )
         )
 
+    retry_key = build_retry_key(run_id, line_user_id, display_date) if run_id else None
+
     if not columns:
-        line_bot_api.push_message(
-            PushMessageRequest(
-                to=line_user_id,
-                messages=[text_msg],
-            )
-        )
+        dispatch_push(line_user_id, [text_msg], run_id=run_id, retry_key=retry_key)
         app.logger.info(
             f"[send_line_reminder_with_appts] 只有文字提醒 line_user_id={line_user_id} date={display_date}"
         )
@@ -278,12 +287,7 @@ def send_line_reminder_with_appts(line_user_id: str, appts: list[dict]):
         template=CarouselTemplate(columns=columns),
     )
 
-    line_bot_api.push_message(
-        PushMessageRequest(
-            to=line_user_id,
-            messages=[text_msg, carousel_msg],
-        )
-    )
+    dispatch_push(line_user_id, [text_msg, carousel_msg], run_id=run_id, retry_key=retry_key)
 
     app.logger.info(
         f"[send_line_reminder_with_appts] 已推播 line_user_id={line_user_id} date={display_date} count={len(columns)}"
@@ -494,11 +498,13 @@ def process_reminder_group(
     appt_date_str: str,
     days_before: int | None,
     items: list[tuple[dict, dict]],
+    run_id: str | None = None,
 ) -> int:
     """
     群組提醒（路線1）：
     - 發「一則」LINE 回診提醒（用 items 裡的 appt 組 carousel，不再重新查 Bookings）
     - 把這組裡所有 ticket 的 reminder_state 改成 queued 並寫入備註
+    - run_id：這一輪 run_reminder_check 的 id，用來累計推播統計
     """
 
     app.logger.info(f"[process_reminder_group] START job for line_user_id={line_user_id} items={len(items)}")
@@ -517,70 +523,165 @@ def process_reminder_group(
     # 1) 先推播一次（只用 items 的 appt 組 carousel）
     try:
         appts = [appt for (_, appt) in items if appt]
-        send_line_reminder_with_appts(line_user_id, appts)
+        send_line_reminder_with_appts(line_user_id, appts, run_id=run_id)
     except Exception as e:
         app.logger.error(
             f"[process_reminder_group] 推播 LINE 失敗，整組不更新（避免狀態不同步）: {e}"
         )
+        # 這組沒有 ticket 變 queued，D-1 名單本來就不用有它
+        if _manifest_enabled(days_before):
+            manifest_group_done(appt_date_str)
+        # 移出 checkpoint，同一天重跑時這組才會再被排一次
+        unmark_group(
+            checkpoint_scope(appt_date_str, days_before),
+            line_user_id,
+            [t.get("id") for (t, _) in items if t],
+        )
         return 0
 
-    # 2) 推播成功後：把整組 tickets 都 queued + note
-    processed = 0
+    # 2) 推播成功後：把整組 tickets 都 queued + note（各 ticket 並行寫入 Zendesk）
+    results = update_group_tickets_concurrently(items, days_before)
+    processed = len(results)
+    failed = [r["ticket_id"] for r in results if not (r["queued"] and r["noted"])]
+
+    # 3) D-3 這一輪順便寫 D-1 外撥名單（只放成功 queued 的 ticket，跟 D-1 掃 Zendesk 會找到的一樣）
+    #    寫不完整就把這天標成 dirty，D-1 改掃 Zendesk，不會漏撥
+    if _manifest_enabled(days_before):
+        try:
+            ok = write_voice_manifest(line_user_id, appt_date_str, items, results)
+        except Exception as e:
+            app.logger.exception(f"[process_reminder_group] 寫 D-1 外撥名單失敗 line_user_id={line_user_id}: {e}")
+            ok = False
+        manifest_group_done(appt_date_str, ok)
+
+    app.logger.info(
+        f"[process_reminder_group] 完成 line_user_id={line_user_id}, date={appt_date_str}, "
+        f"days_before={days_before}，共處理 {processed} 張 ticket，寫入未完全成功={failed}"
+    )
+    return processed
+
+
+def _manifest_enabled(days_before: int | None) -> bool:
+    # 只有正式的 D-3 提醒才建 D-1 名單（手動帶別的 days 測試時不動名單）
+    return VOICE_MANIFEST_ENABLED and (days_before is None or days_before == REMINDER_DAYS_BEFORE)
+
+
+def write_voice_manifest(
+    line_user_id: str,
+    appt_date_str: str,
+    items: list[tuple[dict, dict]],
+    results: list[dict],
+) -> bool:
+    """
+    把這組已經 queued 的 ticket 寫進 D-1 外撥名單（voice_manifest），回傳是不是每個 requester 都寫好了。
+    name / phone 這裡一次 show_many 查好，D-1 就不用再查 Zendesk；查不到的人算失敗（名單上沒有電話撥不出去）。
+    """
+    queued = {r["ticket_id"] for r in results if r.get("queued")}
+    by_requester: dict[int, list[dict]] = {}
     for ticket, appt in items:
-        ticket_id = ticket.get("id") if ticket else None
-        if not ticket_id:
+        ticket_id = ticket.get("id")
+        requester_id = ticket.get("requester_id")
+        if ticket_id not in queued or not requester_id:
+            continue
+
+        # mark_zendesk_ticket_queued 已經把 attempts + 1
+        try:
+            attempts = int(_get_ticket_cf_value(ticket, ZENDESK_CF_REMINDER_ATTEMPTS, 0) or 0) + 1
+        except (TypeError, ValueError):
+            attempts = 1
+
+        s_str = ((appt or {}).get("startDateTime") or {}).get("dateTime")
+        s_local = parse_booking_datetime_to_local(s_str) if s_str else None
+
+        by_requester.setdefault(int(requester_id), []).append(
+            {
+                "ticket_id": ticket_id,
+                "booking_id": (appt or {}).get("id") or _get_ticket_cf_value(ticket, ZENDESK_CF_BOOKING_ID),
+                "attempts": attempts,
+                "appt_time": s_local.strftime("%H:%M") if s_local else None,
+            }
+        )
+
+    if not by_requester:
+        return True
+
+    try:
+        users = get_zendesk_users_by_ids(list(by_requester))
+    except Exception as e:
+        app.logger.error(f"[write_voice_manifest] 查 requester 失敗: {e}")
+        return False
+
+    ok = True
+    for requester_id, tickets in by_requester.items():
+        user = users.get(requester_id)
+        if not user:
+            app.logger.warning(f"[write_voice_manifest] 查不到 requester_id={requester_id}，不寫名單")
+            ok = False
             continue
+        phone = extract_phone_from_zendesk_user(user)
+        if not add_to_manifest(appt_date_str, requester_id, line_user_id, user, phone, tickets):
+            ok = False
+    return ok
+
+
+def _update_one_reminder_ticket(flask_app, ticket: dict, appt: dict, days_before: int | None) -> dict:
+    """
+    單一 ticket 的 Zendesk 回寫（queued + 備註），給 thread pool 用。
+    thread 不會繼承 app context，所以要自己 push 一次。
+    """
+    ticket_id = ticket.get("id")
+    result = {"ticket_id": ticket_id, "queued": False, "noted": False}
 
+    with flask_app.app_context():
         try:
-            mark_zendesk_ticket_queued(ticket_id, ticket)
+            result["queued"] = bool(mark_zendesk_ticket_queued(ticket_id, ticket))
         except Exception as e:
             app.logger.error(
                 f"[process_reminder_group] ticket_id={ticket_id} 更新 reminder_state=queued 失敗: {e}"
             )
 
         try:
-            add_zendesk_reminder_comment(ticket_id, appt, days_before)
+            result["noted"] = bool(add_zendesk_reminder_comment(ticket_id, appt, days_before))
         except Exception as e:
             app.logger.error(
                 f"[process_reminder_group] ticket_id={ticket_id} 新增提醒備註失敗: {e}"
             )
 
-        processed += 1
-
-    app.logger.info(
-        f"[process_reminder_group] 完成 line_user_id={line_user_id}, date={appt_date_str}, "
-        f"days_before={days_before}，共處理 {processed} 張 ticket"
-    )
-    return processed
-
-
+    return result
 
 
-#好的正式版
-def run_reminder_check(days_before: int | None = None) -> int:
+def update_group_tickets_concurrently(
+    items: list[tuple[dict, dict]],
+    days_before: int | None,
+    max_workers: int | None = None,
+) -> list[dict]:
     """
-    跑一次「回呼提醒檢查」：
-    - 找出 reminder_state = pending 的 ticket
-    - 看它對應的約診是不是「還有 days_before 天」
-    - 符合條件的就發 LINE + 更新 ticket（透過 RQ queue）
-    回傳：這一輪 enqueue 了幾個「群組 job」
-
-    以前：for ticket in tickets: 裡面直接 enqueue("...send_line_reminder_and_log", ticket, appt, days_before)
-    現在：
-    先把同一個 (line_user_id, appt_date_str, days_before) 的 ticket 放進同一組 items
-    每組只 enqueue 一次，丟到 process_reminder_group
+    把一組 (ticket, appt) 的 Zendesk 寫入丟進有上限的 thread pool 同時跑。
+    回傳每張 ticket 的結果：[{"ticket_id": 1140, "queued": True, "noted": True}, ...]
+    （順序跟 items 一致）
     """
-    if days_before is None:
-        days_before = REMINDER_DAYS_BEFORE
+    work = [(ticket, appt) for (ticket, appt) in items if ticket and ticket.get("id")]
+    if not work:
+        return []
 
-    today = datetime.now().date()
-    target_date = today + timedelta(days=days_before)
+    workers = max(1, min(max_workers or ZENDESK_WRITE_CONCURRENCY, len(work)))
+    flask_app = app._get_current_object()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(_update_one_reminder_ticket, flask_app, ticket, appt, days_before)
+            for (ticket, appt) in work
+        ]
+        return [f.result() for f in futures]
 
-    tickets = search_zendesk_tickets_for_reminder()
 
-    # key: (line_user_id, appt_date_str, days_before) -> list[(ticket, appt)]
-    groups: dict[tuple[str, str, int | None], list[tuple[dict, dict]]] = {}
 
+
+def _filter_reminder_candidates(tickets: list[dict], target_date) -> list[dict]:
+    """
+    只做本地判斷（不打 API）：reminder_state = pending 且看診日 = target_date 的 ticket。
+    """
+    candidates: list[dict] = []
     for ticket in tickets:
         ticket_id = ticket.get("id")
 
@@ -591,7 +692,6 @@ def run_reminder_check(days_before: int | None = None) -> int:
             )
             continue
 
-        # 1. 先看日期是否是這一輪要處理的 target_date
         appt_date_str = _get_ticket_cf_value(ticket, ZENDESK_CF_APPOINTMENT_DATE)
         if not appt_date_str:
             continue
@@ -604,14 +704,57 @@ def run_reminder_check(days_before: int | None = None) -> int:
         if appt_date != target_date:
             continue
 
-        # 2. 找對應的 Bookings appointment
+        candidates.append(ticket)
+    return candidates
+
+
+def _resolve_reminder_groups(
+    tickets: list[dict],
+    days_before: int | None,
+    scope: str | None = None,
+    shard: int | None = None,
+) -> tuple[dict[tuple[str, str, int | None], list[tuple[dict, dict]]], int, int]:
+    """
+    對候選 ticket 查 Bookings appointment + line_user_id，依 (line_user_id, 日期, days_before) 分組。
+    有 scope 時走 checkpoint：已查過的 ticket 直接用 Redis 裡的結果，新查到的馬上寫回，
+    process 中途掛掉重跑只需要查剩下的。
+    回傳 (groups, errors, resumed)
+    """
+    # key: (line_user_id, appt_date_str, days_before) -> list[(ticket, appt)]
+    groups: dict[tuple[str, str, int | None], list[tuple[dict, dict]]] = {}
+    errors = 0
+
+    # 依 ticket id 由小到大處理（log 比較好對）
+    tickets = sorted(tickets, key=lambda t: int(t.get("id") or 0))
+    cached = load_resolved(scope, [int(t.get("id")) for t in tickets if t.get("id")]) if scope else {}
+    resumed = 0
+
+    for ticket in tickets:
+        ticket_id = ticket.get("id")
+        appt_date_str = _get_ticket_cf_value(ticket, ZENDESK_CF_APPOINTMENT_DATE)
+
+        hit = cached.get(int(ticket_id)) if ticket_id else None
+        if hit and hit.get("line_user_id") and hit.get("appt"):
+            key = (hit["line_user_id"], appt_date_str, days_before)
+            groups.setdefault(key, []).append((ticket, hit["appt"]))
+            resumed += 1
+            continue
+
+        # 找對應的 Bookings appointment
         booking_id = _get_ticket_cf_value(ticket, ZENDESK_CF_BOOKING_ID)
-        appt, local_start = get_appointment_by_id(booking_id)
+        try:
+            appt, local_start = get_appointment_by_id(booking_id)
+        except Exception as e:
+            # 單張查詢失敗不要讓整輪掛掉（也不寫 checkpoint，重跑時會再查一次）
+            app.logger.error(f"[run_reminder_check] ticket_id={ticket_id} 取得 appointment 失敗: {e}")
+            errors += 1
+            continue
         if not appt or not local_start:
             continue
 
-        # 3. 找 line_user_id（這個是之後分組的 key）
+        # 找 line_user_id（這個是之後分組的 key）
         line_user_id = get_line_user_id_from_ticket(ticket, appt)
+        save_resolved(scope, ticket_id, line_user_id, appt)
         if not line_user_id:
             app.logger.warning(
                 f"[run_reminder_check] ticket_id={ticket_id} 找不到 line_user_id，略過"
@@ -621,29 +764,274 @@ def run_reminder_check(days_before: int | None = None) -> int:
         key = (line_user_id, appt_date_str, days_before)
         groups.setdefault(key, []).append((ticket, appt))
 
-    # 4. 每一組 (line_user_id, date, days_before) enqueue 一個 group job
+    if resumed:
+        app.logger.info(
+            f"[run_reminder_check] checkpoint scope={scope} shard={shard} 沿用 {resumed} 張已查過的 ticket"
+        )
+    return groups, errors, resumed
+
+
+def _enqueue_reminder_groups(
+    groups: dict[tuple[str, str, int | None], list[tuple[dict, dict]]],
+    run_id: str,
+    tracked: bool = True,
+    scope: str | None = None,
+) -> int:
+    """
+    每一組 (line_user_id, date, days_before) enqueue 一個 process_reminder_group job。
+    有 scope 時，已經 enqueue 過的 group（checkpoint groups）直接略過。
+    """
     processed_groups = 0
 
     for (line_user_id, appt_date_str, days), items in groups.items():
         if not items:
             continue
 
-        job = reminder_queue.enqueue(
-            "flows_reminders.process_reminder_group",  # 新增的 group handler
-            line_user_id,
-            appt_date_str,
-            days,
-            items,  # list[(ticket, appt)]，RQ 會用 pickle 存
-        )
+        ticket_ids = [t.get("id") for (t, _) in items if t]
+        if not mark_group_enqueued(scope, line_user_id, ticket_ids):
+            app.logger.info(
+                f"[run_reminder_check] checkpoint：line_user_id={line_user_id} date={appt_date_str} 已 enqueue 過，略過"
+            )
+            # 跟新排入的分開計，看 run 狀態時才分得出哪些是續跑略過的
+            if tracked:
+                incr_run(run_id, "groups_skipped_checkpoint")
+            continue
+
+        # D-1 名單：這個 job 寫完名單前，D-1 不會只讀名單
+        manifest = _manifest_enabled(days)
+        if manifest:
+            expect_manifest_group(appt_date_str)
+        try:
+            job = reminder_queue.enqueue(
+                "flows_reminders.process_reminder_group",  # 新增的 group handler
+                line_user_id,
+                appt_date_str,
+                days,
+                items,  # list[(ticket, appt)]，RQ 會用 pickle 存
+                run_id,
+            )
+        except Exception:
+            unmark_group(scope, line_user_id, ticket_ids)
+            if manifest:
+                manifest_group_done(appt_date_str)
+            raise
         app.logger.info(
-            f"[run_reminder_check] 已 enqueue group job_id={job.id} "
+            f"[run_reminder_check] 已 enqueue group job_id={job.id} run_id={run_id} "
             f"line_user_id={line_user_id} appointment_date={appt_date_str} "
             f"tickets_count={len(items)}"
         )
         processed_groups += 1
+        if tracked:
+            incr_run(run_id, "groups_enqueued")
+
+    return processed_groups
+
+
+def _shard_of(ticket: dict, shards: int) -> int:
+    """
+    依 requester_id 決定 shard（同一個病患的 ticket 一定落在同一個 shard，分組才不會被拆開）。
+    用 crc32 而不是 hash()，避免不同 process 的 hash seed 不同。
+    """
+    key = str(ticket.get("requester_id") or ticket.get("id") or "")
+    return zlib.crc32(key.encode("utf-8")) % shards
+
+
+def split_reminder_shards(tickets: list[dict], shards: int) -> list[tuple[int, list[dict]]]:
+    """
+    回傳 [(shard_index, tickets), ...]，只留有 ticket 的 shard。
+    shard_index 固定對應 crc32 % shards（同一個 requester 每次都落在同一個 shard）。
+    """
+    shards = max(1, shards)
+    buckets: list[list[dict]] = [[] for _ in range(shards)]
+    for ticket in tickets:
+        buckets[_shard_of(ticket, shards)].append(ticket)
+    return [(idx, b) for idx, b in enumerate(buckets) if b]
+
+
+#好的正式版
+def run_reminder_check(days_before: int | None = None, run_id: str | None = None) -> int:
+    """
+    跑一次「回呼提醒檢查」（單一 process 同步版，手動測試 / test_run_reminder.py 用）：
+    - 找出 reminder_state = pending 的 ticket
+    - 看它對應的約診是不是「還有 days_before 天」
+    - 符合條件的就發 LINE + 更新 ticket（透過 RQ queue）
+    回傳：這一輪 enqueue 了幾個「群組 job」
+
+    以前：for ticket in tickets: 裡面直接 enqueue("...send_line_reminder_and_log", ticket, appt, days_before)
+    現在：
+    先把同一個 (line_user_id, appt_date_str, days_before) 的 ticket 放進同一組 items
+    每組只 enqueue 一次，丟到 process_reminder_group
+
+    正式排程走 run_reminder_scan_job（分 shard 平行跑）。
+    """
+    if days_before is None:
+        days_before = REMINDER_DAYS_BEFORE
+
+    today = datetime.now().date()
+    target_date = today + timedelta(days=days_before)
+
+    # 這一輪的 id：推播統計（sent / retried / failed）用這個 key 累計
+    tracked = bool(run_id)
+    run_id = run_id or new_run_id()
+    app.logger.info(f"[run_reminder_check] run_id={run_id} target_date={target_date}")
+
+    stage_started = time.time()
+    tickets = search_zendesk_tickets_for_reminder()
+    candidates = _filter_reminder_candidates(tickets, target_date)
+    if tracked:
+        update_run(run_id, tickets_scanned=len(tickets), candidates=len(candidates))
+        record_stage(run_id, "search", stage_started)
+
+    scope = checkpoint_scope(target_date.strftime("%Y-%m-%d"), days_before)
+
+    stage_started = time.time()
+    groups, errors, resumed = _resolve_reminder_groups(candidates, days_before, scope=scope)
+    if tracked:
+        update_run(run_id, groups_found=len(groups), errors=errors, tickets_resumed=resumed)
+        record_stage(run_id, "resolve", stage_started)
+
+    stage_started = time.time()
+    processed_groups = _enqueue_reminder_groups(groups, run_id, tracked=tracked, scope=scope)
+    if tracked:
+        record_stage(run_id, "enqueue", stage_started)
+
+    # 整輪沒有錯誤：checkpoint 用不到了，下一輪重新查（新約的診、剛綁定 LINE 的都會進來）
+    # D-1 外撥名單也到這裡才算建好（中途失敗就不設，D-1 會改掃 Zendesk）
+    if not errors:
+        clear_checkpoint(scope)
+        if _manifest_enabled(days_before):
+            mark_manifest_ready(target_date.strftime("%Y-%m-%d"))
+
+    return processed_groups
+
+
+def run_reminder_scan_job(run_id: str, days_before: int | None = None) -> int:
+    """
+    RQ job（協調者）：/cron/run-reminder 只負責 enqueue 這個 job。
+    - 這裡只做一次 Zendesk search + 本地篩選（便宜）
+    - 候選 ticket 依 requester_id 分成 REMINDER_SCAN_SHARDS 份，每份 enqueue 一個 process_reminder_shard
+    - 最耗時的「查 appointment / 查 user」由各 shard 在不同 worker 平行跑
+    - 最後一個完成的 shard 負責彙總、finish_run 並釋放鎖
+    回傳：enqueue 了幾個 shard job
+    """
+    if days_before is None:
+        days_before = REMINDER_DAYS_BEFORE
+
+    update_run(run_id, status="running", started_at=time.time())
+    try:
+        target_date = datetime.now().date() + timedelta(days=days_before)
+        if _manifest_enabled(days_before):
+            # 最後一個 shard 成功跑完時用這個日期標記 D-1 名單已建好
+            update_run(run_id, manifest_date=target_date.strftime("%Y-%m-%d"))
+
+        stage_started = time.time()
+        tickets = search_zendesk_tickets_for_reminder()
+        candidates = _filter_reminder_candidates(tickets, target_date)
+        # shard 可能過了午夜才跑：scope 由這裡算好傳下去，不讓 shard 自己用 now() 重算
+        scope = checkpoint_scope(target_date.strftime("%Y-%m-%d"), days_before)
+        update_run(
+            run_id,
+            tickets_scanned=len(tickets),
+            candidates=len(candidates),
+            checkpoint=scope,
+        )
+        record_stage(run_id, "search", stage_started)
+
+        shards = split_reminder_shards(candidates, REMINDER_SCAN_SHARDS)
+        if not shards:
+            if _manifest_enabled(days_before):
+                mark_manifest_ready(target_date.strftime("%Y-%m-%d"))
+            finish_run(run_id, status="done", result={"processed": 0, "shards": 0})
+            return 0
+
+        update_run(run_id, shards_total=len(shards), shards_done=0)
+        for idx, shard_tickets in shards:
+            job = reminder_queue.enqueue(
+                "flows_reminders.process_reminder_shard",
+                run_id,
+                idx,
+                days_before,
+                shard_tickets,
+                scope,
+            )
+            app.logger.info(
+                f"[run_reminder_scan_job] run_id={run_id} 已 enqueue shard={idx} "
+                f"job_id={job.id} tickets={len(shard_tickets)}"
+            )
+    except Exception as e:
+        app.logger.exception(f"[run_reminder_scan_job] run_id={run_id} 失敗: {e}")
+        finish_run(run_id, status="failed", error=str(e))
+        raise
+
+    return len(shards)
+
+
+def process_reminder_shard(
+    run_id: str,
+    shard_index: int,
+    days_before: int | None,
+    tickets: list[dict],
+    scope: str | None = None,
+) -> int:
+    """
+    RQ job（單一 shard）：查這批 ticket 的 appointment / line_user_id、分組、enqueue group job。
+    scope：協調者算好的 checkpoint scope（跟協調者同一個約診日，就算 shard 過了午夜才跑）。
+    計數用 HINCRBY 直接累加到 run 上；最後一個 shard 做彙總。
+    """
+    stage_started = time.time()
+    processed_groups = 0
+    try:
+        if days_before is None:
+            days_before = REMINDER_DAYS_BEFORE
+        if not scope:
+            scope = (get_run(run_id) or {}).get("checkpoint")
+
+        groups, errors, resumed = _resolve_reminder_groups(tickets, days_before, scope=scope, shard=shard_index)
+        incr_run(run_id, "groups_found", len(groups))
+        incr_run(run_id, "errors", errors)
+        incr_run(run_id, "tickets_resumed", resumed)
+        processed_groups = _enqueue_reminder_groups(groups, run_id, scope=scope)
+    except Exception as e:
+        app.logger.exception(f"[process_reminder_shard] run_id={run_id} shard={shard_index} 失敗: {e}")
+        incr_run(run_id, "errors")
+        incr_run(run_id, "shards_failed")
+    finally:
+        record_stage(run_id, f"shard{shard_index}", stage_started)
+        _finish_shard(run_id, shard_index)
 
     return processed_groups
 
+
+def _finish_shard(run_id: str, shard_index: int) -> None:
+    """
+    記下這個 shard 完成；如果是最後一個，彙總整輪結果並結束 run。
+    用 shard 編號的 set 計數：同一個 shard job 重試 / 跑兩次不會多算，也不會讓 run 提早結束或結束兩次。
+    """
+    first, done = mark_shard_done(run_id, shard_index)
+    run = get_run(run_id) or {}
+    total = int(run.get("shards_total") or 0)
+    if not first or not total or done < total:
+        return
+
+    status = "done" if not run.get("shards_failed") else "partial"
+    # 整輪沒有錯誤才清 checkpoint；partial / 有查詢失敗時留著，下一輪從這裡續跑
+    if status == "done" and not int(run.get("errors") or 0):
+        clear_checkpoint(run.get("checkpoint"))
+        if run.get("manifest_date"):
+            mark_manifest_ready(run["manifest_date"])
+    finish_run(
+        run_id,
+        status=status,
+        result={
+            "processed": int(run.get("groups_enqueued") or 0),
+            "shards": total,
+            "shards_failed": int(run.get("shards_failed") or 0),
+            "errors": int(run.get("errors") or 0),
+            "groups_skipped_checkpoint": int(run.get("groups_skipped_checkpoint") or 0),
+        },
+    )
+    app.logger.info(f"[run_reminder_scan_job] run_id={run_id} 全部 shard 完成 status={status}")
+
     
 # 舊版會洗line訊息的run reminder check    
 # def run_reminder_check(days_before: int | None = None) -> int:
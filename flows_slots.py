@@ -20,6 +20,7 @@ from line_client import line_bot_api
 from bookings_core import (
     get_available_slots_for_date,
 )
+from availability_cache import get_available_slots_cached
 
 from config import (
     WEEKDAY_ZH,
@@ -50,15 +51,11 @@ def get_week_offset_for_date(target_date: "date") -> int | None:
         return offset
     return None
 
-def show_dates_for_week(offset: int, event: MessageEvent):
+def get_week_candidate_dates(offset: int) -> list["date"]:
     """
-    根據 offset 顯示某一週可預約的日期 Carousel。
-    offset = 0: 本週
-    offset = 1: 下週
-    offset = 2: 兩週後
-    offset = 3: 三週後（目前上限）
+    某一週要列出來的日期（週一～週六；本週從明天開始）。
+    show_dates_for_week 跟預先查時段（booking_prefetch）共用。
     """
-
     today = datetime.now()
     weekday = today.weekday()  # 0=週一 ... 6=週日
     monday = today - timedelta(days=weekday)  # 本週一
@@ -81,13 +78,26 @@ def show_dates_for_week(offset: int, event: MessageEvent):
     while cur.date() <= week_end.date():
         candidate_dates.append(cur.date())
         cur += timedelta(days=1)
+    return candidate_dates
+
+
+def show_dates_for_week(offset: int, event: MessageEvent):
+    """
+    根據 offset 顯示某一週可預約的日期 Carousel。
+    offset = 0: 本週
+    offset = 1: 下週
+    offset = 2: 兩週後
+    offset = 3: 三週後（目前上限）
+    每天的時段先看快取（「線上約診」時通常已經預先查好）。
+    """
+    candidate_dates = get_week_candidate_dates(offset)
 
     columns = []
 
     # --- 每個日期，如果有可預約時段，就變成一個 column ---
     for d in candidate_dates:
         date_str = d.isoformat()  # YYYY-MM-DD
-        available_slots = get_available_slots_for_date(date_str)
+        available_slots = get_available_slots_cached(date_str)
         if not available_slots:
             continue  # 沒有任何時段就略過
 
@@ -1,5 +1,6 @@
 # flows_voice_calls.py
 import os
+import time
 import requests
 from flask import current_app as app  # 不要 import app.py
 import base64
@@ -10,10 +11,14 @@ from zendesk_core import (
     get_zendesk_ticket_by_id,
     get_zendesk_user_by_id,
     extract_phone_from_zendesk_user,
-    mark_zendesk_ticket_queued,
+    mark_zendesk_tickets_queued,
+    get_zendesk_tickets_by_ids,
     mark_zendesk_ticket_voice_attempted,
     _get_ticket_cf_value, #demo zendesk 串copilot
 )
+from voice_dialer import mark_call_started, release_call
+from voice_retry import schedule_retry
+from voice_outcomes import record_dial
 
 from config import (
     PROFILE_STATUS_EMPTY,
@@ -167,48 +172,96 @@ def process_voice_call_task(task: dict):
 
 
 
-def process_voice_call_group(line_user_id: str, appt_date_str: str, ticket_ids: list[int]):
+def _extract_call_id(data) -> str | None:
+    # dialout 回應裡的通話 ID（跟 webhook 找 call_id 的欄位一樣）
+    if not isinstance(data, dict):
+        return None
+    call_id = (
+        data.get("callId")
+        or data.get("call_id")
+        or data.get("sessionId")
+        or data.get("conversationId")
+        or data.get("id")
+    )
+    return str(call_id) if call_id else None
+
+
+def dial_voice_call_group(line_user_id: str, appt_date_str: str, ticket_ids: list[int], dial_target: dict | None = None):
+    """
+    voice_dialer 佔好 slot 後排的 job：撥一通，LiveHub 接受就把 slot 換成 call_id（等 webhook 結束才釋放），
+    沒撥出去就馬上釋放 slot 讓下一組補上。
+    """
+    call_id = None
+    dialed = False
+    try:
+        dialed, call_id = process_voice_call_group(line_user_id, appt_date_str, ticket_ids, dial_target)
+    finally:
+        if dialed:
+            mark_call_started(ticket_ids, call_id)
+        else:
+            release_call(ticket_ids=ticket_ids)
+
+
+def resolve_dial_target(ticket_ids: list[int]) -> dict | None:
+    """
+    job 沒帶撥號對象時（例如重撥）才用：一次 show_many 拿整組 ticket，再用第一張的 requester 找 name/phone。
+    回傳格式跟 scheduler 帶進來的一樣：{"patient_name", "phone", "requester_id", "ticket_attempts"}
+    """
+    tickets = get_zendesk_tickets_by_ids(ticket_ids)
+    first = tickets.get(int(ticket_ids[0])) if ticket_ids else None
+    if not first:
+        app.logger.error(f"[VOICE GROUP] 取不到 ticket: {ticket_ids[:1]}")
+        return None
+
+    requester_id = first.get("requester_id")
+    if not requester_id:
+        app.logger.error(f"[VOICE GROUP] ticket_id={first.get('id')} 缺 requester_id")
+        return None
+
+    user = get_zendesk_user_by_id(int(requester_id))
+    return {
+        "patient_name": (user or {}).get("name") or "貴賓",
+        "phone": extract_phone_from_zendesk_user(user),
+        "requester_id": int(requester_id),
+        "ticket_attempts": {
+            str(tid): _get_ticket_cf_value(t, ZENDESK_CF_REMINDER_ATTEMPTS, 0) or 0 for tid, t in tickets.items()
+        },
+    }
+
+
+def process_voice_call_group(line_user_id: str, appt_date_str: str, ticket_ids: list[int], dial_target: dict | None = None):
     """
     群組外撥（正式版 v1）：
     - 同一個人同一天：只打一通
     - metadata 帶 ticketIds，讓 webhook 回來可以更新整組
     - Zendesk 更新（attempts/date/note）留給 webhook 處理
+    dial_target：scheduler 掃描時已經批次查好的 name / phone / attempts，有帶就不用再查 Zendesk
+    回傳 (有沒有撥出去, LiveHub 給的 call_id)
     """
     if not LIVEHUB_BOT_ID or not LIVEHUB_NOTIFY_URL:
         app.logger.error("[VOICE GROUP] 缺 bot ID 或 notifyUrl")
-        return
+        return False, None
 
     if not ticket_ids:
         app.logger.warning("[VOICE GROUP] ticket_ids 為空，略過")
-        return
-    # 0) 外撥前先鎖票（queued）避免重複撥打
-    # 這裡會 attempts + 1（因為你的 mark_zendesk_ticket_queued 就是這樣設計）
-    for tid in ticket_ids:
-        if not tid:
-            continue
-        try:
-            # 用第一張 ticket 的資料可以算 attempts，但你這裡為了最小改動就不帶 ticket
-            mark_zendesk_ticket_queued(ticket_id=int(tid), ticket=None)
-        except Exception as e:
-            app.logger.error(f"[VOICE GROUP] lock queued failed tid={tid}: {e}")
-
-
-    # 1) 用第一張 ticket 找 requester → phone/name
-    first_ticket_id = int(ticket_ids[0])
-    ticket = get_zendesk_ticket_by_id(first_ticket_id)
-    if not ticket:
-        app.logger.error(f"[VOICE GROUP] 取不到 ticket: {first_ticket_id}")
-        return
+        return False, None
 
-    requester_id = ticket.get("requester_id")
-    if not requester_id:
-        app.logger.error(f"[VOICE GROUP] ticket_id={first_ticket_id} 缺 requester_id")
-        return
+    # 1) 撥號對象：scheduler 帶進來的優先，沒有才查 Zendesk
+    dial_target = dial_target or resolve_dial_target(ticket_ids)
+    if not dial_target:
+        return False, None
+
+    # 0) 外撥前先鎖票（queued）避免重複撥打：整組一次 update_many，attempts 各自 + 1
+    ticket_attempts = dial_target.get("ticket_attempts") or {str(tid): 0 for tid in ticket_ids}
+    try:
+        mark_zendesk_tickets_queued({int(tid): int(n or 0) for tid, n in ticket_attempts.items()})
+    except Exception as e:
+        app.logger.error(f"[VOICE GROUP] lock queued failed ticket_ids={ticket_ids}: {e}")
+
+    requester_id = dial_target.get("requester_id")
+    patient_name = dial_target.get("patient_name") or "貴賓"
+    phone = dial_target.get("phone")
 
-    user = get_zendesk_user_by_id(int(requester_id))
-    patient_name = (user or {}).get("name") or "貴賓"
-    phone = extract_phone_from_zendesk_user(user)
-    
     # ✅ 測試模式：強制覆蓋電話（避免用假資料）
     if VOICE_DEMO_MODE and VOICE_TEST_PHONE:
         app.logger.warning(
@@ -222,7 +275,7 @@ def process_voice_call_group(line_user_id: str, appt_date_str: str, ticket_ids:
         app.logger.error(
             f"[VOICE GROUP] requester_id={requester_id} 找不到 phone，無法外撥 ticket_ids={ticket_ids}"
         )
-        return
+        return False, None
     app.logger.warning("[VOICE GROUP] final phone=%r target=%r", phone, f"tel:{phone}")
 
 
@@ -265,6 +318,7 @@ def process_voice_call_group(line_user_id: str, appt_date_str: str, ticket_ids:
         json.dumps(payload, ensure_ascii=False)
     )
 
+    requested_at = time.time()
     try:
         resp = requests.post(url, json=payload, headers=headers, timeout=10)
         app.logger.warning("[VOICE GROUP] LiveHub status=%s body=%s", resp.status_code, (resp.text or "")[:300])
@@ -273,6 +327,7 @@ def process_voice_call_group(line_user_id: str, appt_date_str: str, ticket_ids:
         app.logger.info(f"[VOICE GROUP] LiveHub response={data}")
     except Exception as e:
         app.logger.error(f"[VOICE GROUP] dialout 失敗: {e}")
+        record_dial(None, ticket_ids, appt_date_str, requested_at, (time.time() - requested_at) * 1000.0, ok=False)
 
         # dialout 失敗也要回寫 Zendesk（避免隔天重跑一直打）
         today_str = datetime.now().strftime("%Y-%m-%d")
@@ -288,8 +343,16 @@ def process_voice_call_group(line_user_id: str, appt_date_str: str, ticket_ids:
                 )
             except Exception as ee:
                 app.logger.error(f"[VOICE GROUP] update failed tid={tid}: {ee}")
-        return
-    
+
+        # LiveHub 沒接受這通 → 依 backoff 排重撥
+        schedule_retry(line_user_id, appt_date_str, ticket_ids, reason="dialout_failed")
+        return False, None
+
+    call_id = _extract_call_id(data)
+    record_dial(call_id, ticket_ids, appt_date_str, requested_at, (time.time() - requested_at) * 1000.0, ok=True)
+    return True, call_id
+
+
 #demo zendesk串到copilot
 def process_voice_call_demo_from_zendesk(line_user_id: str, appt_date_str: str, ticket_ids: list[int]):
     """
@@ -1,40 +1,52 @@
 # flows_voice_scheduler.py
+import time
 from datetime import datetime, timedelta
 from collections import defaultdict
 from flask import current_app as app
 
 from zendesk_core import (
     search_zendesk_tickets_for_voice_reminder,
+    get_zendesk_users_by_ids,
+    extract_phone_from_zendesk_user,
     _get_ticket_cf_value,
     ZENDESK_CF_APPOINTMENT_DATE,
+    ZENDESK_CF_APPOINTMENT_TIME,
 )
 
 from config import (
     ZENDESK_REMINDER_STATE_QUEUED,
+    ZENDESK_CF_REMINDER_ATTEMPTS,
+    VOICE_MANIFEST_ENABLED,
 )
 
-from queue_core import voice_call_queue
+from voice_dialer import submit_dial, pump_dialer
+from voice_manifest import manifest_ready, iter_manifest
+from cron_runs import update_run, incr_run, record_stage, finish_run
 
 
-def build_voice_groups_and_enqueue(days: int = 1) -> dict:
+def _collect_groups_from_zendesk(target_date: str, run_id: str | None) -> tuple[list[dict], int]:
     """
-    真實版 D1：
-    1) 撈 Zendesk pending tickets
-    2) 篩出 appointment_date = 今天 + days
-    3) 依 (requester_id, appointment_date) 分組
-    4) 每組 enqueue 一通 voice job（process_voice_call_group_from_zendesk）
+    舊路線（沒有 D-1 名單時）：撈 Zendesk queued tickets → 篩約診日 → 依 (requester_id, appointment_date) 分組
+    → requester 一次 show_many 查好 name / phone。
+    回傳 (groups, 掃到幾張 ticket)
     """
-    target_date = (datetime.now().date() + timedelta(days=days)).strftime("%Y-%m-%d")
-    app.logger.info("[VOICE CRON] target_date=%s (days=%s)", target_date, days)
-
+    stage_started = time.time()
     tickets = search_zendesk_tickets_for_voice_reminder(
         state=ZENDESK_REMINDER_STATE_QUEUED
     ) or []
+    update_run(run_id, tickets_scanned=len(tickets))
+    record_stage(run_id, "search", stage_started)
 
     app.logger.info("[VOICE CRON] pending candidates=%s", len(tickets))
 
+    stage_started = time.time()
+
     # key = (requester_id, appointment_date) → value = [ticket_id...]
     groups = defaultdict(list)
+    # ticket_id → 目前的 reminder_attempts（外撥前鎖票用，不用再 GET ticket）
+    ticket_attempts = {}
+    # 每組最早的約診時間（HH:MM），決定撥號優先順序
+    group_first_time = {}
 
     for t in tickets:
         tid = t.get("id")
@@ -51,42 +63,137 @@ def build_voice_groups_and_enqueue(days: int = 1) -> dict:
             continue
 
         groups[(int(requester_id), appt_date)].append(int(tid))
+        appt_time = str(_get_ticket_cf_value(t, ZENDESK_CF_APPOINTMENT_TIME, "") or "").strip()
+        if appt_time:
+            key = (int(requester_id), appt_date)
+            group_first_time[key] = min(group_first_time.get(key, appt_time), appt_time)
+        try:
+            ticket_attempts[int(tid)] = int(_get_ticket_cf_value(t, ZENDESK_CF_REMINDER_ATTEMPTS, 0) or 0)
+        except (TypeError, ValueError):
+            ticket_attempts[int(tid)] = 0
 
     app.logger.info("[VOICE CRON] groups_to_call=%s", len(groups))
+    update_run(run_id, groups_found=len(groups))
+    record_stage(run_id, "group", stage_started)
+    stage_started = time.time()
+
+    # 所有 requester 一次 show_many 查好 name / phone，voice job 就不用各自再查
+    users = get_zendesk_users_by_ids([rid for rid, _ in groups])
+    record_stage(run_id, "resolve", stage_started)
+
+    out = []
+    for (requester_id, appt_date), ticket_ids in groups.items():
+        user = users.get(requester_id)
+        dial_target = None
+        if user:
+            dial_target = {
+                "patient_name": user.get("name") or "貴賓",
+                "phone": extract_phone_from_zendesk_user(user),
+                "requester_id": requester_id,
+                "ticket_attempts": {str(tid): ticket_attempts.get(tid, 0) for tid in ticket_ids},
+            }
+        out.append(
+            {
+                "requester_id": requester_id,
+                # line_user_id 這階段先不用依賴它；給 placeholder 即可
+                "line_user_id": "U_auto",
+                "appt_date": appt_date,
+                "appt_time": group_first_time.get((requester_id, appt_date)),
+                "ticket_ids": ticket_ids,
+                "dial_target": dial_target,
+            }
+        )
+    return out, len(tickets)
+
+
+def build_voice_groups_and_enqueue(days: int = 1, run_id: str | None = None, source: str = "auto") -> dict:
+    """
+    真實版 D1：
+    - source="auto"：D-3 提醒整輪成功、每個 group 也都寫完這天的外撥名單（voice_manifest）時，直接串流讀名單，
+      確認 / 取消的人已經被拿掉，不用掃 Zendesk；名單不完整（掃描失敗 / job 掛掉 / 寫入失敗）就退回掃 Zendesk
+    - source="zendesk"：強制掃 Zendesk（名單壞掉 / D-3 沒跑時手動補）
+    每組排進 voice_dialer，由它控制同時通話數跟撥號時段。
 
+    run_id：由 /cron/run-voice-reminder 帶進來時，進度會寫到 cron_runs。
+    """
+    target_date = (datetime.now().date() + timedelta(days=days)).strftime("%Y-%m-%d")
+    use_manifest = source != "zendesk" and VOICE_MANIFEST_ENABLED and manifest_ready(target_date)
+    app.logger.info(
+        "[VOICE CRON] target_date=%s (days=%s) run_id=%s source=%s",
+        target_date, days, run_id, "manifest" if use_manifest else "zendesk",
+    )
+    update_run(run_id, source="manifest" if use_manifest else "zendesk")
+
+    scanned = 0
+    if use_manifest:
+        groups = iter_manifest(target_date)
+    else:
+        groups, scanned = _collect_groups_from_zendesk(target_date, run_id)
+
+    stage_started = time.time()
     enqueued = 0
     details = []
 
-    for (requester_id, appt_date), ticket_ids in groups.items():
-        # line_user_id 這階段先不用依賴它；給 placeholder 即可
-        line_user_id = "U_auto"
+    for g in groups:
+        ticket_ids = g["ticket_ids"]
+        attempts = (g["dial_target"] or {}).get("ticket_attempts") or {}
 
-        job = voice_call_queue.enqueue(
-            "flows_voice_calls.process_voice_call_group",
-            line_user_id,
-            appt_date,
+        # 不直接丟 voice queue：排進 voice_dialer，由它控制同時通話數跟撥號時段
+        submit_dial(
+            g["line_user_id"],
+            g["appt_date"],
             ticket_ids,
+            g["dial_target"],
+            appt_time=g["appt_time"],
+            attempts=max((int(v) for v in attempts.values()), default=0),
         )
 
         enqueued += 1
-        details.append(
-            {
-                "requester_id": requester_id,
-                "appointment_date": appt_date,
-                "ticket_ids": ticket_ids,
-                "job_id": job.id,
-            }
-        )
+        incr_run(run_id, "groups_enqueued")
+        if len(details) < 20:  # 避免回太長
+            details.append(
+                {
+                    "requester_id": g["requester_id"],
+                    "appointment_date": g["appt_date"],
+                    "ticket_ids": ticket_ids,
+                }
+            )
 
         app.logger.info(
-            "[VOICE CRON] enqueued job_id=%s requester_id=%s date=%s tickets=%s",
-            job.id, requester_id, appt_date, ticket_ids
+            "[VOICE CRON] queued for dialer requester_id=%s date=%s tickets=%s",
+            g["requester_id"], g["appt_date"], ticket_ids
         )
 
+    if use_manifest:
+        update_run(run_id, groups_found=enqueued)
+    record_stage(run_id, "enqueue", stage_started)
+
+    # 有空 slot 就先開始撥，其餘等通話結束 / cron pump 再補
+    dial_started = pump_dialer()
+    update_run(run_id, dial_started=dial_started)
+
     return {
         "target_date": target_date,
-        "pending_candidates": len(tickets),
-        "groups": len(groups),
+        "source": "manifest" if use_manifest else "zendesk",
+        "pending_candidates": scanned,
+        "groups": enqueued,
         "enqueued": enqueued,
-        "details": details[:20],  # 避免回太長
+        "dial_started": dial_started,
+        "details": details,
     }
+
+
+def run_voice_scan_job(run_id: str, days: int = 1, source: str = "auto") -> dict:
+    """
+    RQ job：/cron/run-voice-reminder 只負責 enqueue 這個 job，掃描在 voice worker 裡跑。
+    """
+    update_run(run_id, status="running", started_at=time.time())
+    try:
+        result = build_voice_groups_and_enqueue(days=days, run_id=run_id, source=source)
+    except Exception as e:
+        app.logger.exception("[VOICE CRON] run_id=%s failed: %s", run_id, e)
+        finish_run(run_id, status="failed", error=str(e))
+        raise
+
+    finish_run(run_id, status="done", result=result)
+    return result
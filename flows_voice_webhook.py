@@ -1,15 +1,60 @@
 # flows_voice_webhook.py
-from datetime import datetime
+import json
+import time
+from datetime import datetime, timedelta
 from flask import current_app as app
 from zendesk_core import (
-    mark_zendesk_ticket_voice_attempted,
     mark_zendesk_ticket_voice_succeeded,
     mark_zendesk_ticket_voice_failed,
+    mark_zendesk_tickets_voice_attempted,
 )
+from queue_core import redis_conn, voice_call_queue
+from config import VOICE_CALL_STALE_SEC, VOICE_WEBHOOK_SETTLE_SEC
 
 from utils import(
     parse_ticket_ids
 )
+from voice_dialer import release_call
+from voice_retry import schedule_retry
+from voice_outcomes import record_status, record_final
+
+# 這些狀態代表通話已經結束，voice_dialer 的 slot 可以釋放給下一通
+_TERMINAL_STATUSES = {
+    "success", "completed", "ok",
+    "no_answer", "noanswer", "busy", "failed", "error", "rejected",
+    "ended", "hangup", "disconnected", "terminated", "canceled", "cancelled",
+    "timeout", "voicemail", "machine_detected",
+}
+
+
+def _is_terminal_status(s: str) -> bool:
+    return (s or "").strip().lower() in _TERMINAL_STATUSES
+
+
+CALL_PREFIX = "linebot:voice:call:"              # HASH：ticket_ids / appt_date / line_user_id / status / terminal / updated_at / events / written
+FLUSH_LOCK_PREFIX = "linebot:voice:call:flushing:"
+OPEN_KEY = "linebot:voice:calls:open"            # ZSET：還沒回寫 Zendesk 的 call_id，score = 最後 event 時間
+RAW_KEY = "linebot:voice:webhook:raw"            # LIST：原始 webhook（最新的在前面）
+RAW_KEEP = 1000
+CALL_TTL_SEC = 2 * 24 * 60 * 60
+
+# 記一個 event：已經有結束狀態時，後面的中間狀態（ringing…）不會蓋掉它
+_RECORD_EVENT_LUA = """
+redis.call('HSET', KEYS[1], 'ticket_ids', ARGV[1], 'updated_at', ARGV[3])
+redis.call('HINCRBY', KEYS[1], 'events', 1)
+if ARGV[4] == '1' or redis.call('HGET', KEYS[1], 'terminal') ~= '1' then
+    redis.call('HSET', KEYS[1], 'status', ARGV[2], 'terminal', ARGV[4])
+end
+if ARGV[6] ~= '' then
+    redis.call('HSET', KEYS[1], 'appt_date', ARGV[6])
+end
+if ARGV[7] ~= '' then
+    redis.call('HSET', KEYS[1], 'line_user_id', ARGV[7])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+return 1
+"""
+_record_event = redis_conn.register_script(_RECORD_EVENT_LUA)
 
 def _get_metadata(data: dict) -> dict:
     m = data.get("metadata")
@@ -57,11 +102,12 @@ def _normalize_status(s: str) -> str:
     return "attempted"
 
 
-def handle_livehub_webhook(data: dict):
+def _parse_livehub_event(data: dict) -> tuple[str | None, str, list[int]]:
     """
     支援兩種 payload：
     - 新版群組：metadata.ticketIds = [..]
     - 舊版單筆：metadata.ticketId = 123
+    回傳 (call_id, call_status, ticket_ids)
     """
     call_id = (
         data.get("callId")
@@ -72,9 +118,7 @@ def handle_livehub_webhook(data: dict):
         or (data.get("call") or {}).get("id")
     )
 
-
     call_status = data.get("callStatus") or data.get("status") or data.get("call_status")
-    result = _normalize_status(call_status)
 
     metadata = _get_metadata(data)
 
@@ -97,43 +141,129 @@ def handle_livehub_webhook(data: dict):
         single = metadata.get("ticketId") or metadata.get("zendesk_ticket_id")
         ticket_ids = parse_ticket_ids(single)
 
+    return (str(call_id) if call_id else None), str(call_status or ""), ticket_ids
+
 
+def handle_livehub_webhook(data: dict) -> bool:
+    """
+    /webhook/livehub 只做這些就回 200：
+    - 驗欄位（call_id / ticket_ids）
+    - 原始 event 存一份到 Redis（RAW_KEY，留最近 RAW_KEEP 筆）
+    - 這通電話的最新狀態記在 CALL_PREFIX{call_id}（已經有結束狀態就不會被中間狀態蓋掉）
+    - 結束狀態：釋放撥號 slot，排 flush_voice_call 做整組一次的 Zendesk 回寫
+    回傳有沒有收下這個 event。
+    """
+    if not isinstance(data, dict):
+        app.logger.warning(f"[voice_webhook] payload 不是 object，ignore. data={data!r}")
+        return False
+
+    call_id, call_status, ticket_ids = _parse_livehub_event(data)
     if not call_id or not ticket_ids:
         app.logger.warning(f"[voice_webhook] missing call_id or ticket_ids, ignore. data={data}")
-        return
-
-    today_str = datetime.now().strftime("%Y-%m-%d")
-
-    for tid in ticket_ids:
-        if not tid:
-            continue
-        try:
-            # if result == "success":
-            #     mark_zendesk_ticket_voice_succeeded(
-            #         ticket_id=int(tid),
-            #         call_id=str(call_id),
-            #         call_status=str(call_status or ""),
-            #         attempted_date=today_str,
-            #     )
-            # elif result == "failed":
-            #     mark_zendesk_ticket_voice_failed(
-            #         ticket_id=int(tid),
-            #         call_id=str(call_id),
-            #         call_status=str(call_status or ""),
-            #         attempted_date=today_str,
-            #     )
-            # else:
-            #     mark_zendesk_ticket_voice_attempted(
-            #         ticket_id=int(tid),
-            #         call_id=str(call_id),
-            #         call_status=str(call_status or ""),
-            #         attempted_date=today_str,
-            #     )
-             mark_zendesk_ticket_voice_attempted(
-                    ticket_id=int(tid),
-                    call_id=str(call_id),
-                    call_status=str(call_status or ""),
-                    attempted_date=today_str,
-                )
-        except Exception as e:
-            app.logger.error(f"[voice_webhook] update ticket failed tid={tid}: {e}")
+        return False
+
+    terminal = _is_terminal_status(call_status)
+    now = time.time()
+    # 撥號時放進 metadata 的約診日 / line_user_id，重撥要用
+    metadata = _get_metadata(data)
+    appt_date = str(metadata.get("appointmentDate") or "")
+    line_user_id = str(metadata.get("lineUserId") or "")
+
+    pipe = redis_conn.pipeline()
+    pipe.lpush(RAW_KEY, json.dumps({"received_at": now, "data": data}, ensure_ascii=False))
+    pipe.ltrim(RAW_KEY, 0, RAW_KEEP - 1)
+    pipe.zadd(OPEN_KEY, {call_id: now})
+    pipe.execute()
+    _record_event(
+        keys=[f"{CALL_PREFIX}{call_id}"],
+        args=[json.dumps(ticket_ids), call_status, now, "1" if terminal else "0", CALL_TTL_SEC, appt_date, line_user_id],
+    )
+
+    record_status(call_id, call_status, now)
+
+    if terminal:
+        # 通話結束 → 釋放撥號 slot，voice_dialer 會馬上補下一通
+        release_call(call_id=call_id, ticket_ids=ticket_ids)
+        voice_call_queue.enqueue("flows_voice_webhook.flush_voice_call", call_id)
+
+    app.logger.info(f"[voice_webhook] stored call_id={call_id} status={call_status} terminal={terminal}")
+    return True
+
+
+def _decode(v):
+    return v.decode() if isinstance(v, bytes) else v
+
+
+def flush_voice_call(call_id: str, force: bool = False) -> bool:
+    """
+    RQ job：一通電話只回寫 Zendesk 一次（整組 ticket 一次 GET + 一次 PUT）。
+    - 等最後一個 event 過了 VOICE_WEBHOOK_SETTLE_SEC 再寫，同一通後面又來的結束狀態會一起收斂成最新的
+      （還沒到就用 enqueue_in 排到那時候再跑，不在 worker 裡 sleep 卡住撥號 job）
+    - 已經寫過就跳過（LiveHub 重送 / 多個結束狀態都只寫一次）
+    force=True：沒收到結束狀態也照目前最新狀態寫（flush_stale_voice_calls 用）
+    """
+    key = f"{CALL_PREFIX}{call_id}"
+    lock_key = f"{FLUSH_LOCK_PREFIX}{call_id}"
+    if not redis_conn.set(lock_key, "1", nx=True, ex=60):
+        return False
+    try:
+        call = {_decode(k): _decode(v) for k, v in (redis_conn.hgetall(key) or {}).items()}
+        if not call or call.get("written") == "1":
+            redis_conn.zrem(OPEN_KEY, call_id)
+            return False
+        if call.get("terminal") != "1" and not force:
+            return False
+
+        wait = VOICE_WEBHOOK_SETTLE_SEC - (time.time() - float(call.get("updated_at") or 0))
+        if wait > 0:
+            voice_call_queue.enqueue_in(
+                timedelta(seconds=wait), "flows_voice_webhook.flush_voice_call", call_id, force
+            )
+            return False
+
+        ticket_ids = json.loads(call.get("ticket_ids") or "[]")
+        call_status = call.get("status") or ""
+        today_str = datetime.now().strftime("%Y-%m-%d")
+
+        # 跟原本一樣只記「已嘗試」（success / failed 的回寫目前先不開）
+        attempts = mark_zendesk_tickets_voice_attempted(
+            ticket_ids=ticket_ids,
+            call_id=call_id,
+            call_status=call_status,
+            attempted_date=today_str,
+        )
+        if attempts is None:
+            app.logger.error(f"[voice_webhook] Zendesk 回寫失敗 call_id={call_id} tickets={ticket_ids}")
+            return False
+
+        # 沒接 / 忙線 / 失敗 → 依 backoff 排重撥（重送的 event attempts 是空的，不會重複排）
+        if attempts and call.get("terminal") == "1" and _normalize_status(call_status) == "failed":
+            schedule_retry(
+                call.get("line_user_id") or "U_auto",
+                call.get("appt_date") or "",
+                ticket_ids,
+                reason=call_status,
+            )
+
+        record_final(call_id, call_status, _normalize_status(call_status) if call.get("terminal") == "1" else "attempted")
+
+        pipe = redis_conn.pipeline()
+        pipe.hset(key, "written", "1")
+        pipe.zrem(OPEN_KEY, call_id)
+        pipe.execute()
+        app.logger.info(f"[voice_webhook] Zendesk 回寫完成 call_id={call_id} status={call_status} tickets={ticket_ids}")
+        return True
+    finally:
+        redis_conn.delete(lock_key)
+
+
+def flush_stale_voice_calls() -> int:
+    """
+    超過 VOICE_CALL_STALE_SEC 都沒再收到 event、也沒回寫過的通話（例如結束 webhook 掉了），
+    照最新狀態補寫一次。/cron/voice-dialer/pump 會順便呼叫。
+    """
+    cutoff = time.time() - VOICE_CALL_STALE_SEC
+    call_ids = [_decode(c) for c in (redis_conn.zrangebyscore(OPEN_KEY, "-inf", cutoff) or [])]
+    for call_id in call_ids:
+        voice_call_queue.enqueue("flows_voice_webhook.flush_voice_call", call_id, True)
+    return len(call_ids)
@@ -1,13 +1,108 @@
 # line_client.py
 import os
+import threading
+import time
+import uuid
 import certifi
+from contextvars import ContextVar
+
+from flask import current_app as app
 
 from linebot.v3 import WebhookHandler
 from linebot.v3.messaging import (
     Configuration,
     ApiClient,
     MessagingApi,
+    PushMessageRequest,
+    ReplyMessageRequest,
 )
+from linebot.v3.messaging.exceptions import ApiException
+
+# reply token 從 LINE 送出 webhook 起大約 1 分鐘內有效；超過這個秒數就不浪費一次 reply，直接改 push
+LINE_REPLY_TOKEN_TTL_SEC = float(os.getenv("LINE_REPLY_TOKEN_TTL_SEC", "50"))
+
+# 目前正在處理的 event：{"user_id": ..., "ts": 秒}
+# event 改成在 worker / thread 裡處理後，reply token 可能已過期，要知道改 push 給誰
+_reply_target: ContextVar = ContextVar("line_reply_target", default=None)
+
+
+def set_reply_target(user_id: str | None, event_ts_ms: int | None):
+    """
+    處理一個 event 前呼叫，回傳的 token 交給 reset_reply_target 還原。
+    """
+    ts = (event_ts_ms / 1000.0) if event_ts_ms else time.time()
+    target = {"user_id": user_id, "ts": ts, "replied": False, "lock": threading.Lock()} if user_id else None
+    return _reply_target.set(target)
+
+
+def reset_reply_target(token) -> None:
+    _reply_target.reset(token)
+
+
+def get_reply_target() -> dict | None:
+    return _reply_target.get()
+
+
+def claim_reply_token(target: dict) -> bool:
+    """
+    一個 reply token 只能用一次：第一個來拿的人（最終回覆 or「查詢中」提示）拿到，之後的人要改 push。
+    """
+    with target["lock"]:
+        if target["replied"]:
+            return False
+        target["replied"] = True
+        return True
+
+
+def _is_invalid_reply_token(e: ApiException) -> bool:
+    if getattr(e, "status", None) != 400:
+        return False
+    return "reply token" in str(getattr(e, "body", "") or "").lower()
+
+
+class ReplyFallbackMessagingApi(MessagingApi):
+    """
+    跟 MessagingApi 一樣，只是 reply_message 在 reply token 過期時自動改用 push 給同一個使用者。
+    原本各 flow 的 line_bot_api.reply_message(...) 都不用改。
+    """
+
+    def _push_instead(self, target: dict, reply_message_request, reason: str):
+        app.logger.info(f"[line_client] reply token 不可用（{reason}），改 push to={target['user_id']}")
+        # 用 reply token 產生固定的 retry key，同一則回覆重送也只會送到一次
+        retry_key = str(uuid.uuid5(uuid.NAMESPACE_URL, f"linebot:reply:{reply_message_request.reply_token}"))
+        try:
+            return self.push_message(
+                PushMessageRequest(to=target["user_id"], messages=reply_message_request.messages),
+                x_line_retry_key=retry_key,
+            )
+        except ApiException as e:
+            if getattr(e, "status", None) == 409:
+                return None
+            raise
+
+    def reply_message(self, reply_message_request, **kwargs):
+        target = _reply_target.get()
+        if target and time.time() - target["ts"] > LINE_REPLY_TOKEN_TTL_SEC:
+            return self._push_instead(target, reply_message_request, "event 已超過有效時間")
+        if target and not claim_reply_token(target):
+            return self._push_instead(target, reply_message_request, "已先回覆過「查詢中」")
+        try:
+            return super().reply_message(reply_message_request, **kwargs)
+        except ApiException as e:
+            if target and _is_invalid_reply_token(e):
+                return self._push_instead(target, reply_message_request, "Invalid reply token")
+            raise
+
+    def reply_interim(self, target: dict, reply_token: str, messages) -> bool:
+        """
+        處理太久時先用 reply token 回一則提示（reply_budget 的 timer 呼叫）。
+        最終回覆已經先用掉 token 就什麼都不做；回傳有沒有送出。
+        """
+        if not claim_reply_token(target):
+            return False
+        super().reply_message(ReplyMessageRequest(reply_token=reply_token, messages=messages))
+        return True
+
 
 # === LINE 基本設定 ===
 configuration = Configuration(
@@ -16,6 +111,6 @@ configuration = Configuration(
 configuration.ssl_ca_cert = certifi.where()
 
 api_client = ApiClient(configuration)
-line_bot_api = MessagingApi(api_client)
+line_bot_api = ReplyFallbackMessagingApi(api_client)
 
 handler = WebhookHandler(os.getenv("LINE_CHANNEL_SECRET"))
@@ -0,0 +1,368 @@
+# line_events.py
+import base64
+import hashlib
+import hmac
+import inspect
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app as app
+from linebot.v3.models.events import UnknownEvent
+from linebot.v3.webhooks import Event, MessageEvent
+
+from line_client import handler, set_reply_target, reset_reply_target
+from queue_core import line_event_queue, redis_conn
+from state_store import state_scope
+from config import (
+    LINE_WEBHOOK_MODE,
+    LINE_EVENT_THREADS,
+    LINE_EVENT_DEDUPE_TTL_SEC,
+    LINE_EVENT_PROCESSING_TTL_SEC,
+    LINE_USER_LOCK_TTL_SEC,
+)
+
+DEDUPE_PREFIX = "linebot:event:seen:"   # value: processing（短 TTL）/ done（LINE_EVENT_DEDUPE_TTL_SEC）
+INBOX_PREFIX = "linebot:event:inbox:"   # 每個使用者一個 ZSET，score = event timestamp
+USER_LOCK_PREFIX = "linebot:event:lock:"
+FAILED_KEY = "linebot:event:failed"     # LIST：handler 拋錯的 event（留最近 FAILED_KEEP 筆，方便查 / 手動補）
+FAILED_KEEP = 1000
+
+# 只有持有者才能續期 / 解鎖
+_EXTEND_LOCK_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+_RELEASE_LOCK_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+_extend_lock = redis_conn.register_script(_EXTEND_LOCK_LUA)
+_release_lock = redis_conn.register_script(_RELEASE_LOCK_LUA)
+
+_CHANNEL_SECRET = os.getenv("LINE_CHANNEL_SECRET") or ""
+
+# thread 模式用的 pool（整個 process 共用一個）
+_executor = ThreadPoolExecutor(max_workers=LINE_EVENT_THREADS, thread_name_prefix="line-event")
+
+
+def verify_signature(body: str, signature: str) -> bool:
+    return handler.parser.signature_validator.validate(body, signature)
+
+
+def _sign(body: str) -> str:
+    digest = hmac.new(_CHANNEL_SECRET.encode("utf-8"), body.encode("utf-8"), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode("utf-8")
+
+
+def _dedupe_key(event_id: str) -> str:
+    return f"{DEDUPE_PREFIX}{event_id}"
+
+
+def claim_event(event: dict) -> bool:
+    """
+    SET NX 佔住這個 webhookEventId，第一次看到回傳 True。
+    已經看過（處理中或處理完）回傳 False → 直接丟掉，不再跑一次 Graph / Zendesk。
+    「處理中」只留 LINE_EVENT_PROCESSING_TTL_SEC：worker 中途掛掉時，之後的重送不會被擋一整天；
+    處理完改成 done 才留 LINE_EVENT_DEDUPE_TTL_SEC。
+    Redis 出問題時放行（寧可重做也不要漏掉使用者的訊息）。
+    """
+    event_id = event.get("webhookEventId")
+    if not event_id:
+        return True
+    try:
+        return bool(redis_conn.set(_dedupe_key(event_id), "processing", nx=True, ex=LINE_EVENT_PROCESSING_TTL_SEC))
+    except Exception as e:
+        app.logger.warning(f"[line_events] dedupe 檢查失敗，照常處理 evt_id={event_id}: {e}")
+        return True
+
+
+def _start_event(event: dict) -> None:
+    """
+    真的開始處理時再把「處理中」續到 LINE_EVENT_PROCESSING_TTL_SEC（在 inbox 排隊的時間不算）。
+    """
+    event_id = event.get("webhookEventId")
+    if not event_id:
+        return
+    try:
+        redis_conn.set(_dedupe_key(event_id), "processing", ex=LINE_EVENT_PROCESSING_TTL_SEC, xx=True)
+    except Exception as e:
+        app.logger.warning(f"[line_events] 更新 dedupe 狀態失敗 evt_id={event_id}: {e}")
+
+
+def _finish_event(event: dict, ok: bool) -> None:
+    """
+    處理成功 → 標記 done；失敗 → 刪掉 key，讓 LINE 的重送（isRedelivery）可以再處理一次。
+    """
+    event_id = event.get("webhookEventId")
+    if not event_id:
+        return
+    try:
+        if ok:
+            redis_conn.set(_dedupe_key(event_id), "done", ex=LINE_EVENT_DEDUPE_TTL_SEC)
+        else:
+            redis_conn.delete(_dedupe_key(event_id))
+    except Exception as e:
+        app.logger.warning(f"[line_events] 更新 dedupe 狀態失敗 evt_id={event_id}: {e}")
+
+
+def _handle_with_body(destination: str | None, event: dict) -> None:
+    """
+    舊做法：把單一 event 包回 webhook body 再簽一次，交給 handler.handle（會再驗簽 + 再 parse 一次）。
+    只在 SDK 內部結構對不上時才用。
+    """
+    body = json.dumps({"destination": destination, "events": [event]}, ensure_ascii=False)
+    handler.handle(body, _sign(body))
+
+
+def _handle_parsed(destination: str | None, event: dict) -> None:
+    """
+    callback 已經驗過簽、parse 過 JSON；這裡直接把 dict 轉成 SDK 的 event model，
+    照 WebhookHandler.handle 的規則找 @handler.add 註冊的 handler 呼叫，不再序列化 / 驗簽 / parse 整包。
+    """
+    handlers = getattr(handler, "_handlers", None)
+    if handlers is None:
+        _handle_with_body(destination, event)
+        return
+
+    # 跟 WebhookParser.parse 一樣：SDK 不認得的 type 會 ValueError，包成 UnknownEvent
+    try:
+        model = Event.from_dict(event)
+    except ValueError:
+        app.logger.info(f"[line_events] 不認得的 event type={event.get('type')}")
+        model = UnknownEvent.new_from_json_dict(event)
+
+    func = None
+    if isinstance(model, MessageEvent):
+        func = handlers.get(f"{model.__class__.__name__}_{model.message.__class__.__name__}")
+    if func is None:
+        func = handlers.get(model.__class__.__name__)
+    if func is None:
+        func = getattr(handler, "_default", None)
+    if func is None:
+        app.logger.info(f"[line_events] 沒有對應的 handler type={event.get('type')}")
+        return
+
+    # 跟 WebhookHandler 一樣：handler 收兩個參數時多給 destination
+    code = getattr(func, "__code__", None)
+    if code is not None and (code.co_flags & inspect.CO_VARARGS or code.co_argcount >= 2):
+        func(model, destination)
+    else:
+        func(model)
+
+
+def process_line_event(destination: str | None, event: dict) -> None:
+    """
+    處理單一個 LINE event（drain_user_events 或 thread 都走這裡）。
+    event 是 callback parse 好的 dict，直接分派給 @handler.add 註冊的 handler。
+    """
+    source = event.get("source") or {}
+    line_user_id = source.get("userId")
+    token = set_reply_target(line_user_id, event.get("timestamp"))
+    _start_event(event)
+    ok = False
+    try:
+        # 流程 state 進來先一次讀好，handler 跑完再用一個 pipeline 寫回
+        with state_scope(line_user_id):
+            _handle_parsed(destination, event)
+        ok = True
+    finally:
+        reset_reply_target(token)
+        _finish_event(event, ok)
+
+
+def _event_owner(event: dict) -> str | None:
+    """
+    同一個對象（使用者 / 群組 / 聊天室）的 event 要依序處理。
+    """
+    source = event.get("source") or {}
+    return source.get("userId") or source.get("groupId") or source.get("roomId")
+
+
+def _push_to_inbox(owner: str, destination: str | None, event: dict) -> None:
+    item = json.dumps({"destination": destination, "event": event}, ensure_ascii=False)
+    pipe = redis_conn.pipeline()
+    pipe.zadd(f"{INBOX_PREFIX}{owner}", {item: float(event.get("timestamp") or 0)})
+    pipe.expire(f"{INBOX_PREFIX}{owner}", LINE_EVENT_DEDUPE_TTL_SEC)
+    pipe.execute()
+
+
+class _LockHeartbeat:
+    """
+    處理單一 event 時在背景定期續期使用者鎖：handler 跑超過 LINE_USER_LOCK_TTL_SEC 也不會讓第二個 drainer 進來。
+    續期失敗（鎖被別人拿走）記在 lost，由呼叫端決定要不要繼續。
+    """
+
+    def __init__(self, lock_key: str, token: str):
+        self.lock_key = lock_key
+        self.token = token
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="line-event-lock", daemon=True)
+
+    def _run(self) -> None:
+        interval = max(LINE_USER_LOCK_TTL_SEC / 3.0, 1.0)
+        while not self._stop.wait(interval):
+            try:
+                if not _extend_lock(keys=[self.lock_key], args=[self.token, LINE_USER_LOCK_TTL_SEC]):
+                    self.lost = True
+                    return
+            except Exception:
+                # Redis 暫時連不上：下一輪再試，鎖還有剩下的 TTL
+                continue
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+
+
+def _done_with_item(inbox_key: str, owner: str, raw, error: str | None = None) -> None:
+    """
+    處理完才把 event 移出 inbox；handler 拋錯的同時放進 FAILED_KEY（不擋住這個人後面的 event，也不會不見）。
+    """
+    pipe = redis_conn.pipeline()
+    pipe.zrem(inbox_key, raw)
+    if error is not None:
+        pipe.lpush(FAILED_KEY, json.dumps(
+            {"owner": owner, "item": raw.decode() if isinstance(raw, bytes) else raw, "error": error, "at": time.time()},
+            ensure_ascii=False,
+        ))
+        pipe.ltrim(FAILED_KEY, 0, FAILED_KEEP - 1)
+    pipe.execute()
+
+
+def drain_user_events(owner: str) -> int:
+    """
+    RQ job / thread：依 timestamp 由小到大處理某個使用者 inbox 裡的 event。
+
+    - 拿不到該使用者的鎖 → 代表別的 worker 正在處理他，新的 event 會由那個 worker 接著處理，這裡直接結束
+    - 不同使用者的鎖互不影響，可以完全平行
+    - 先看（ZRANGE）最前面的 event，處理完才 ZREM：worker 中途掛掉，event 還在 inbox，下一次 drain 會接著處理
+    - 處理中由 _LockHeartbeat 續期鎖，單一 event 跑很久也不會有第二個 worker 同時處理這個人
+    - 解鎖後再看一次 inbox，避免「剛放進來的 event 沒人處理」
+    回傳：這次處理了幾個 event
+    """
+    lock_key = f"{USER_LOCK_PREFIX}{owner}"
+    inbox_key = f"{INBOX_PREFIX}{owner}"
+    token = uuid.uuid4().hex
+    processed = 0
+
+    while True:
+        if not redis_conn.set(lock_key, token, nx=True, ex=LINE_USER_LOCK_TTL_SEC):
+            return processed
+
+        try:
+            while True:
+                head = redis_conn.zrange(inbox_key, 0, 0)
+                if not head:
+                    break
+                raw = head[0]
+                error = None
+                with _LockHeartbeat(lock_key, token) as heartbeat:
+                    try:
+                        item = json.loads(raw)
+                        process_line_event(item.get("destination"), item.get("event") or {})
+                    except Exception as e:
+                        app.logger.exception(f"[line_events] owner={owner} 處理 event 失敗: {e}")
+                        error = str(e)
+                _done_with_item(inbox_key, owner, raw, error)
+                processed += 1
+                if heartbeat.lost:
+                    # 鎖已經不是我們的（Redis 續期失敗太久），交給拿到鎖的 worker 接著處理
+                    app.logger.warning(f"[line_events] owner={owner} 使用者鎖遺失，停止這次 drain")
+                    return processed
+        finally:
+            _release_lock(keys=[lock_key], args=[token])
+
+        if not redis_conn.zcard(inbox_key):
+            return processed
+
+
+def _process_in_thread(flask_app, destination: str | None, event: dict) -> None:
+    with flask_app.app_context():
+        try:
+            process_line_event(destination, event)
+        except Exception as e:
+            app.logger.exception(
+                f"[line_events] 處理 event 失敗 evt_id={event.get('webhookEventId')}: {e}"
+            )
+
+
+def _drain_in_thread(flask_app, owner: str) -> None:
+    with flask_app.app_context():
+        try:
+            drain_user_events(owner)
+        except Exception as e:
+            app.logger.exception(f"[line_events] owner={owner} drain 失敗: {e}")
+
+
+def _schedule_drain(flask_app, owner: str) -> None:
+    if LINE_WEBHOOK_MODE == "sync":
+        drain_user_events(owner)
+        return
+
+    if LINE_WEBHOOK_MODE == "rq":
+        try:
+            line_event_queue.enqueue("line_events.drain_user_events", owner)
+            return
+        except Exception as e:
+            app.logger.error(f"[line_events] enqueue 失敗，改用 thread 處理 owner={owner}: {e}")
+
+    _executor.submit(_drain_in_thread, flask_app, owner)
+
+
+def dispatch_webhook_events(payload: dict) -> int:
+    """
+    把 webhook 裡的 events 交出去處理，回傳交出去的數量。
+    - 已經看過的 webhookEventId（含 deliveryContext.isRedelivery 的重送）直接丟掉
+    - 每個 event 先放進該使用者的 inbox（依 timestamp 排序），再排一個 drain；
+      同一個使用者同時只有一個 worker 在處理，註冊流程的 state 不會互相蓋掉
+    - Redis 出問題時退回「直接處理單一 event」，不讓 event 掉掉
+    """
+    destination = payload.get("destination")
+    events = payload.get("events") or []
+    flask_app = app._get_current_object()
+
+    dispatched = 0
+    owners: list[str] = []
+    for event in sorted(events, key=lambda e: e.get("timestamp") or 0):
+        if not claim_event(event):
+            redelivery = (event.get("deliveryContext") or {}).get("isRedelivery")
+            app.logger.info(
+                f"[line_events] 重複的 event，略過 evt_id={event.get('webhookEventId')} redelivery={redelivery}"
+            )
+            continue
+
+        dispatched += 1
+        owner = _event_owner(event)
+        if owner:
+            try:
+                _push_to_inbox(owner, destination, event)
+                if owner not in owners:
+                    owners.append(owner)
+                continue
+            except Exception as e:
+                app.logger.error(
+                    f"[line_events] 放入 inbox 失敗，直接處理 evt_id={event.get('webhookEventId')}: {e}"
+                )
+
+        if LINE_WEBHOOK_MODE == "sync":
+            process_line_event(destination, event)
+        else:
+            _executor.submit(_process_in_thread, flask_app, destination, event)
+
+    for owner in owners:
+        _schedule_drain(flask_app, owner)
+
+    return dispatched
@@ -0,0 +1,182 @@
+# line_push_core.py
+import time
+import uuid
+
+from flask import current_app as app
+
+from linebot.v3.messaging import PushMessageRequest
+from linebot.v3.messaging.exceptions import ApiException
+
+from line_client import line_bot_api
+from queue_core import redis_conn
+
+from config import (
+    LINE_PUSH_RATE_PER_SEC,
+    LINE_PUSH_BURST,
+    LINE_PUSH_MAX_RETRIES,
+)
+
+BUCKET_KEY = "linebot:push:bucket"       # 全部 worker 共用同一個 bucket（LINE 是以 channel 計算）
+RUN_STATS_PREFIX = "linebot:push:run:"   # 每一輪提醒的 sent / retried / failed 統計
+RUN_STATS_TTL_SEC = 2 * 24 * 60 * 60     # 統計留兩天，夠查前一天的 run
+
+# 在 Redis 裡做 token bucket：
+# - 依照距離上次的時間補 token（最多補到 burst）
+# - 有 token 就扣 1 回傳 0；沒有就回傳「還要等幾秒」（不扣）
+_TOKEN_BUCKET_LUA = """
+local key = KEYS[1]
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+
+local data = redis.call('HMGET', key, 'tokens', 'ts')
+local tokens = tonumber(data[1]) or burst
+local ts = tonumber(data[2]) or now
+
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+
+redis.call('HSET', key, 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', key, 60)
+return tostring(wait)
+"""
+
+_token_bucket = redis_conn.register_script(_TOKEN_BUCKET_LUA)
+
+
+def _acquire_push_token(max_wait_sec: float = 30.0) -> None:
+    """
+    跟 Redis token bucket 拿一個發送額度；拿不到就 sleep 到下一個 token 補上為止。
+    """
+    deadline = time.time() + max_wait_sec
+    while True:
+        wait = float(_token_bucket(
+            keys=[BUCKET_KEY],
+            args=[LINE_PUSH_RATE_PER_SEC, LINE_PUSH_BURST, time.time()],
+        ))
+        if wait <= 0:
+            return
+        if time.time() + wait > deadline:
+            # 等太久就直接放行，交給 429 重試機制處理
+            app.logger.warning(f"[line_push] token bucket 等待超過 {max_wait_sec}s，直接送出")
+            return
+        time.sleep(wait)
+
+
+def _record_run_stat(run_id: str | None, field: str, amount: int = 1) -> None:
+    if not run_id:
+        return
+    key = f"{RUN_STATS_PREFIX}{run_id}"
+    try:
+        pipe = redis_conn.pipeline()
+        pipe.hincrby(key, field, amount)
+        pipe.expire(key, RUN_STATS_TTL_SEC)
+        pipe.execute()
+    except Exception as e:
+        app.logger.warning(f"[line_push] 記錄統計失敗 run_id={run_id} field={field}: {e}")
+
+
+def _parse_retry_after(e: ApiException, attempt: int) -> float:
+    """
+    429 優先用 Retry-After header；沒有就用指數退避（1, 2, 4 ... 秒）。
+    """
+    headers = getattr(e, "headers", None) or {}
+    raw = None
+    try:
+        raw = headers.get("Retry-After") or headers.get("retry-after")
+    except Exception:
+        raw = None
+    if raw:
+        try:
+            return max(0.0, float(raw))
+        except (TypeError, ValueError):
+            pass
+    return float(2 ** (attempt - 1))
+
+
+def get_push_run_stats(run_id: str) -> dict:
+    """
+    回傳某一輪 run 的推播統計，例如 {"sent": 120, "retried": 3, "failed": 1}
+    """
+    if not run_id:
+        return {}
+    raw = redis_conn.hgetall(f"{RUN_STATS_PREFIX}{run_id}") or {}
+    return {k.decode() if isinstance(k, bytes) else k: int(v) for k, v in raw.items()}
+
+
+def build_retry_key(*parts) -> str:
+    """
+    給定同一則訊息的識別資料（例如 run_id, line_user_id, 日期），產生固定的 X-Line-Retry-Key。
+    同樣的 parts 一定得到同一個 UUID → RQ job 重跑時 LINE 也會自動去重。
+    """
+    name = ":".join(str(p) for p in parts)
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"linebot:push:{name}"))
+
+
+def dispatch_push(
+    to: str,
+    messages: list,
+    run_id: str | None = None,
+    retry_key: str | None = None,
+) -> None:
+    """
+    所有 push 都走這裡：
+    - 先過 Redis token bucket（跨 worker 限速）
+    - 帶 X-Line-Retry-Key，重試時 LINE 端會去重，不會重複發
+    - 429 依 Retry-After 等待後重試；5xx / 連線錯誤用指數退避重試
+    - 409（同一個 retry key 已被接受過）視為已發送
+    - 其他 4xx 不重試
+
+    最後仍失敗會 raise，讓呼叫端照原本的 try/except 處理。
+    """
+    if not retry_key:
+        retry_key = str(uuid.uuid4())
+
+    request = PushMessageRequest(to=to, messages=messages)
+    tries = max(1, LINE_PUSH_MAX_RETRIES + 1)
+
+    for attempt in range(1, tries + 1):
+        _acquire_push_token()
+        try:
+            line_bot_api.push_message(request, x_line_retry_key=retry_key)
+            _record_run_stat(run_id, "sent")
+            if attempt > 1:
+                app.logger.info(f"[line_push] 重試成功 to={to} attempt={attempt}/{tries}")
+            return
+        except ApiException as e:
+            status = getattr(e, "status", None)
+
+            if status == 409:
+                # 同一個 retry key 已經被 LINE 接受過 → 代表先前那次其實有送到
+                app.logger.info(f"[line_push] retry key 已被接受過（409），視為已發送 to={to}")
+                _record_run_stat(run_id, "sent")
+                return
+
+            retryable = status == 429 or (status is not None and status >= 500)
+            if not retryable or attempt >= tries:
+                app.logger.error(
+                    f"[line_push] 發送失敗 to={to} status={status} attempt={attempt}/{tries}: {e}"
+                )
+                _record_run_stat(run_id, "failed")
+                raise
+
+            wait = _parse_retry_after(e, attempt) if status == 429 else float(2 ** (attempt - 1))
+            app.logger.warning(
+                f"[line_push] status={status} to={to} attempt={attempt}/{tries}，{wait:.1f}s 後重試"
+            )
+        except Exception as e:
+            if attempt >= tries:
+                app.logger.error(f"[line_push] 發送失敗 to={to} attempt={attempt}/{tries}: {e}")
+                _record_run_stat(run_id, "failed")
+                raise
+            wait = float(2 ** (attempt - 1))
+            app.logger.warning(f"[line_push] 連線錯誤 to={to} attempt={attempt}/{tries}，{wait:.1f}s 後重試: {e}")
+
+        _record_run_stat(run_id, "retried")
+        time.sleep(wait)
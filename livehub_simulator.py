@@ -0,0 +1,198 @@
+# livehub_simulator.py
+"""
+本機假 LiveHub：壓測外撥 / webhook 用，不會真的打電話。
+
+啟動：
+    python livehub_simulator.py --port 5055 --dial-failure-rate 0.05
+
+再把 bot 指過來：
+    LIVEHUB_BASE_URL=http://localhost:5055
+    LIVEHUB_NOTIFY_URL=http://localhost:5001/webhook/livehub
+
+- POST /api/v1/actions/dialout：等 dial-latency 後回 callId（dial-failure-rate 的機率回 503）
+- 之後在背景照結果（answered / no_answer / busy / voicemail）依序把狀態 POST 到 notifyUrl
+- GET /sim/stats：撥號數、失敗數、送出的 webhook 數、bot 處理 webhook 的耗時
+"""
+import argparse
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from flask import Flask, request, jsonify
+
+sim = Flask(__name__)
+
+# 由 main() 依命令列參數設定
+CONFIG = {
+    "dial_latency_ms": (50, 300),
+    "dial_failure_rate": 0.0,
+    "ring_sec": (2.0, 8.0),
+    "talk_sec": (5.0, 20.0),
+    "outcomes": {"answered": 0.6, "no_answer": 0.2, "busy": 0.1, "voicemail": 0.1},
+    "notify_url": None,          # 有設就蓋掉 dialout payload 裡的 notifyUrl
+    "webhook_failure_rate": 0.0,  # 模擬 LiveHub 漏送 webhook
+}
+
+# 每個結果要送的狀態順序：(狀態, 延遲種類)
+SEQUENCES = {
+    "answered": [("ringing", None), ("answered", "ring"), ("completed", "talk")],
+    "no_answer": [("ringing", None), ("no_answer", "ring")],
+    "busy": [("busy", None)],
+    "voicemail": [("ringing", None), ("voicemail", "ring")],
+}
+
+_stats_lock = threading.Lock()
+_stats = {
+    "dials": 0,
+    "dial_failures": 0,
+    "webhooks_sent": 0,
+    "webhooks_dropped": 0,
+    "webhook_errors": 0,
+    "webhook_ms": [],
+    "outcomes": {},
+    "started_at": time.time(),
+}
+
+_sender = ThreadPoolExecutor(max_workers=32, thread_name_prefix="sim-webhook")
+
+
+def _incr(field: str, n: int = 1) -> None:
+    with _stats_lock:
+        _stats[field] += n
+
+
+def _uniform(r: tuple[float, float]) -> float:
+    return random.uniform(r[0], r[1])
+
+
+def _pick_outcome() -> str:
+    names = list(CONFIG["outcomes"])
+    return random.choices(names, weights=[CONFIG["outcomes"][n] for n in names], k=1)[0]
+
+
+def _post_webhook(notify_url: str, call_id: str, status: str, metadata: dict) -> None:
+    if random.random() < CONFIG["webhook_failure_rate"]:
+        _incr("webhooks_dropped")
+        return
+    payload = {
+        "callId": call_id,
+        "callStatus": status,
+        "metadata": metadata,
+        "timestamp": int(time.time() * 1000),
+    }
+    started = time.perf_counter()
+    try:
+        resp = requests.post(notify_url, json=payload, timeout=10)
+        resp.raise_for_status()
+    except Exception:
+        _incr("webhook_errors")
+        return
+    with _stats_lock:
+        _stats["webhooks_sent"] += 1
+        _stats["webhook_ms"].append((time.perf_counter() - started) * 1000.0)
+
+
+def _play_call(notify_url: str, call_id: str, outcome: str, metadata: dict) -> None:
+    for status, wait in SEQUENCES[outcome]:
+        if wait == "ring":
+            time.sleep(_uniform(CONFIG["ring_sec"]))
+        elif wait == "talk":
+            time.sleep(_uniform(CONFIG["talk_sec"]))
+        _post_webhook(notify_url, call_id, status, metadata)
+
+
+@sim.route("/api/v1/actions/dialout", methods=["POST"])
+def dialout():
+    data = request.get_json(silent=True) or {}
+    time.sleep(_uniform(CONFIG["dial_latency_ms"]) / 1000.0)
+    _incr("dials")
+
+    if random.random() < CONFIG["dial_failure_rate"]:
+        _incr("dial_failures")
+        return jsonify({"error": "simulated trunk failure"}), 503
+
+    notify_url = CONFIG["notify_url"] or data.get("notifyUrl")
+    if not data.get("target") or not notify_url:
+        return jsonify({"error": "missing target or notifyUrl"}), 400
+
+    call_id = f"sim-{uuid.uuid4().hex}"
+    outcome = _pick_outcome()
+    with _stats_lock:
+        _stats["outcomes"][outcome] = _stats["outcomes"].get(outcome, 0) + 1
+    _sender.submit(_play_call, notify_url, call_id, outcome, data.get("metadata") or {})
+    return jsonify({"callId": call_id, "status": "calling"}), 200
+
+
+@sim.route("/sim/stats", methods=["GET"])
+def stats():
+    with _stats_lock:
+        ms = sorted(_stats["webhook_ms"])
+        out = {k: v for k, v in _stats.items() if k != "webhook_ms"}
+    elapsed = max(time.time() - out["started_at"], 1e-6)
+
+    def pct(p: float):
+        return round(ms[min(len(ms) - 1, int(round(p * (len(ms) - 1))))], 1) if ms else None
+
+    out["elapsed_sec"] = round(elapsed, 1)
+    out["dials_per_sec"] = round(out["dials"] / elapsed, 2)
+    out["webhooks_per_sec"] = round(out["webhooks_sent"] / elapsed, 2)
+    out["webhook_ms"] = {"p50": pct(0.5), "p90": pct(0.9), "p99": pct(0.99)}
+    return jsonify(out), 200
+
+
+@sim.route("/sim/reset", methods=["POST"])
+def reset():
+    with _stats_lock:
+        _stats.update(
+            dials=0, dial_failures=0, webhooks_sent=0, webhooks_dropped=0, webhook_errors=0,
+            webhook_ms=[], outcomes={}, started_at=time.time(),
+        )
+    return jsonify({"status": "ok"}), 200
+
+
+def _parse_range(v: str) -> tuple[float, float]:
+    lo, _, hi = v.partition(",")
+    return float(lo), float(hi or lo)
+
+
+def _parse_weights(v: str) -> dict[str, float]:
+    out = {}
+    for part in v.split(","):
+        name, _, w = part.partition("=")
+        name = name.strip()
+        if name not in SEQUENCES:
+            raise SystemExit(f"不認得的結果 {name!r}，可以用：{', '.join(SEQUENCES)}")
+        out[name] = float(w)
+    return out
+
+
+def main():
+    p = argparse.ArgumentParser(description="本機假 LiveHub（壓測用）")
+    p.add_argument("--port", type=int, default=5055)
+    p.add_argument("--dial-latency-ms", default="50,300", help="dialout 回應時間範圍（ms），例：50,300")
+    p.add_argument("--dial-failure-rate", type=float, default=0.0, help="dialout 回 503 的機率")
+    p.add_argument("--ring-sec", default="2,8", help="響鈴到結果的秒數範圍")
+    p.add_argument("--talk-sec", default="5,20", help="接起來到掛斷的秒數範圍")
+    p.add_argument("--outcomes", default="answered=0.6,no_answer=0.2,busy=0.1,voicemail=0.1")
+    p.add_argument("--webhook-failure-rate", type=float, default=0.0, help="漏送 webhook 的機率")
+    p.add_argument("--notify-url", default=None, help="蓋掉 dialout 帶來的 notifyUrl")
+    args = p.parse_args()
+
+    CONFIG.update(
+        dial_latency_ms=_parse_range(args.dial_latency_ms),
+        dial_failure_rate=args.dial_failure_rate,
+        ring_sec=_parse_range(args.ring_sec),
+        talk_sec=_parse_range(args.talk_sec),
+        outcomes=_parse_weights(args.outcomes),
+        notify_url=args.notify_url,
+        webhook_failure_rate=args.webhook_failure_rate,
+    )
+    print(f"[livehub_simulator] listening on :{args.port} config={CONFIG}")
+    sim.run(host="0.0.0.0", port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
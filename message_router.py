@@ -0,0 +1,152 @@
+# message_router.py
+import re
+import time
+
+from flask import current_app as app
+
+from queue_core import redis_conn
+
+STATS_KEY = "linebot:router:stats"   # HASH：{route}:count / {route}:ms_total / {route}:errors
+
+
+class MessageContext:
+    """
+    一則文字訊息在各 handler 之間共用的資料，user_id / state 只取一次。
+    """
+
+    def __init__(self, event, text: str, line_user_id: str | None, state: dict | None):
+        self.event = event
+        self.text = text
+        self.line_user_id = line_user_id
+        self.state = state          # None = 沒有進行中的流程
+        self.match = None           # pattern route 命中時的 re.Match
+        self.arg = ""               # prefix route：去掉前綴後剩下的字
+
+
+class MessageRouter:
+    """
+    handle_message 的路由表：
+    - exact：完整指令，dict 查表 O(1)
+    - pattern：有格式的指令（例如「預約 YYYY-MM-DD」），預先 compile 好的 regex
+    - prefix：其他前綴指令，所有前綴 compile 成一個 regex，一次比對就知道是哪個
+    - step：流程中（state["step"]）每一步各自一個 handler
+    每個 route 的次數 / 耗時記在 Redis（STATS_KEY）。
+    """
+
+    def __init__(self):
+        self._exact: dict[str, tuple[str, callable]] = {}
+        self._patterns: list[tuple[re.Pattern, str, callable]] = []
+        self._prefixes: dict[str, tuple[str, callable]] = {}
+        self._prefix_re: re.Pattern | None = None
+        self._steps: dict[str, tuple[str, callable]] = {}
+        self._step_default: tuple[str, callable] | None = None
+        self._default: tuple[str, callable] | None = None
+
+    # ---------- 註冊 ----------
+    def exact(self, *texts: str, name: str | None = None):
+        def deco(func):
+            for t in texts:
+                self._exact[t] = (name or func.__name__, func)
+            return func
+        return deco
+
+    def pattern(self, regex: str, name: str | None = None):
+        def deco(func):
+            self._patterns.append((re.compile(regex), name or func.__name__, func))
+            return func
+        return deco
+
+    def prefix(self, *prefixes: str, name: str | None = None):
+        def deco(func):
+            for p in prefixes:
+                self._prefixes[p] = (name or func.__name__, func)
+            # 長的前綴放前面，避免被短的先吃掉
+            alts = "|".join(re.escape(p) for p in sorted(self._prefixes, key=len, reverse=True))
+            self._prefix_re = re.compile(f"^(?:{alts})")
+            return func
+        return deco
+
+    def step(self, *steps: str, name: str | None = None):
+        def deco(func):
+            for s in steps:
+                self._steps[s] = (name or func.__name__, func)
+            return func
+        return deco
+
+    def step_default(self, func):
+        self._step_default = (func.__name__, func)
+        return func
+
+    def default(self, func):
+        self._default = (func.__name__, func)
+        return func
+
+    # ---------- 比對 ----------
+    def resolve_step(self, step: str | None) -> tuple[str, callable] | None:
+        return self._steps.get(step or "") or self._step_default
+
+    def resolve_command(self, ctx: MessageContext) -> tuple[str, callable] | None:
+        text = ctx.text
+
+        hit = self._exact.get(text)
+        if hit:
+            return hit
+
+        for regex, name, func in self._patterns:
+            m = regex.match(text)
+            if m:
+                ctx.match = m
+                return name, func
+
+        if self._prefix_re:
+            m = self._prefix_re.match(text)
+            if m:
+                ctx.arg = text[m.end():].strip()
+                return self._prefixes[m.group(0)]
+
+        return None
+
+    def resolve_default(self) -> tuple[str, callable] | None:
+        return self._default
+
+    # ---------- 執行 + 計時 ----------
+    def run(self, route: tuple[str, callable], ctx: MessageContext):
+        name, func = route
+        started = time.perf_counter()
+        ok = False
+        try:
+            result = func(ctx)
+            ok = True
+            return result
+        finally:
+            _record_route(name, (time.perf_counter() - started) * 1000.0, ok)
+
+
+def _record_route(name: str, elapsed_ms: float, ok: bool) -> None:
+    try:
+        pipe = redis_conn.pipeline()
+        pipe.hincrby(STATS_KEY, f"{name}:count", 1)
+        pipe.hincrbyfloat(STATS_KEY, f"{name}:ms_total", round(elapsed_ms, 3))
+        if not ok:
+            pipe.hincrby(STATS_KEY, f"{name}:errors", 1)
+        pipe.execute()
+    except Exception as e:
+        app.logger.warning(f"[router] 記錄 route 統計失敗 route={name}: {e}")
+    app.logger.info(f"[router] route={name} ok={ok} elapsed_ms={elapsed_ms:.1f}")
+
+
+def get_route_stats() -> dict:
+    """
+    回傳 {route: {"count": n, "errors": n, "ms_total": x, "ms_avg": x}}
+    """
+    raw = redis_conn.hgetall(STATS_KEY) or {}
+    stats: dict[str, dict] = {}
+    for k, v in raw.items():
+        k = k.decode() if isinstance(k, bytes) else k
+        v = v.decode() if isinstance(v, bytes) else v
+        route, _, field = k.rpartition(":")
+        stats.setdefault(route, {"count": 0, "errors": 0, "ms_total": 0.0})
+        stats[route][field] = float(v) if field == "ms_total" else int(v)
+    for s in stats.values():
+        s["ms_avg"] = round(s["ms_total"] / s["count"], 1) if s["count"] else 0.0
+    return stats
@@ -1,14 +1,17 @@
+import json
 from datetime import datetime, timedelta
 
 from flask import current_app as app
 
 from zendesk_core import search_zendesk_user_by_line_id
+from queue_core import redis_conn
 from bookings_core import (
 list_appointments_for_range,
 parse_booking_datetime_to_local
 )
 
 from config import (
+    PATIENT_CACHE_TTL_SEC,
     PROFILE_STATUS_COMPLETE,
     is_valid_name
     )
@@ -143,10 +146,56 @@ def get_next_upcoming_appointment_for_line_user(line_user_id: str, max_days: int
     )
     return appt, local_start
 
+PATIENT_CACHE_PREFIX = "linebot:patient:"   # 已建檔（name + phone 齊全）的 Zendesk user，JSON
+
+
+def _is_complete_patient(user: dict | None) -> bool:
+    # 統一標準：要能預約 = name + phone 都有（避免半套資料混入預約流程）
+    if not user:
+        return False
+    name = (user.get("name") or "").strip()
+    phone = (user.get("phone") or "").strip()
+    return bool(phone) and is_valid_name(name)
+
+
+def cache_registered_patient(line_user_id: str, user: dict | None) -> bool:
+    """
+    把已建檔的 Zendesk user 存進短期快取（預約流程的下一步就不用再查 Zendesk）。
+    資料不完整的不存，回傳是否有存。
+    """
+    if not line_user_id or not _is_complete_patient(user):
+        return False
+    try:
+        redis_conn.set(
+            f"{PATIENT_CACHE_PREFIX}{line_user_id}",
+            json.dumps(user, ensure_ascii=False),
+            ex=PATIENT_CACHE_TTL_SEC,
+        )
+    except Exception as e:
+        app.logger.warning(f"[patient_cache] 寫入失敗 line_user_id={line_user_id}: {e}")
+        return False
+    return True
+
+
+def get_cached_registered_patient(line_user_id: str) -> dict | None:
+    if not line_user_id:
+        return None
+    try:
+        raw = redis_conn.get(f"{PATIENT_CACHE_PREFIX}{line_user_id}")
+        return json.loads(raw) if raw else None
+    except Exception as e:
+        app.logger.warning(f"[patient_cache] 讀取失敗 line_user_id={line_user_id}: {e}")
+        return None
+
+
 def is_registered_patient(line_user_id: str) -> bool:
     if not line_user_id:
         return False
 
+    # 短期快取裡有（剛查過、確定已建檔）就直接放行
+    if get_cached_registered_patient(line_user_id):
+        return True
+
     try:
         count, user = search_zendesk_user_by_line_id(line_user_id)
     except Exception as e:
@@ -163,14 +212,9 @@ def is_registered_patient(line_user_id: str) -> bool:
     if count < 1 or not user:
         return False
 
-    # 統一標準：要能預約 = name + phone 都有（避免半套資料混入預約流程）
-    name = (user.get("name") or "").strip()
-    phone = (user.get("phone") or "").strip()
-
-    if not phone:
-        return False
-    if not is_valid_name(name):
+    if not _is_complete_patient(user):
         return False
 
+    cache_registered_patient(line_user_id, user)
     return True
 
@@ -0,0 +1,124 @@
+# profile_cache.py
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app as app
+
+from line_client import line_bot_api
+from queue_core import redis_conn, line_event_queue
+
+from config import PROFILE_CACHE_TTL_SEC, PROFILE_REFRESH_AFTER_SEC, LINE_WEBHOOK_MODE
+
+PREFIX = "linebot:profile:"                # HASH：display_name / picture_url / fetched_at
+REFRESH_LOCK_PREFIX = "linebot:profile:refreshing:"
+REFRESH_LOCK_TTL_SEC = 60                  # 同一個使用者 60 秒內只會背景刷新一次
+
+# 背景刷新用（LINE profile API 很快，兩條 thread 就夠）
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="line-profile")
+
+
+def _key(line_user_id: str) -> str:
+    return f"{PREFIX}{line_user_id}"
+
+
+def _decode(v):
+    return v.decode() if isinstance(v, bytes) else v
+
+
+def refresh_profile(line_user_id: str) -> dict | None:
+    """
+    直接打 LINE profile API，存進快取並回傳 {"display_name", "picture_url"}；失敗回傳 None。
+    """
+    if not line_user_id:
+        return None
+    try:
+        profile = line_bot_api.get_profile(line_user_id)
+    except Exception as e:
+        app.logger.error(f"[profile_cache] 取得 LINE profile 失敗 uid={line_user_id}: {e}")
+        return None
+
+    data = {
+        "display_name": getattr(profile, "display_name", None) or "",
+        "picture_url": getattr(profile, "picture_url", None) or "",
+    }
+    try:
+        pipe = redis_conn.pipeline()
+        pipe.hset(_key(line_user_id), mapping={**data, "fetched_at": str(time.time())})
+        pipe.expire(_key(line_user_id), PROFILE_CACHE_TTL_SEC)
+        pipe.execute()
+    except Exception as e:
+        app.logger.warning(f"[profile_cache] 寫入快取失敗 uid={line_user_id}: {e}")
+    return data
+
+
+def _refresh_in_thread(flask_app, line_user_id: str) -> None:
+    with flask_app.app_context():
+        refresh_profile(line_user_id)
+
+
+def refresh_profile_async(line_user_id: str) -> None:
+    """
+    背景刷新；同一個使用者已經有人在刷新就不重複打 API。
+    rq 模式下 job 做完 process 就結束，背景 thread 會被砍掉，所以改排一個 RQ job。
+    """
+    if not line_user_id:
+        return
+    try:
+        if not redis_conn.set(f"{REFRESH_LOCK_PREFIX}{line_user_id}", "1", nx=True, ex=REFRESH_LOCK_TTL_SEC):
+            return
+    except Exception as e:
+        app.logger.warning(f"[profile_cache] 取得刷新鎖失敗 uid={line_user_id}: {e}")
+        return
+
+    if LINE_WEBHOOK_MODE == "rq":
+        try:
+            line_event_queue.enqueue("profile_cache.refresh_profile", line_user_id)
+            return
+        except Exception as e:
+            app.logger.warning(f"[profile_cache] enqueue 刷新失敗，改用 thread uid={line_user_id}: {e}")
+    _executor.submit(_refresh_in_thread, app._get_current_object(), line_user_id)
+
+
+def get_cached_profile(line_user_id: str) -> dict | None:
+    """
+    只讀快取（不會等 LINE API）：
+    - 沒有快取 → 排背景刷新，回傳 None
+    - 快取超過 PROFILE_REFRESH_AFTER_SEC → 先回舊的，同時排背景刷新
+    """
+    if not line_user_id:
+        return None
+    try:
+        raw = redis_conn.hgetall(_key(line_user_id)) or {}
+    except Exception as e:
+        app.logger.warning(f"[profile_cache] 讀取快取失敗 uid={line_user_id}: {e}")
+        return None
+
+    if not raw:
+        refresh_profile_async(line_user_id)
+        return None
+
+    data = {_decode(k): _decode(v) for k, v in raw.items()}
+    try:
+        age = time.time() - float(data.get("fetched_at") or 0)
+    except ValueError:
+        age = PROFILE_REFRESH_AFTER_SEC + 1
+    if age > PROFILE_REFRESH_AFTER_SEC:
+        refresh_profile_async(line_user_id)
+    return data
+
+
+def get_display_name(line_user_id: str, allow_fetch: bool = False) -> str | None:
+    """
+    取 LINE 顯示名稱。預設只看快取；allow_fetch=True 時快取沒有才同步打一次 API。
+    """
+    data = get_cached_profile(line_user_id)
+    if not data and allow_fetch:
+        data = refresh_profile(line_user_id)
+    return (data or {}).get("display_name") or None
+
+
+def warm_profile(line_user_id: str) -> None:
+    """
+    follow / 第一次互動時呼叫：快取沒有或過期就排背景刷新。
+    """
+    get_cached_profile(line_user_id)
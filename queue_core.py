@@ -15,6 +15,9 @@ reminder_queue = Queue("reminders", connection=redis_conn)
 # LINE 外撥提醒用
 voice_call_queue = Queue("voice_calls", connection=redis_conn)
 
+# LINE webhook event（callback 先回 200，event 之後在 worker 裡處理）
+line_event_queue = Queue("line_events", connection=redis_conn)
+
 
 
 
@@ -0,0 +1,102 @@
+# reminder_checkpoint.py
+import json
+
+from queue_core import redis_conn
+
+# 一個「提醒範圍」= (看診日, days_before)。這一輪沒跑完（掛掉 / 有錯誤）時，下一輪從這份 checkpoint 續跑：
+# - resolved：ticket_id → 已查好的 {line_user_id, appt}，重跑時不用再打 Graph / Zendesk
+#   （查不到 appt / line_user_id 的不記，病患之後綁定 LINE 或補資料，下一輪會重查）
+# - groups：已經 enqueue 過的 (line_user_id, ticket 組)，重跑時不會重複推播；
+#   同一人同一天多了新的 ticket 會是不同的組，還是會排
+# 整輪成功跑完就 clear_checkpoint，之後的 run 一律重新查（不會拿到舊的 appt）。
+# 續跑只靠 resolved（逐張 ticket 記錄）：查詢失敗的 ticket 不會寫入、新進的 ticket id 也可能比較小，
+# 用「處理到第幾張」的 cursor 跳過反而會漏掉，所以不另外記 cursor。
+PREFIX = "linebot:reminder:ckpt:"
+CHECKPOINT_TTL_SEC = 6 * 60 * 60
+
+
+def checkpoint_scope(appt_date_str: str, days_before: int | None) -> str:
+    return f"{appt_date_str}:{days_before}"
+
+
+def _key(scope: str, part: str) -> str:
+    return f"{PREFIX}{scope}:{part}"
+
+
+def _touch(pipe, scope: str) -> None:
+    for part in ("resolved", "groups"):
+        pipe.expire(_key(scope, part), CHECKPOINT_TTL_SEC)
+
+
+def load_resolved(scope: str, ticket_ids: list[int]) -> dict[int, dict]:
+    """
+    一次 HMGET 拿回這批 ticket 已查好的結果；沒有 checkpoint 的不會出現在回傳裡。
+    """
+    if not scope or not ticket_ids:
+        return {}
+    raw = redis_conn.hmget(_key(scope, "resolved"), [str(t) for t in ticket_ids])
+    out: dict[int, dict] = {}
+    for tid, v in zip(ticket_ids, raw):
+        if not v:
+            continue
+        try:
+            out[tid] = json.loads(v)
+        except Exception:
+            continue
+    return out
+
+
+def save_resolved(scope: str, ticket_id: int, line_user_id: str | None, appt: dict | None) -> None:
+    """
+    存一張 ticket 的查詢結果；line_user_id / appt 缺一個就不存（下一輪再查一次）。
+    """
+    if not scope or not ticket_id or not (line_user_id and appt):
+        return
+    value = {"line_user_id": line_user_id, "appt": appt}
+
+    pipe = redis_conn.pipeline()
+    pipe.hset(_key(scope, "resolved"), str(ticket_id), json.dumps(value, ensure_ascii=False))
+    _touch(pipe, scope)
+    pipe.execute()
+
+
+def get_enqueued_groups(scope: str) -> set[str]:
+    if not scope:
+        return set()
+    return {m.decode() if isinstance(m, bytes) else m for m in redis_conn.smembers(_key(scope, "groups"))}
+
+
+def _group_member(line_user_id: str, ticket_ids: list[int]) -> str:
+    return f"{line_user_id}:" + ",".join(str(int(t)) for t in sorted(ticket_ids) if t)
+
+
+def mark_group_enqueued(scope: str, line_user_id: str, ticket_ids: list[int]) -> bool:
+    """
+    SADD 成功（第一次）回傳 True；同一組（同一人、同一批 ticket）已經 enqueue 過回傳 False。
+    """
+    if not scope:
+        return True
+    pipe = redis_conn.pipeline()
+    pipe.sadd(_key(scope, "groups"), _group_member(line_user_id, ticket_ids))
+    _touch(pipe, scope)
+    added, *_ = pipe.execute()
+    return bool(added)
+
+
+def unmark_group(scope: str, line_user_id: str, ticket_ids: list[int]) -> None:
+    """
+    推播失敗時把 group 移出 checkpoint，讓同一天重跑時能再排一次。
+    """
+    if not scope:
+        return
+    redis_conn.srem(_key(scope, "groups"), _group_member(line_user_id, ticket_ids))
+
+
+def clear_checkpoint(scope: str) -> None:
+    """
+    整輪成功跑完（沒有錯誤）時呼叫：之後的 run 不再沿用這份結果。
+    """
+    if not scope:
+        return
+    redis_conn.delete(_key(scope, "resolved"), _key(scope, "groups"))
+
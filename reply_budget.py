@@ -0,0 +1,110 @@
+# reply_budget.py
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import current_app as app
+from linebot.v3.messaging import TextMessage, ShowLoadingAnimationRequest
+
+from line_client import line_bot_api, get_reply_target, LINE_REPLY_TOKEN_TTL_SEC
+from queue_core import redis_conn
+
+from config import LINE_REPLY_BUDGET_SEC, LINE_REPLY_INTERIM_MODE, LINE_REPLY_INTERIM_TEXT
+
+STATS_KEY = "linebot:reply_budget:stats"   # HASH：{flow}:count / {flow}:exceeded / {flow}:interim / {flow}:ms_total
+
+
+def _send_interim(flask_app, flow: str, target: dict, reply_token: str | None, sent: dict) -> None:
+    """
+    timer 到了最終回覆還沒送出 → 先給使用者一個提示。
+    """
+    with flask_app.app_context():
+        # reply token 已經過期就不送了，最終結果本來就會改 push
+        if time.time() - target["ts"] > LINE_REPLY_TOKEN_TTL_SEC:
+            return
+        try:
+            if LINE_REPLY_INTERIM_MODE == "loading":
+                # 讀取動畫只能 5 的倍數秒、最多 60 秒；不佔用 reply token，最終回覆照樣 reply
+                remain = LINE_REPLY_TOKEN_TTL_SEC - (time.time() - target["ts"])
+                seconds = max(5, min(60, int(remain // 5) * 5))
+                line_bot_api.show_loading_animation(
+                    ShowLoadingAnimationRequest(chat_id=target["user_id"], loading_seconds=seconds)
+                )
+                sent["interim"] = True
+            elif reply_token:
+                sent["interim"] = line_bot_api.reply_interim(
+                    target, reply_token, [TextMessage(text=LINE_REPLY_INTERIM_TEXT)]
+                )
+        except Exception as e:
+            app.logger.warning(f"[reply_budget] 送出提示失敗 flow={flow} uid={target['user_id']}: {e}")
+            return
+        if sent.get("interim"):
+            app.logger.info(f"[reply_budget] 超過 {LINE_REPLY_BUDGET_SEC}s，已先送提示 flow={flow} uid={target['user_id']}")
+
+
+@contextmanager
+def reply_budget(flow: str, event):
+    """
+    把一個 flow 的處理包起來：從 LINE 送出 event 起算，超過 LINE_REPLY_BUDGET_SEC 還沒結束，
+    timer 就先送「查詢中」（或讀取動畫），最終結果由 line_client 自動改用 push。
+    結束時記錄這個 flow 有沒有超過 budget。
+    """
+    target = get_reply_target()
+    started = target["ts"] if target else time.time()
+    sent = {"interim": False}
+
+    timer = None
+    if target and LINE_REPLY_BUDGET_SEC > 0:
+        delay = max(0.0, LINE_REPLY_BUDGET_SEC - (time.time() - started))
+        timer = threading.Timer(
+            delay,
+            _send_interim,
+            args=(app._get_current_object(), flow, target, getattr(event, "reply_token", None), sent),
+        )
+        timer.daemon = True
+        timer.start()
+
+    try:
+        yield
+    finally:
+        if timer is not None:
+            timer.cancel()
+            # 提示正在送的話等它送完，避免 rq job 結束時被砍掉
+            timer.join(timeout=5)
+        _record_budget(flow, (time.time() - started) * 1000.0, sent["interim"])
+
+
+def _record_budget(flow: str, elapsed_ms: float, interim: bool) -> None:
+    exceeded = elapsed_ms > LINE_REPLY_BUDGET_SEC * 1000.0
+    try:
+        pipe = redis_conn.pipeline()
+        pipe.hincrby(STATS_KEY, f"{flow}:count", 1)
+        pipe.hincrbyfloat(STATS_KEY, f"{flow}:ms_total", round(elapsed_ms, 3))
+        if exceeded:
+            pipe.hincrby(STATS_KEY, f"{flow}:exceeded", 1)
+        if interim:
+            pipe.hincrby(STATS_KEY, f"{flow}:interim", 1)
+        pipe.execute()
+    except Exception as e:
+        app.logger.warning(f"[reply_budget] 記錄統計失敗 flow={flow}: {e}")
+    if exceeded:
+        app.logger.info(f"[reply_budget] flow={flow} 超過 budget elapsed_ms={elapsed_ms:.1f} interim={interim}")
+
+
+def get_reply_budget_stats() -> dict:
+    """
+    回傳 {flow: {"count", "exceeded", "interim", "ms_total", "ms_avg", "exceeded_rate"}}
+    elapsed 從 LINE 送出 event 起算（含排隊時間）。
+    """
+    raw = redis_conn.hgetall(STATS_KEY) or {}
+    stats: dict[str, dict] = {}
+    for k, v in raw.items():
+        k = k.decode() if isinstance(k, bytes) else k
+        v = v.decode() if isinstance(v, bytes) else v
+        flow, _, field = k.rpartition(":")
+        stats.setdefault(flow, {"count": 0, "exceeded": 0, "interim": 0, "ms_total": 0.0})
+        stats[flow][field] = float(v) if field == "ms_total" else int(v)
+    for s in stats.values():
+        s["ms_avg"] = round(s["ms_total"] / s["count"], 1) if s["count"] else 0.0
+        s["exceeded_rate"] = round(s["exceeded"] / s["count"], 4) if s["count"] else 0.0
+    return stats
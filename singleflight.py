@@ -0,0 +1,148 @@
+# singleflight.py
+import json
+import threading
+import time
+import uuid
+
+from flask import current_app as app
+
+from queue_core import redis_conn
+
+from config import SINGLEFLIGHT_SHARE_TTL_SEC, SINGLEFLIGHT_WAIT_SEC
+
+LOCK_PREFIX = "linebot:sf:lock:"      # 誰正在打上游（value = token）
+RESULT_PREFIX = "linebot:sf:result:"  # 打完的結果（JSON），給其他 process 的人拿
+POLL_INTERVAL_SEC = 0.05
+
+_RELEASE_LOCK_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+_release_lock = redis_conn.register_script(_RELEASE_LOCK_LUA)
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: BaseException | None = None
+
+
+# 同一個 process 裡正在進行的呼叫：key -> _Call
+_calls: dict[str, _Call] = {}
+_calls_lock = threading.Lock()
+
+
+def _identity(v):
+    return v
+
+
+def _do_across_processes(key: str, fn, encode, decode, share_ttl_sec: float, wait_sec: float):
+    """
+    用 Redis SET NX 選出一個 process 去打上游，其他 process 輪詢結果。
+    帶頭的失敗（沒留下結果就放鎖）或等太久 → 自己打一次，不讓使用者卡住。
+    """
+    lock_key = f"{LOCK_PREFIX}{key}"
+    result_key = f"{RESULT_PREFIX}{key}"
+    token = uuid.uuid4().hex
+
+    try:
+        raw = redis_conn.get(result_key)
+        if raw is not None:
+            return decode(json.loads(raw))
+        leader = bool(redis_conn.set(lock_key, token, nx=True, px=int(wait_sec * 1000)))
+    except Exception as e:
+        app.logger.warning(f"[singleflight] Redis 無法使用，直接呼叫 key={key}: {e}")
+        return fn()
+
+    if not leader:
+        deadline = time.time() + wait_sec
+        try:
+            while time.time() < deadline:
+                time.sleep(POLL_INTERVAL_SEC)
+                raw = redis_conn.get(result_key)
+                if raw is not None:
+                    return decode(json.loads(raw))
+                if not redis_conn.exists(lock_key):
+                    break
+        except Exception as e:
+            app.logger.warning(f"[singleflight] 等待結果時 Redis 出錯 key={key}: {e}")
+        return fn()
+
+    try:
+        value = fn()
+        try:
+            redis_conn.set(
+                result_key,
+                json.dumps(encode(value), ensure_ascii=False),
+                px=max(1, int(share_ttl_sec * 1000)),
+            )
+        except Exception as e:
+            app.logger.warning(f"[singleflight] 寫入結果失敗 key={key}: {e}")
+        return value
+    finally:
+        try:
+            _release_lock(keys=[lock_key], args=[token])
+        except Exception:
+            pass
+
+
+def singleflight(
+    key: str,
+    fn,
+    *,
+    encode=_identity,
+    decode=_identity,
+    share_ttl_sec: float | None = None,
+    wait_sec: float | None = None,
+    local_only: bool = False,
+):
+    """
+    同一個 key 同時只有一個上游呼叫在進行，其他人等它的結果：
+    - 同一個 process 的 thread：等同一個 _Call
+    - 不同 process：透過 Redis 鎖 + 結果 key（結果保留 share_ttl_sec 秒）
+    encode / decode：把回傳值轉成可以 JSON 的形式（例如 tuple → list）
+    local_only=True：只合併同一個 process 的呼叫，結果不寫進 Redis（token 之類的機密用這個）
+    """
+    share_ttl_sec = SINGLEFLIGHT_SHARE_TTL_SEC if share_ttl_sec is None else share_ttl_sec
+    wait_sec = SINGLEFLIGHT_WAIT_SEC if wait_sec is None else wait_sec
+
+    with _calls_lock:
+        call = _calls.get(key)
+        leader = call is None
+        if leader:
+            call = _Call()
+            _calls[key] = call
+
+    if not leader:
+        if not call.done.wait(wait_sec):
+            return fn()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    try:
+        if local_only:
+            call.result = fn()
+        else:
+            call.result = _do_across_processes(key, fn, encode, decode, share_ttl_sec, wait_sec)
+        return call.result
+    except BaseException as e:
+        call.error = e
+        raise
+    finally:
+        with _calls_lock:
+            _calls.pop(key, None)
+        call.done.set()
+
+
+def forget(key: str) -> None:
+    """
+    上游資料剛被改過（例如新增 / 取消預約）→ 丟掉還沒過期的共享結果。
+    """
+    try:
+        redis_conn.delete(f"{RESULT_PREFIX}{key}")
+    except Exception as e:
+        app.logger.warning(f"[singleflight] 清除結果失敗 key={key}: {e}")
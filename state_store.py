@@ -1,33 +1,183 @@
 # state_store.py
 import json
+from contextlib import contextmanager
+from contextvars import ContextVar
+
 from queue_core import redis_conn
 
-PREFIX = "linebot:pending:"        # key prefix
+PREFIX = "linebot:pending:"        # key prefix（每個使用者一個 HASH，欄位值用 JSON 存）
 DEFAULT_TTL_SEC = 15 * 60          # 15 分鐘，夠跑完一輪流程
 
+# 目前這個 event 的本地快取（state_scope 裡才有）
+_request_cache: ContextVar = ContextVar("linebot_state_cache", default=None)
+
+
 def _key(line_user_id: str) -> str:
     return f"{PREFIX}{line_user_id}"
 
+
+def _decode(v):
+    return v.decode() if isinstance(v, bytes) else v
+
+
+def _encode_fields(state: dict) -> dict[str, str]:
+    return {k: json.dumps(v, ensure_ascii=False) for k, v in state.items()}
+
+
+def _load(line_user_id: str) -> dict:
+    raw = redis_conn.hgetall(_key(line_user_id)) or {}
+    state = {}
+    for k, v in raw.items():
+        try:
+            state[_decode(k)] = json.loads(_decode(v))
+        except Exception:
+            # 壞掉的欄位就當不存在
+            continue
+    return state
+
+
+class _StateCache:
+    """
+    一個 event 處理期間的 state 快取：
+    - 第一次讀某個使用者才 HGETALL，之後都讀本地
+    - 寫入 / 刪除先記在本地，flush 時跟原本的值比對，只把有變的欄位（HSET / HDEL）
+      跟 EXPIRE 放進同一個 pipeline 一次送出
+    """
+
+    def __init__(self):
+        self._loaded: dict[str, str] = {}     # uid -> 讀進來時的 JSON（比對有沒有改用）
+        self._states: dict[str, dict] = {}    # uid -> 目前的 state（{} = 沒有 / 已刪除）
+
+    def prefetch(self, *line_user_ids: str) -> None:
+        todo = [uid for uid in line_user_ids if uid and uid not in self._states]
+        if not todo:
+            return
+        pipe = redis_conn.pipeline()
+        for uid in todo:
+            pipe.hgetall(_key(uid))
+        for uid, raw in zip(todo, pipe.execute()):
+            state = {}
+            for k, v in (raw or {}).items():
+                try:
+                    state[_decode(k)] = json.loads(_decode(v))
+                except Exception:
+                    continue
+            self._remember(uid, state)
+
+    def _remember(self, uid: str, state: dict) -> None:
+        self._loaded[uid] = json.dumps(state, ensure_ascii=False, sort_keys=True)
+        self._states[uid] = state
+
+    def get(self, uid: str) -> dict:
+        if uid not in self._states:
+            self._remember(uid, _load(uid))
+        return self._states[uid]
+
+    def set(self, uid: str, state: dict) -> None:
+        if uid not in self._states:
+            # 沒讀過就直接整個覆蓋（flush 時會先 DEL）
+            self._loaded[uid] = None
+        self._states[uid] = dict(state or {})
+
+    def clear(self, uid: str) -> bool:
+        existed = bool(self.get(uid))
+        self._states[uid] = {}
+        return existed
+
+    def flush(self) -> None:
+        pipe = redis_conn.pipeline()
+        dirty = 0
+        for uid, state in self._states.items():
+            before = self._loaded.get(uid)
+            after = json.dumps(state, ensure_ascii=False, sort_keys=True)
+            if before == after:
+                continue
+            dirty += 1
+            key = _key(uid)
+            if not state:
+                pipe.delete(key)
+                continue
+            if before is None:
+                pipe.delete(key)
+                removed = []
+            else:
+                removed = [k for k in json.loads(before) if k not in state]
+            if removed:
+                pipe.hdel(key, *removed)
+            old = json.loads(before) if before else {}
+            changed = {k: v for k, v in state.items() if k not in old or old[k] != v}
+            if changed:
+                pipe.hset(key, mapping=_encode_fields(changed))
+            pipe.expire(key, DEFAULT_TTL_SEC)
+        if dirty:
+            pipe.execute()
+        self._loaded = {uid: json.dumps(s, ensure_ascii=False, sort_keys=True) for uid, s in self._states.items()}
+
+
+@contextmanager
+def state_scope(*line_user_ids: str):
+    """
+    處理一個 event 時包起來：進來先一次讀好這些使用者的 state，結束時一次把改動寫回。
+    """
+    cache = _StateCache()
+    cache.prefetch(*line_user_ids)
+    token = _request_cache.set(cache)
+    try:
+        yield cache
+    finally:
+        _request_cache.reset(token)
+        cache.flush()
+
+
 def get_state(line_user_id: str) -> dict:
     if not line_user_id:
         return {}
-    raw = redis_conn.get(_key(line_user_id))
-    if not raw:
-        return {}
-    try:
-        return json.loads(raw)
-    except Exception:
-        # 壞資料就當不存在
-        return {}
+    cache = _request_cache.get()
+    if cache is not None:
+        return cache.get(line_user_id)
+    return _load(line_user_id)
+
 
 def set_state(line_user_id: str, state: dict, ttl_sec: int = DEFAULT_TTL_SEC) -> None:
     if not line_user_id:
         return
     if state is None:
         state = {}
-    redis_conn.set(_key(line_user_id), json.dumps(state, ensure_ascii=False), ex=ttl_sec)
+    cache = _request_cache.get()
+    if cache is not None:
+        cache.set(line_user_id, state)
+        return
+    pipe = redis_conn.pipeline()
+    pipe.delete(_key(line_user_id))
+    if state:
+        pipe.hset(_key(line_user_id), mapping=_encode_fields(state))
+        pipe.expire(_key(line_user_id), ttl_sec)
+    pipe.execute()
+
+
+def update_state(line_user_id: str, ttl_sec: int = DEFAULT_TTL_SEC, **fields) -> None:
+    """
+    只改 state 裡的幾個欄位（HSET），其他欄位不動。
+    """
+    if not line_user_id or not fields:
+        return
+    cache = _request_cache.get()
+    if cache is not None:
+        state = dict(cache.get(line_user_id))
+        state.update(fields)
+        cache.set(line_user_id, state)
+        return
+    pipe = redis_conn.pipeline()
+    pipe.hset(_key(line_user_id), mapping=_encode_fields(fields))
+    pipe.expire(_key(line_user_id), ttl_sec)
+    pipe.execute()
+
 
 def clear_state(line_user_id: str) -> bool:
     if not line_user_id:
         return False
+    cache = _request_cache.get()
+    if cache is not None:
+        return cache.clear(line_user_id)
     return redis_conn.delete(_key(line_user_id)) > 0
+
@@ -0,0 +1,46 @@
+# tests/conftest.py
+"""
+測試共用設定：
+- Redis 換成 fakeredis（要裝 fakeredis[lua]，Lua script 才跑得動），每個測試前清空
+- LINE token 給假的值，line_client 才 import 得起來（不會真的打 LINE）
+- 每個測試都在一個 Flask app context 裡跑（各模組用 current_app.logger）
+
+跑法：pip install pytest "fakeredis[lua]" 之後在 repo 根目錄 python -m pytest
+"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "test-token")
+os.environ.setdefault("LINE_CHANNEL_SECRET", "test-secret")
+
+import fakeredis
+import pytest
+from flask import Flask
+from rq import Queue
+
+import queue_core
+
+# 一定要在 import 其他模組之前換掉：各模組 import 時就會拿 redis_conn 去 register_script
+fake_redis = fakeredis.FakeRedis()
+queue_core.redis_conn = fake_redis
+queue_core.reminder_queue = Queue("reminders", connection=fake_redis)
+queue_core.voice_call_queue = Queue("voice_calls", connection=fake_redis)
+queue_core.line_event_queue = Queue("line_events", connection=fake_redis)
+
+
+@pytest.fixture(autouse=True)
+def redis_conn():
+    fake_redis.flushall()
+    yield fake_redis
+    fake_redis.flushall()
+
+
+@pytest.fixture(autouse=True)
+def app_context():
+    flask_app = Flask("tests")
+    with flask_app.app_context():
+        yield flask_app
@@ -0,0 +1,90 @@
+# tests/test_line_events.py
+import pytest
+
+import line_events
+from line_events import (
+    DEDUPE_PREFIX,
+    FAILED_KEY,
+    INBOX_PREFIX,
+    claim_event,
+    dispatch_webhook_events,
+)
+from config import LINE_EVENT_DEDUPE_TTL_SEC, LINE_EVENT_PROCESSING_TTL_SEC
+
+
+def _event(event_id: str, ts: int = 1000, redelivery: bool = False) -> dict:
+    return {
+        "type": "message",
+        "webhookEventId": event_id,
+        "timestamp": ts,
+        "source": {"type": "user", "userId": "U1"},
+        "deliveryContext": {"isRedelivery": redelivery},
+    }
+
+
+def test_claim_event_only_once(redis_conn):
+    assert claim_event(_event("e1")) is True
+    assert claim_event(_event("e1", redelivery=True)) is False
+    assert redis_conn.get(f"{DEDUPE_PREFIX}e1") == b"processing"
+    assert 0 < redis_conn.ttl(f"{DEDUPE_PREFIX}e1") <= LINE_EVENT_PROCESSING_TTL_SEC
+
+
+def test_claim_event_without_id_is_never_deduped():
+    event = _event("e1")
+    del event["webhookEventId"]
+    assert claim_event(event) is True
+    assert claim_event(event) is True
+
+
+def test_finish_ok_keeps_done_for_dedupe_ttl(redis_conn):
+    event = _event("e1")
+    claim_event(event)
+    line_events._finish_event(event, ok=True)
+    assert redis_conn.get(f"{DEDUPE_PREFIX}e1") == b"done"
+    assert redis_conn.ttl(f"{DEDUPE_PREFIX}e1") > LINE_EVENT_PROCESSING_TTL_SEC
+    assert redis_conn.ttl(f"{DEDUPE_PREFIX}e1") <= LINE_EVENT_DEDUPE_TTL_SEC
+    assert claim_event(event) is False
+
+
+def test_finish_failed_lets_redelivery_through(redis_conn):
+    event = _event("e1")
+    claim_event(event)
+    line_events._finish_event(event, ok=False)
+    assert not redis_conn.exists(f"{DEDUPE_PREFIX}e1")
+    assert claim_event(_event("e1", redelivery=True)) is True
+
+
+@pytest.fixture
+def sync_mode(monkeypatch):
+    monkeypatch.setattr(line_events, "LINE_WEBHOOK_MODE", "sync")
+
+
+def test_dispatch_drops_duplicates_and_keeps_order(monkeypatch, redis_conn, sync_mode):
+    handled = []
+    monkeypatch.setattr(line_events, "_handle_parsed", lambda dest, event: handled.append(event["webhookEventId"]))
+
+    payload = {"destination": "D", "events": [_event("e2", ts=2000), _event("e1", ts=1000), _event("e1", ts=1000)]}
+    assert dispatch_webhook_events(payload) == 2
+    assert handled == ["e1", "e2"]
+    assert redis_conn.get(f"{DEDUPE_PREFIX}e1") == b"done"
+    assert not redis_conn.exists(f"{INBOX_PREFIX}U1")
+
+    # LINE 重送同一個 event：不再處理
+    assert dispatch_webhook_events({"destination": "D", "events": [_event("e1", redelivery=True)]}) == 0
+    assert handled == ["e1", "e2"]
+
+
+def test_failed_event_goes_to_dead_letter_and_can_be_redelivered(monkeypatch, redis_conn, sync_mode):
+    def boom(dest, event):
+        raise RuntimeError("handler failed")
+
+    monkeypatch.setattr(line_events, "_handle_parsed", boom)
+    assert dispatch_webhook_events({"destination": "D", "events": [_event("e1")]}) == 1
+    assert redis_conn.llen(FAILED_KEY) == 1
+    assert not redis_conn.exists(f"{INBOX_PREFIX}U1")
+    assert not redis_conn.exists(f"{DEDUPE_PREFIX}e1")
+
+    handled = []
+    monkeypatch.setattr(line_events, "_handle_parsed", lambda dest, event: handled.append(event["webhookEventId"]))
+    assert dispatch_webhook_events({"destination": "D", "events": [_event("e1", redelivery=True)]}) == 1
+    assert handled == ["e1"]
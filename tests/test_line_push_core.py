@@ -0,0 +1,97 @@
+# tests/test_line_push_core.py
+import pytest
+from linebot.v3.messaging import TextMessage
+from linebot.v3.messaging.exceptions import ApiException
+
+import line_push_core
+from line_push_core import BUCKET_KEY, build_retry_key, dispatch_push, get_push_run_stats
+
+
+def _bucket(now: float, rate: float = 2, burst: int = 3) -> float:
+    return float(line_push_core._token_bucket(keys=[BUCKET_KEY], args=[rate, burst, now]))
+
+
+def test_token_bucket_allows_burst_then_waits():
+    assert [_bucket(1000.0) for _ in range(3)] == [0.0, 0.0, 0.0]
+    # 空了：rate=2 → 要等 0.5 秒才補到一個
+    assert _bucket(1000.0) == pytest.approx(0.5)
+
+
+def test_token_bucket_refills_over_time():
+    for _ in range(3):
+        _bucket(1000.0)
+    assert _bucket(1000.5) == 0.0
+    # 過很久也只補到 burst
+    assert [_bucket(2000.0) for _ in range(4)][-1] > 0
+
+
+def _api_error(status: int, headers: dict | None = None) -> ApiException:
+    e = ApiException(status=status, reason="test")
+    e.headers = headers or {}
+    return e
+
+
+class _FakeLineApi:
+    def __init__(self, *results):
+        self.results = list(results)
+        self.retry_keys = []
+
+    def push_message(self, request, x_line_retry_key=None):
+        self.retry_keys.append(x_line_retry_key)
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    waited = []
+    monkeypatch.setattr(line_push_core, "_acquire_push_token", lambda *a, **k: None)
+    monkeypatch.setattr(line_push_core.time, "sleep", waited.append)
+    return waited
+
+
+def _push(monkeypatch, *results):
+    api = _FakeLineApi(*results)
+    monkeypatch.setattr(line_push_core, "line_bot_api", api)
+    return api
+
+
+def test_409_counts_as_sent(monkeypatch, sleeps):
+    api = _push(monkeypatch, _api_error(409))
+    dispatch_push("U1", [TextMessage(text="hi")], run_id="r1", retry_key="k1")
+    assert api.retry_keys == ["k1"]
+    assert get_push_run_stats("r1") == {"sent": 1}
+    assert sleeps == []
+
+
+def test_429_waits_retry_after_and_keeps_retry_key(monkeypatch, sleeps):
+    api = _push(monkeypatch, _api_error(429, {"Retry-After": "2"}), None)
+    dispatch_push("U1", [TextMessage(text="hi")], run_id="r1", retry_key="k1")
+    assert api.retry_keys == ["k1", "k1"]
+    assert sleeps == [2.0]
+    assert get_push_run_stats("r1") == {"sent": 1, "retried": 1}
+
+
+def test_5xx_backs_off_then_gives_up(monkeypatch, sleeps):
+    tries = line_push_core.LINE_PUSH_MAX_RETRIES + 1
+    api = _push(monkeypatch, *[_api_error(500) for _ in range(tries)])
+    with pytest.raises(ApiException):
+        dispatch_push("U1", [TextMessage(text="hi")], run_id="r1")
+    assert len(api.retry_keys) == tries
+    assert len(set(api.retry_keys)) == 1
+    assert sleeps == [float(2 ** i) for i in range(tries - 1)]
+    assert get_push_run_stats("r1") == {"retried": tries - 1, "failed": 1}
+
+
+def test_other_4xx_is_not_retried(monkeypatch, sleeps):
+    api = _push(monkeypatch, _api_error(400))
+    with pytest.raises(ApiException):
+        dispatch_push("U1", [TextMessage(text="hi")], run_id="r1")
+    assert len(api.retry_keys) == 1
+    assert get_push_run_stats("r1") == {"failed": 1}
+
+
+def test_build_retry_key_is_stable():
+    assert build_retry_key("r1", "U1", "2026-01-15") == build_retry_key("r1", "U1", "2026-01-15")
+    assert build_retry_key("r1", "U1", "2026-01-15") != build_retry_key("r2", "U1", "2026-01-15")
@@ -0,0 +1,135 @@
+# tests/test_message_router.py
+from types import SimpleNamespace
+
+import pytest
+
+from message_router import MessageRouter, MessageContext, get_route_stats
+
+
+def _ctx(text: str, state: dict | None = None) -> MessageContext:
+    return MessageContext(SimpleNamespace(reply_token="rt"), text, "U1", state)
+
+
+@pytest.fixture
+def router():
+    r = MessageRouter()
+
+    @r.exact("預約 今天")
+    def exact_today(ctx):
+        return "exact"
+
+    @r.pattern(r"^預約\s+(\d{4}-\d{2}-\d{2})$")
+    def book_date(ctx):
+        return "pattern"
+
+    @r.prefix("預約")
+    def book_short(ctx):
+        return "short"
+
+    @r.prefix("預約 ")
+    def book_prefix(ctx):
+        return "prefix"
+
+    @r.step("ask_name")
+    def ask_name(ctx):
+        return "step"
+
+    @r.step_default
+    def unknown_step(ctx):
+        return "step_default"
+
+    return r
+
+
+def test_exact_beats_pattern_and_prefix(router):
+    name, _ = router.resolve_command(_ctx("預約 今天"))
+    assert name == "exact_today"
+
+
+def test_pattern_beats_prefix_and_keeps_match(router):
+    ctx = _ctx("預約 2026-01-15")
+    name, _ = router.resolve_command(ctx)
+    assert name == "book_date"
+    assert ctx.match.group(1) == "2026-01-15"
+
+
+def test_longest_prefix_wins_and_arg_is_stripped(router):
+    ctx = _ctx("預約 明天下午")
+    name, _ = router.resolve_command(ctx)
+    assert name == "book_prefix"
+    assert ctx.arg == "明天下午"
+
+    ctx = _ctx("預約明天")
+    name, _ = router.resolve_command(ctx)
+    assert name == "book_short"
+    assert ctx.arg == "明天"
+
+
+def test_no_command_returns_none(router):
+    assert router.resolve_command(_ctx("你好")) is None
+
+
+def test_step_lookup_and_default(router):
+    assert router.resolve_step("ask_name")[0] == "ask_name"
+    assert router.resolve_step("no_such_step")[0] == "unknown_step"
+    assert router.resolve_step(None)[0] == "unknown_step"
+
+
+def test_run_records_stats(router):
+    ctx = _ctx("預約 2026-01-15")
+    route = router.resolve_command(ctx)
+    assert router.run(route, ctx) == "pattern"
+
+    @router.exact("boom")
+    def boom(ctx):
+        raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError):
+        router.run(router.resolve_command(_ctx("boom")), _ctx("boom"))
+
+    stats = get_route_stats()
+    assert stats["book_date"]["count"] == 1
+    assert stats["book_date"]["errors"] == 0
+    assert stats["boom"]["errors"] == 1
+
+
+# ---------- app.py 實際註冊的指令 ----------
+
+@pytest.fixture
+def linebot_app(monkeypatch):
+    import app as linebot_app
+
+    replies = []
+    monkeypatch.setattr(
+        linebot_app,
+        "line_bot_api",
+        SimpleNamespace(reply_message=lambda req: replies.append([m.text for m in req.messages])),
+    )
+    linebot_app.sent_replies = replies
+    return linebot_app
+
+
+@pytest.mark.parametrize("text", ["預約 2026-01-15", "預約  2026-01-15", "預約\t2026-01-15", "預約　2026-01-15"])
+def test_book_date_accepts_any_whitespace(linebot_app, text):
+    ctx = _ctx(text)
+    name, _ = linebot_app.message_router.resolve_command(ctx)
+    assert name == "_cmd_book_date"
+    assert ctx.match.group(1) == "2026-01-15"
+
+
+def test_query_date_goes_to_pattern(linebot_app):
+    ctx = _ctx("查 2026-01-15")
+    name, _ = linebot_app.message_router.resolve_command(ctx)
+    assert name == "_cmd_query_date"
+
+
+def test_query_non_date_replies_usage_hint(linebot_app, monkeypatch):
+    monkeypatch.setattr(
+        linebot_app, "list_appointments_for_date", lambda *_: pytest.fail("不應該打 Graph")
+    )
+    ctx = _ctx("查 明天")
+    route = linebot_app.message_router.resolve_command(ctx)
+    assert route[0] == "_cmd_query_date_usage"
+
+    linebot_app.message_router.run(route, ctx)
+    assert linebot_app.sent_replies == [["請輸入：查 YYYY-MM-DD，例：查 2025-01-15"]]
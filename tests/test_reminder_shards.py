@@ -0,0 +1,69 @@
+# tests/test_reminder_shards.py
+import pytest
+
+import flows_reminders
+from cron_runs import get_run, start_run, update_run
+from flows_reminders import process_reminder_shard, split_reminder_shards
+
+
+def test_split_keeps_each_requester_in_one_shard():
+    tickets = [{"id": i, "requester_id": 100 + i % 5} for i in range(40)]
+    shards = split_reminder_shards(tickets, 4)
+
+    owner = {}
+    for idx, batch in shards:
+        for t in batch:
+            assert owner.setdefault(t["requester_id"], idx) == idx
+    assert sum(len(b) for _, b in shards) == 40
+    assert split_reminder_shards(tickets, 4) == shards
+
+
+@pytest.fixture
+def run_id():
+    rid, _ = start_run("test_reminder_scan")
+    update_run(rid, shards_total=2, shards_done=0, checkpoint="2026-01-15:d3")
+    return rid
+
+
+@pytest.fixture
+def resolved(monkeypatch):
+    scopes = []
+
+    def fake_resolve(tickets, days_before, scope=None, shard=None):
+        scopes.append(scope)
+        return {}, 0, 0
+
+    monkeypatch.setattr(flows_reminders, "_resolve_reminder_groups", fake_resolve)
+    monkeypatch.setattr(flows_reminders, "_enqueue_reminder_groups", lambda groups, run_id, scope=None: 0)
+    monkeypatch.setattr(flows_reminders, "clear_checkpoint", lambda scope: None)
+    return scopes
+
+
+def test_shard_uses_coordinator_scope(run_id, resolved):
+    process_reminder_shard(run_id, 0, 3, [], "2026-01-15:d3")
+    assert resolved == ["2026-01-15:d3"]
+
+
+def test_shard_without_scope_falls_back_to_run_checkpoint(run_id, resolved):
+    process_reminder_shard(run_id, 0, 3, [])
+    assert resolved == ["2026-01-15:d3"]
+
+
+def test_rerun_shard_is_counted_once(run_id, resolved, monkeypatch):
+    finished = []
+    real_finish = flows_reminders.finish_run
+    monkeypatch.setattr(
+        flows_reminders, "finish_run", lambda rid, **kw: (finished.append(kw["status"]), real_finish(rid, **kw))
+    )
+
+    process_reminder_shard(run_id, 0, 3, [], "2026-01-15:d3")
+    process_reminder_shard(run_id, 0, 3, [], "2026-01-15:d3")   # 同一個 shard job 重跑
+    assert finished == []
+    assert get_run(run_id)["shards_done"] == 1
+
+    process_reminder_shard(run_id, 1, 3, [], "2026-01-15:d3")
+    assert finished == ["done"]
+    assert get_run(run_id)["status"] == "done"
+
+    process_reminder_shard(run_id, 1, 3, [], "2026-01-15:d3")   # 最後一個 shard 重跑不會再結束一次
+    assert finished == ["done"]
@@ -0,0 +1,90 @@
+# tests/test_state_store.py
+import json
+
+from state_store import (
+    DEFAULT_TTL_SEC,
+    PREFIX,
+    clear_state,
+    get_state,
+    set_state,
+    state_scope,
+    update_state,
+)
+
+KEY = f"{PREFIX}U1"
+
+
+def _raw(redis_conn) -> dict:
+    return {k.decode(): json.loads(v) for k, v in redis_conn.hgetall(KEY).items()}
+
+
+def test_set_update_clear_outside_scope(redis_conn):
+    set_state("U1", {"step": "ask_name", "name": "王"})
+    assert get_state("U1") == {"step": "ask_name", "name": "王"}
+    assert 0 < redis_conn.ttl(KEY) <= DEFAULT_TTL_SEC
+
+    update_state("U1", step="ask_phone")
+    assert _raw(redis_conn) == {"step": "ask_phone", "name": "王"}
+
+    assert clear_state("U1") is True
+    assert not redis_conn.exists(KEY)
+    assert clear_state("U1") is False
+
+
+def test_scope_only_writes_changed_fields(redis_conn):
+    set_state("U1", {"step": "ask_name", "name": "王", "phone": "0912345678"})
+
+    with state_scope("U1"):
+        update_state("U1", step="ask_phone")
+        # 別的地方在 scope 期間改了沒動到的欄位：flush 只寫有變的欄位，不會蓋回去
+        redis_conn.hset(KEY, "phone", json.dumps("0987654321"))
+
+    assert _raw(redis_conn) == {"step": "ask_phone", "name": "王", "phone": "0987654321"}
+
+
+def test_scope_removes_dropped_fields(redis_conn):
+    set_state("U1", {"step": "ask_name", "candidates": [1, 2]})
+
+    with state_scope("U1"):
+        set_state("U1", {"step": "ask_phone"})
+
+    assert _raw(redis_conn) == {"step": "ask_phone"}
+
+
+def test_scope_tracks_in_place_changes(redis_conn):
+    set_state("U1", {"step": "ask_name"})
+
+    with state_scope("U1"):
+        get_state("U1")["name"] = "王"
+
+    assert _raw(redis_conn) == {"step": "ask_name", "name": "王"}
+
+
+def test_scope_without_changes_does_not_write(redis_conn):
+    set_state("U1", {"step": "ask_name"})
+    redis_conn.expire(KEY, 30)
+
+    with state_scope("U1"):
+        assert get_state("U1") == {"step": "ask_name"}
+
+    # 沒有改動就不送 pipeline，TTL 不會被續成 DEFAULT_TTL_SEC
+    assert redis_conn.ttl(KEY) <= 30
+
+
+def test_scope_clear_deletes_key(redis_conn):
+    set_state("U1", {"step": "ask_name"})
+
+    with state_scope("U1"):
+        assert clear_state("U1") is True
+        assert get_state("U1") == {}
+
+    assert not redis_conn.exists(KEY)
+
+
+def test_scope_set_without_read_overwrites(redis_conn):
+    set_state("U2", {"step": "old", "extra": 1})
+
+    with state_scope("U1"):
+        set_state("U2", {"step": "new"})
+
+    assert {k.decode(): json.loads(v) for k, v in redis_conn.hgetall(f"{PREFIX}U2").items()} == {"step": "new"}
@@ -0,0 +1,65 @@
+# tests/test_voice_dialer.py
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+import voice_dialer
+from voice_dialer import (
+    INFLIGHT_KEY,
+    PENDING_ITEMS_KEY,
+    PENDING_KEY,
+    get_dialer_status,
+    pump_dialer,
+    submit_dial,
+)
+
+APPT_DATE = (datetime.now() + timedelta(days=1)).strftime("%Y-%m-%d")
+
+
+@pytest.fixture
+def dial_jobs(monkeypatch):
+    jobs = []
+    monkeypatch.setattr(voice_dialer, "in_calling_window", lambda now=None: True)
+    monkeypatch.setattr(
+        voice_dialer.voice_call_queue, "enqueue", lambda func, *args, **kwargs: jobs.append(args)
+    )
+    return jobs
+
+
+def test_resubmit_updates_the_pending_entry(redis_conn):
+    submit_dial("U1", APPT_DATE, [1141, 1140], dial_target={"phone": "0912345678"}, appt_time="10:00")
+    submit_dial("U1", APPT_DATE, [1140, 1141], attempts=1)
+
+    assert redis_conn.zrange(PENDING_KEY, 0, -1) == [b"tickets:1140,1141"]
+    assert redis_conn.hlen(PENDING_ITEMS_KEY) == 1
+    item = json.loads(redis_conn.hget(PENDING_ITEMS_KEY, "tickets:1140,1141"))
+    assert item["attempts"] == 1
+    # 重撥沒帶 dial_target → 沿用第一次查好的
+    assert item["dial_target"] == {"phone": "0912345678"}
+
+
+def test_pump_dials_each_group_once_in_priority_order(redis_conn, dial_jobs):
+    submit_dial("U1", APPT_DATE, [1], appt_time="14:00")
+    submit_dial("U2", APPT_DATE, [2], appt_time="09:00")
+    submit_dial("U1", APPT_DATE, [1], appt_time="14:00")
+
+    assert pump_dialer() == 2
+    assert [args[2] for args in dial_jobs] == [[2], [1]]
+    assert not redis_conn.zcard(PENDING_KEY)
+    assert not redis_conn.hlen(PENDING_ITEMS_KEY)
+    assert redis_conn.zcard(INFLIGHT_KEY) == 2
+
+
+def test_pump_requeues_when_slots_are_full(redis_conn, dial_jobs, monkeypatch):
+    monkeypatch.setattr(voice_dialer, "VOICE_MAX_INFLIGHT_CALLS", 1)
+    submit_dial("U1", APPT_DATE, [1], appt_time="09:00")
+    submit_dial("U2", APPT_DATE, [2], appt_time="10:00")
+
+    assert pump_dialer() == 1
+    assert redis_conn.zrange(PENDING_KEY, 0, -1) == [b"tickets:2"]
+    assert json.loads(redis_conn.hget(PENDING_ITEMS_KEY, "tickets:2"))["line_user_id"] == "U2"
+
+    status = get_dialer_status()
+    assert status["pending"] == 1
+    assert status["next"][0]["ticket_ids"] == [2]
@@ -0,0 +1,118 @@
+# tests/test_voice_manifest.py
+import json
+from datetime import datetime, timedelta
+
+from voice_manifest import (
+    BOOKING_PREFIX,
+    MANIFEST_PREFIX,
+    add_to_manifest,
+    expect_manifest_group,
+    get_manifest_status,
+    iter_manifest,
+    manifest_group_done,
+    manifest_ready,
+    mark_manifest_ready,
+    remove_booking_from_manifest,
+)
+
+DATE = (datetime.now() + timedelta(days=3)).strftime("%Y-%m-%d")   # key 用 EXPIREAT 約診日隔天，要用未來的日期
+USER = {"name": "王小明"}
+
+
+def _entry(redis_conn, requester_id: int = 7):
+    raw = redis_conn.hget(f"{MANIFEST_PREFIX}{DATE}", str(requester_id))
+    return json.loads(raw) if raw else None
+
+
+def _add(tickets, requester_id: int = 7):
+    return add_to_manifest(DATE, requester_id, "U1", USER, "0912345678", tickets)
+
+
+def test_merge_keeps_all_tickets_and_earliest_time(redis_conn):
+    assert _add([{"ticket_id": 1, "booking_id": "b1", "attempts": 1, "appt_time": "14:00"}])
+    assert _add([{"ticket_id": 2, "booking_id": "b2", "attempts": 0, "appt_time": "09:30"}])
+    assert _add([{"ticket_id": 3, "booking_id": "b3", "appt_time": ""}])
+
+    entry = _entry(redis_conn)
+    assert sorted(entry["tickets"]) == ["1", "2", "3"]
+    assert entry["appt_time"] == "09:30"
+    assert entry["tickets"]["1"] == {"booking_id": "b1", "attempts": 1}
+    assert redis_conn.get(f"{BOOKING_PREFIX}b2") == f"{DATE}|7|2".encode()
+    assert redis_conn.ttl(f"{MANIFEST_PREFIX}{DATE}") > 0
+
+
+def test_merge_overwrites_same_ticket(redis_conn):
+    _add([{"ticket_id": 1, "booking_id": "b1", "attempts": 1, "appt_time": "14:00"}])
+    _add([{"ticket_id": 1, "booking_id": "b1", "attempts": 2, "appt_time": "14:00"}])
+    assert _entry(redis_conn)["tickets"] == {"1": {"booking_id": "b1", "attempts": 2}}
+
+
+def test_add_skips_empty_input(redis_conn):
+    assert _add([]) is False
+    assert _add([{"booking_id": "b1"}]) is False
+    assert add_to_manifest(DATE, None, "U1", USER, None, [{"ticket_id": 1}]) is False
+    assert not redis_conn.exists(f"{MANIFEST_PREFIX}{DATE}")
+
+
+def test_remove_one_ticket_then_the_last(redis_conn):
+    _add([
+        {"ticket_id": 1, "booking_id": "b1", "appt_time": "09:00"},
+        {"ticket_id": 2, "booking_id": "b2", "appt_time": "10:00"},
+    ])
+
+    assert remove_booking_from_manifest("b1") is True
+    assert sorted(_entry(redis_conn)["tickets"]) == ["2"]
+    assert not redis_conn.exists(f"{BOOKING_PREFIX}b1")
+    # 同一個 booking 再按一次（例如先確認再取消）不會出錯
+    assert remove_booking_from_manifest("b1") is False
+
+    assert remove_booking_from_manifest("b2") is True
+    assert _entry(redis_conn) is None
+    assert list(iter_manifest(DATE)) == []
+
+
+def test_remove_unknown_booking(redis_conn):
+    assert remove_booking_from_manifest(None) is False
+    assert remove_booking_from_manifest("nope") is False
+
+
+def test_iter_manifest_builds_dial_targets(redis_conn):
+    _add([{"ticket_id": 2, "booking_id": "b2", "attempts": 1, "appt_time": "10:00"}], requester_id=7)
+    _add([{"ticket_id": 1, "booking_id": "b1", "attempts": 0, "appt_time": "09:00"}], requester_id=7)
+    add_to_manifest(DATE, 8, "U2", None, None, [{"ticket_id": 5, "booking_id": "b5"}])
+    redis_conn.hset(f"{MANIFEST_PREFIX}{DATE}", "9", "not json")
+
+    rows = {r["requester_id"]: r for r in iter_manifest(DATE)}
+    assert sorted(rows) == [7, 8]
+    assert rows[7]["ticket_ids"] == [1, 2]
+    assert rows[7]["appt_time"] == "09:00"
+    assert rows[7]["dial_target"]["ticket_attempts"] == {"1": 0, "2": 1}
+    assert rows[7]["dial_target"]["patient_name"] == "王小明"
+    assert rows[8]["dial_target"]["patient_name"] == "貴賓"
+    assert rows[8]["appt_time"] is None
+
+
+def test_ready_needs_clean_scan_and_no_pending_groups():
+    assert manifest_ready(DATE) is False
+
+    expect_manifest_group(DATE, 2)
+    mark_manifest_ready(DATE)
+    assert manifest_ready(DATE) is False
+
+    manifest_group_done(DATE)
+    assert manifest_ready(DATE) is False
+    manifest_group_done(DATE)
+    assert manifest_ready(DATE) is True
+
+    status = get_manifest_status(DATE)
+    assert status["scan_done"] is True
+    assert status["groups_pending"] == 0
+    assert status["dirty"] is False
+
+
+def test_failed_group_makes_manifest_dirty():
+    expect_manifest_group(DATE)
+    mark_manifest_ready(DATE)
+    manifest_group_done(DATE, ok=False)
+    assert manifest_ready(DATE) is False
+    assert get_manifest_status(DATE)["dirty"] is True
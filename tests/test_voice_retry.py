@@ -0,0 +1,96 @@
+# tests/test_voice_retry.py
+import json
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+import flows_voice_webhook
+from voice_dialer import PENDING_KEY, PENDING_ITEMS_KEY
+from voice_retry import COUNT_KEY, ITEMS_KEY, RETRY_KEY, feed_due_retries, schedule_retry
+from config import VOICE_RETRY_MAX_ATTEMPTS
+
+APPT_DATE = (datetime.now() + timedelta(days=3)).strftime("%Y-%m-%d")
+GROUP = f"{APPT_DATE}:1140,1141"
+
+
+def _make_due(redis_conn):
+    redis_conn.zadd(RETRY_KEY, {GROUP: 0})
+
+
+def test_first_no_answer_is_scheduled(redis_conn):
+    assert schedule_retry("U1", APPT_DATE, [1141, 1140], reason="no_answer") is True
+    assert redis_conn.zscore(RETRY_KEY, GROUP) > time.time()
+    assert int(redis_conn.hget(COUNT_KEY, GROUP)) == 1
+    assert sorted(json.loads(redis_conn.hget(ITEMS_KEY, GROUP))["ticket_ids"]) == [1140, 1141]
+
+
+def test_retries_stop_at_dial_cap(redis_conn):
+    scheduled = 0
+    for _ in range(VOICE_RETRY_MAX_ATTEMPTS + 1):
+        if not schedule_retry("U1", APPT_DATE, [1140, 1141], reason="busy"):
+            break
+        scheduled += 1
+        _make_due(redis_conn)
+        assert feed_due_retries() == 1
+
+    # 第一通 + (上限 - 1) 次重撥
+    assert scheduled == VOICE_RETRY_MAX_ATTEMPTS - 1
+    assert int(redis_conn.hget(COUNT_KEY, GROUP)) == VOICE_RETRY_MAX_ATTEMPTS
+    assert not redis_conn.zcard(RETRY_KEY)
+
+
+def test_feed_submits_to_dialer_once(redis_conn):
+    schedule_retry("U1", APPT_DATE, [1140, 1141], reason="no_answer")
+    _make_due(redis_conn)
+    assert feed_due_retries() == 1
+    assert feed_due_retries() == 0
+    assert redis_conn.zrange(PENDING_KEY, 0, -1) == [b"tickets:1140,1141"]
+    item = json.loads(redis_conn.hget(PENDING_ITEMS_KEY, "tickets:1140,1141"))
+    assert item["attempts"] == 1
+    assert int(redis_conn.hget(COUNT_KEY, GROUP)) == 2
+
+
+def test_not_scheduled_past_appointment_day(redis_conn):
+    today = datetime.now().strftime("%Y-%m-%d")
+    assert schedule_retry("U1", today, [1140], reason="no_answer") is False
+    assert not redis_conn.zcard(RETRY_KEY)
+
+
+def test_webhook_flush_schedules_retry_even_when_zendesk_attempts_is_high(redis_conn, monkeypatch):
+    # D-3 排隊 + D-1 鎖單 + 這次回寫：reminder_attempts 已經是 3，第一次沒接仍然要排重撥
+    monkeypatch.setattr(
+        flows_voice_webhook,
+        "mark_zendesk_tickets_voice_attempted",
+        lambda ticket_ids, **kwargs: {int(t): 3 for t in ticket_ids},
+    )
+    redis_conn.hset(f"{flows_voice_webhook.CALL_PREFIX}c1", mapping={
+        "ticket_ids": json.dumps([1140, 1141]),
+        "status": "no_answer",
+        "terminal": "1",
+        "appt_date": APPT_DATE,
+        "line_user_id": "U1",
+        "updated_at": time.time() - 60,
+    })
+
+    assert flows_voice_webhook.flush_voice_call("c1") is True
+    assert redis_conn.zscore(RETRY_KEY, GROUP) is not None
+
+
+@pytest.mark.parametrize("status", ["success", "completed"])
+def test_webhook_flush_does_not_retry_answered_calls(redis_conn, monkeypatch, status):
+    monkeypatch.setattr(
+        flows_voice_webhook,
+        "mark_zendesk_tickets_voice_attempted",
+        lambda ticket_ids, **kwargs: {int(t): 3 for t in ticket_ids},
+    )
+    redis_conn.hset(f"{flows_voice_webhook.CALL_PREFIX}c1", mapping={
+        "ticket_ids": json.dumps([1140, 1141]),
+        "status": status,
+        "terminal": "1",
+        "appt_date": APPT_DATE,
+        "updated_at": time.time() - 60,
+    })
+
+    assert flows_voice_webhook.flush_voice_call("c1") is True
+    assert not redis_conn.zcard(RETRY_KEY)
@@ -8,7 +8,6 @@ from linebot.v3.messaging import (
 
 from line_client import line_bot_api
 from config import (
-    PENDING_REGISTRATIONS,
     CONFIRM_OPEN_DAYS_BEFORE, # 原本 2，現在 +1
     CANCEL_DEADLINE_DAYS_BEFORE,
     ZENDESK_UF_LINE_USER_ID_KEY,
@@ -24,7 +23,7 @@ from config import is_valid_name
 
 from flask import current_app as app
 
-from state_store import clear_state
+from state_store import set_state, clear_state
 
 
 def parse_ticket_ids(raw_ticket_ids):
@@ -90,14 +89,14 @@ def reply_consent_input(*, line_bot_api, event, title: str, text: str, ok_data:
         )
     )
 
-def enter_input_step(*, line_bot_api, pending_dict: dict, event, line_user_id: str, step: str, prompt_text: str, extra_state: dict | None = None):
+def enter_input_step(*, line_bot_api, event, line_user_id: str, step: str, prompt_text: str, extra_state: dict | None = None):
     """
     進入某個輸入 step，並立刻回一則文字提示「可以開始輸入」。
     """
     state = {"step": step}
     if extra_state:
         state.update(extra_state)
-    pending_dict[line_user_id] = state
+    set_state(line_user_id, state)
 
     app.logger.info(f"[enter_input_step] uid={line_user_id} step={step} extra={bool(extra_state)}")
 
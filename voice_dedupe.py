@@ -0,0 +1,44 @@
+# voice_dedupe.py
+from flask import current_app as app
+
+from queue_core import redis_conn
+
+from config import VOICE_CALLBACK_DEDUPE_TTL_SEC
+
+PREFIX = "linebot:voice:dedupe:"   # {call_id}:{ticket_id}:{status}，存在 = 這個結果已經回寫過 Zendesk
+
+
+def _key(call_id: str, ticket_id: int, status: str) -> str:
+    return f"{PREFIX}{call_id}:{int(ticket_id)}:{(status or '').strip().lower()}"
+
+
+def claim_voice_outcomes(call_id: str, ticket_ids: list[int], status: str) -> list[int]:
+    """
+    SET NX 佔住 (call_id, ticket_id, status)，回傳第一次看到的 ticket_ids（只有這些需要碰 Zendesk）。
+    Redis 出問題時全部放行，交給 Zendesk 上 last_call_id 的檢查。
+    """
+    ids = [int(t) for t in ticket_ids if t]
+    if not call_id or not ids:
+        return ids
+    try:
+        pipe = redis_conn.pipeline()
+        for tid in ids:
+            pipe.set(_key(call_id, tid, status), "1", nx=True, ex=VOICE_CALLBACK_DEDUPE_TTL_SEC)
+        claimed = pipe.execute()
+    except Exception as e:
+        app.logger.warning(f"[voice_dedupe] dedupe 檢查失敗，照常回寫 call_id={call_id}: {e}")
+        return ids
+    return [tid for tid, ok in zip(ids, claimed) if ok]
+
+
+def release_voice_outcomes(call_id: str, ticket_ids: list[int], status: str) -> None:
+    """
+    Zendesk 回寫失敗時呼叫：放掉佔位，下次重送 / 重試才會再寫。
+    """
+    ids = [int(t) for t in ticket_ids if t]
+    if not call_id or not ids:
+        return
+    try:
+        redis_conn.delete(*[_key(call_id, tid, status) for tid in ids])
+    except Exception as e:
+        app.logger.warning(f"[voice_dedupe] 清除佔位失敗 call_id={call_id} tickets={ids}: {e}")
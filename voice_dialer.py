@@ -0,0 +1,254 @@
+# voice_dialer.py
+import json
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app as app
+
+from queue_core import redis_conn, voice_call_queue
+
+from config import (
+    VOICE_MAX_INFLIGHT_CALLS,
+    VOICE_CALL_WINDOW_START,
+    VOICE_CALL_WINDOW_END,
+    VOICE_CALL_STALE_SEC,
+    VOICE_PRIORITY_ATTEMPT_PENALTY_SEC,
+    VOICE_PRIORITY_DEFAULT_TIME,
+)
+
+PENDING_KEY = "linebot:voice:dial:queue"       # ZSET：等著撥的組（tickets:1,2,3），score = 優先順序（越小越先撥）
+PENDING_ITEMS_KEY = "linebot:voice:dial:queue:items"  # HASH：tickets:1,2,3 → 撥號要用的資料（JSON）
+APPT_START_KEY = "linebot:voice:dial:appt_start"  # HASH：ticket 組 → 約診開始時間（重撥沒帶時間時查這裡）
+APPT_START_TTL_SEC = 3 * 24 * 60 * 60
+INFLIGHT_KEY = "linebot:voice:dial:inflight"   # ZSET：正在通話的 slot，score = 開始時間
+
+# 清掉太久沒收到結束 webhook 的 slot，還有空位才佔一個
+_RESERVE_SLOT_LUA = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[2] - ARGV[3])
+if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[1]) then
+    redis.call('ZADD', KEYS[1], ARGV[2], ARGV[4])
+    return 1
+end
+return 0
+"""
+_reserve_slot = redis_conn.register_script(_RESERVE_SLOT_LUA)
+
+# 拿出優先順序最前面的一組，連同資料一起從佇列拿掉（同一組只會被一個 pump 拿到）
+_POP_PENDING_LUA = """
+local popped = redis.call('ZPOPMIN', KEYS[1])
+if #popped == 0 then
+    return false
+end
+local item = redis.call('HGET', KEYS[2], popped[1])
+redis.call('HDEL', KEYS[2], popped[1])
+return {popped[1], popped[2], item}
+"""
+_pop_pending = redis_conn.register_script(_POP_PENDING_LUA)
+
+
+def _tickets_member(ticket_ids) -> str:
+    # 還不知道 call_id 時用 ticket_ids 佔位（webhook 也會帶 ticketIds 回來）
+    return "tickets:" + ",".join(str(int(t)) for t in sorted(ticket_ids) if t)
+
+
+def _call_member(call_id: str) -> str:
+    return f"call:{call_id}"
+
+
+def _parse_hhmm(v: str) -> tuple[int, int]:
+    h, _, m = (v or "").partition(":")
+    return int(h), int(m or 0)
+
+
+def in_calling_window(now: datetime | None = None) -> bool:
+    """
+    現在是否在可以打電話的時段（VOICE_CALL_WINDOW_START ~ VOICE_CALL_WINDOW_END，本地時間）。
+    """
+    now = now or datetime.now()
+    sh, sm = _parse_hhmm(VOICE_CALL_WINDOW_START)
+    eh, em = _parse_hhmm(VOICE_CALL_WINDOW_END)
+    start = now.replace(hour=sh, minute=sm, second=0, microsecond=0)
+    end = now.replace(hour=eh, minute=em, second=0, microsecond=0)
+    return start <= now < end
+
+
+def _appt_start_ts(appt_date: str, appt_time: str | None, member: str) -> float:
+    """
+    約診開始時間（epoch 秒）：有帶時間就用，沒有就查之前記過的，再沒有用 VOICE_PRIORITY_DEFAULT_TIME。
+    """
+    if appt_time:
+        try:
+            return datetime.strptime(f"{appt_date} {appt_time}", "%Y-%m-%d %H:%M").timestamp()
+        except ValueError:
+            pass
+    known = redis_conn.hget(APPT_START_KEY, member)
+    if known:
+        return float(known)
+    try:
+        day = datetime.strptime(appt_date, "%Y-%m-%d")
+    except ValueError:
+        day = datetime.now()
+    h, m = _parse_hhmm(VOICE_PRIORITY_DEFAULT_TIME)
+    return (day + timedelta(hours=h, minutes=m)).timestamp()
+
+
+def _priority(appt_start_ts: float, attempts: int) -> float:
+    # 約診越早越先撥；每多撥過一次往後排 VOICE_PRIORITY_ATTEMPT_PENALTY_SEC（讓還沒撥過的人先拿到線路）
+    return appt_start_ts + max(int(attempts or 0), 0) * VOICE_PRIORITY_ATTEMPT_PENALTY_SEC
+
+
+def submit_dial(
+    line_user_id: str,
+    appt_date: str,
+    ticket_ids: list[int],
+    dial_target: dict | None = None,
+    appt_time: str | None = None,
+    attempts: int = 0,
+) -> None:
+    """
+    把一組（同一人同一天）排進撥號佇列，實際什麼時候撥由 pump_dialer 決定。
+    - dial_target：scheduler 已經查好的 name / phone / attempts，job 就不用再查 Zendesk
+    - appt_time（HH:MM）/ attempts：決定優先順序，有空的 slot 先給約診最早、撥過最少次的人
+    佇列用 ticket 組當 key：同一組還沒撥就又送進來（cron 重跑、重撥跟重掃重疊）只會更新那一筆，不會撥兩次。
+    """
+    ids = [int(t) for t in ticket_ids if t]
+    member = _tickets_member(ids)
+    start_ts = _appt_start_ts(appt_date, appt_time, member)
+    if dial_target is None:
+        # 重撥沒帶 dial_target：沿用佇列裡那筆已經查好的
+        old = redis_conn.hget(PENDING_ITEMS_KEY, member)
+        if old:
+            dial_target = json.loads(old).get("dial_target")
+    item = {
+        "line_user_id": line_user_id,
+        "appt_date": appt_date,
+        "ticket_ids": ids,
+        "dial_target": dial_target,
+        "attempts": int(attempts or 0),
+        "queued_at": time.time(),
+    }
+    pipe = redis_conn.pipeline()
+    pipe.hset(PENDING_ITEMS_KEY, member, json.dumps(item, ensure_ascii=False))
+    pipe.zadd(PENDING_KEY, {member: _priority(start_ts, attempts)})
+    pipe.hset(APPT_START_KEY, member, start_ts)
+    pipe.expire(APPT_START_KEY, APPT_START_TTL_SEC)
+    pipe.execute()
+
+
+def _requeue(member: str, raw, score: float) -> None:
+    # 放回佇列；拿出來之後同一組又被送進來的話，以新的那筆為準
+    pipe = redis_conn.pipeline()
+    pipe.hsetnx(PENDING_ITEMS_KEY, member, raw)
+    pipe.zadd(PENDING_KEY, {member: score}, nx=True)
+    pipe.execute()
+
+
+def pump_dialer() -> int:
+    """
+    有空的 slot 就從佇列拿優先順序最前面的一組，排一個 voice job 去撥；回傳這次開始撥幾通。
+    - 同時在通話的數量不超過 VOICE_MAX_INFLIGHT_CALLS（slot 要等 webhook 回報結束才釋放）
+    - 不在撥號時段就不動，等下一次 /cron/voice-dialer/pump
+    scan 完、每通電話結束、cron 都會呼叫這裡。
+    """
+    if not in_calling_window():
+        app.logger.info("[voice_dialer] 不在撥號時段，暫不撥號")
+        return 0
+
+    started = 0
+    while True:
+        popped = _pop_pending(keys=[PENDING_KEY, PENDING_ITEMS_KEY])
+        if not popped:
+            break
+        member, score, raw = popped
+        member = member.decode() if isinstance(member, bytes) else member
+        score = float(score)
+        try:
+            item = json.loads(raw)
+        except Exception:
+            app.logger.error(f"[voice_dialer] 佇列資料壞掉，丟掉 {member}: {raw!r}")
+            continue
+
+        now = time.time()
+        if not _reserve_slot(keys=[INFLIGHT_KEY], args=[VOICE_MAX_INFLIGHT_CALLS, now, VOICE_CALL_STALE_SEC, member]):
+            # 滿了：用原本的優先順序放回去，等有通話結束再撥
+            _requeue(member, raw, score)
+            break
+
+        try:
+            voice_call_queue.enqueue(
+                "flows_voice_calls.dial_voice_call_group",
+                item["line_user_id"],
+                item["appt_date"],
+                item["ticket_ids"],
+                item.get("dial_target"),
+            )
+        except Exception as e:
+            app.logger.error(f"[voice_dialer] enqueue 失敗，放回佇列 tickets={item['ticket_ids']}: {e}")
+            redis_conn.zrem(INFLIGHT_KEY, member)
+            _requeue(member, raw, score)
+            break
+        started += 1
+
+    if started:
+        app.logger.info(f"[voice_dialer] 開始撥號 {started} 組，inflight={redis_conn.zcard(INFLIGHT_KEY)}")
+    return started
+
+
+def mark_call_started(ticket_ids: list[int], call_id: str | None) -> None:
+    """
+    LiveHub 接受撥號後呼叫：slot 改用 call_id 記，之後 webhook 用 call_id 釋放。
+    """
+    if not call_id:
+        return
+    member = _tickets_member(ticket_ids)
+    score = redis_conn.zscore(INFLIGHT_KEY, member) or time.time()
+    pipe = redis_conn.pipeline()
+    pipe.zrem(INFLIGHT_KEY, member)
+    pipe.zadd(INFLIGHT_KEY, {_call_member(call_id): score})
+    pipe.execute()
+
+
+def release_call(call_id: str | None = None, ticket_ids: list[int] | None = None) -> None:
+    """
+    通話結束（webhook）或撥號失敗時釋放 slot，馬上補下一通。
+    """
+    members = []
+    if call_id:
+        members.append(_call_member(call_id))
+    if ticket_ids:
+        members.append(_tickets_member(ticket_ids))
+    if not members:
+        return
+    try:
+        removed = redis_conn.zrem(INFLIGHT_KEY, *members)
+    except Exception as e:
+        app.logger.error(f"[voice_dialer] 釋放 slot 失敗 call_id={call_id} tickets={ticket_ids}: {e}")
+        return
+    if removed:
+        pump_dialer()
+
+
+def get_dialer_status() -> dict:
+    now = time.time()
+    inflight = redis_conn.zrange(INFLIGHT_KEY, 0, -1, withscores=True) or []
+    head = redis_conn.zrange(PENDING_KEY, 0, 4, withscores=True) or []
+    raws = redis_conn.hmget(PENDING_ITEMS_KEY, [m for m, _ in head]) if head else []
+    return {
+        "in_window": in_calling_window(),
+        "window": f"{VOICE_CALL_WINDOW_START}-{VOICE_CALL_WINDOW_END}",
+        "max_inflight": VOICE_MAX_INFLIGHT_CALLS,
+        "pending": redis_conn.zcard(PENDING_KEY),
+        "next": [
+            {
+                **{k: item.get(k) for k in ("ticket_ids", "appt_date", "attempts")},
+                "priority": datetime.fromtimestamp(score).strftime("%Y-%m-%d %H:%M"),
+            }
+            for item, score in (
+                (json.loads(raw or "{}"), score) for raw, (_, score) in zip(raws, head)
+            )
+        ],
+        "inflight": [
+            {"slot": (m.decode() if isinstance(m, bytes) else m), "age_sec": round(now - s, 1)}
+            for m, s in inflight
+        ],
+    }
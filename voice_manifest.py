@@ -0,0 +1,237 @@
+# voice_manifest.py
+import json
+from datetime import datetime, timedelta
+
+from flask import current_app as app
+
+from queue_core import redis_conn
+
+# D-3 LINE 提醒推播成功時順便寫好 D-1 要撥的名單，D-1 外撥直接讀這裡，不用再掃 Zendesk
+MANIFEST_PREFIX = "linebot:voice:manifest:"          # HASH：requester_id -> 這個人當天要撥的資料（JSON）
+READY_PREFIX = "linebot:voice:manifest:ready:"       # STRING：D-3 掃描整輪成功跑完才設（沒有這個就退回掃 Zendesk）
+PENDING_PREFIX = "linebot:voice:manifest:pending:"   # STRING：已 enqueue、還沒寫完名單的 group job 數
+DIRTY_PREFIX = "linebot:voice:manifest:dirty:"       # STRING：有 group 寫名單失敗，這天的名單不可信
+BOOKING_PREFIX = "linebot:voice:manifest:booking:"   # STRING：booking_id -> "appt_date|requester_id|ticket_id"（確認 / 取消時找條目用）
+
+# 同一個 requester 可能分在不同 group job：合併 tickets，約診時間取最早
+_MERGE_LUA = """
+local incoming = cjson.decode(ARGV[2])
+local raw = redis.call('HGET', KEYS[1], ARGV[1])
+if raw then
+    local entry = cjson.decode(raw)
+    for tid, t in pairs(incoming['tickets']) do
+        entry['tickets'][tid] = t
+    end
+    if incoming['appt_time'] ~= '' and (entry['appt_time'] == '' or incoming['appt_time'] < entry['appt_time']) then
+        entry['appt_time'] = incoming['appt_time']
+    end
+    incoming = entry
+end
+redis.call('HSET', KEYS[1], ARGV[1], cjson.encode(incoming))
+redis.call('EXPIREAT', KEYS[1], ARGV[3])
+return 1
+"""
+
+# 拿掉一張 ticket；這個人沒有 ticket 了就整筆刪掉（D-1 就不會撥給他）
+_REMOVE_LUA = """
+local raw = redis.call('HGET', KEYS[1], ARGV[1])
+if not raw then
+    return 0
+end
+local entry = cjson.decode(raw)
+if entry['tickets'][ARGV[2]] == nil then
+    return 0
+end
+entry['tickets'][ARGV[2]] = nil
+if next(entry['tickets']) == nil then
+    redis.call('HDEL', KEYS[1], ARGV[1])
+else
+    redis.call('HSET', KEYS[1], ARGV[1], cjson.encode(entry))
+end
+return 1
+"""
+
+_merge = redis_conn.register_script(_MERGE_LUA)
+_remove = redis_conn.register_script(_REMOVE_LUA)
+
+
+def _expire_at(appt_date: str) -> int:
+    # 約診日隔天就沒用了（重撥也不會排過約診日）
+    try:
+        day = datetime.strptime(appt_date, "%Y-%m-%d")
+    except ValueError:
+        day = datetime.now()
+    return int((day + timedelta(days=2)).timestamp())
+
+
+def mark_manifest_ready(appt_date: str) -> None:
+    """
+    D-3 提醒掃描「整輪成功、沒有錯誤」跑完時呼叫：這天的名單由 manifest 負責。
+    就算最後每個人都確認 / 取消（名單是空的），D-1 也知道不用再掃 Zendesk。
+    掃描中途失敗就不會設，D-1 會退回掃 Zendesk。
+    """
+    try:
+        redis_conn.set(f"{READY_PREFIX}{appt_date}", 1)
+        redis_conn.expireat(f"{READY_PREFIX}{appt_date}", _expire_at(appt_date))
+    except Exception as e:
+        app.logger.warning(f"[voice_manifest] 標記名單失敗 appt_date={appt_date}: {e}")
+
+
+def expect_manifest_group(appt_date: str, n: int = 1) -> None:
+    """
+    enqueue 一個 process_reminder_group 前 +1；那個 job 寫完名單（或確定不用寫）時由 manifest_group_done -1。
+    job 中途掛掉就一直 > 0，D-1 不會相信這份不完整的名單。
+    """
+    key = f"{PENDING_PREFIX}{appt_date}"
+    pipe = redis_conn.pipeline()
+    pipe.incrby(key, n)
+    pipe.expireat(key, _expire_at(appt_date))
+    pipe.execute()
+
+
+def manifest_group_done(appt_date: str, ok: bool = True) -> None:
+    """
+    group job 結束時呼叫；ok=False（名單沒寫完整）會把這天標成 dirty，D-1 改掃 Zendesk。
+    """
+    try:
+        pipe = redis_conn.pipeline()
+        if not ok:
+            pipe.set(f"{DIRTY_PREFIX}{appt_date}", 1)
+            pipe.expireat(f"{DIRTY_PREFIX}{appt_date}", _expire_at(appt_date))
+        pipe.decr(f"{PENDING_PREFIX}{appt_date}")
+        pipe.execute()
+    except Exception as e:
+        app.logger.warning(f"[voice_manifest] 更新 group 狀態失敗 appt_date={appt_date}: {e}")
+    if not ok:
+        app.logger.warning(f"[voice_manifest] appt_date={appt_date} 名單寫入不完整，D-1 會改掃 Zendesk")
+
+
+def manifest_ready(appt_date: str) -> bool:
+    """
+    D-1 能不能只讀名單：D-3 整輪成功 + 沒有還沒寫完的 group job + 沒有寫入失敗。
+    """
+    pipe = redis_conn.pipeline()
+    pipe.exists(f"{READY_PREFIX}{appt_date}")
+    pipe.get(f"{PENDING_PREFIX}{appt_date}")
+    pipe.exists(f"{DIRTY_PREFIX}{appt_date}")
+    ready, pending, dirty = pipe.execute()
+    return bool(ready) and int(pending or 0) <= 0 and not dirty
+
+
+def add_to_manifest(
+    appt_date: str,
+    requester_id: int,
+    line_user_id: str,
+    user: dict | None,
+    phone: str | None,
+    tickets: list[dict],
+) -> bool:
+    """
+    寫入一個人的 D-1 外撥資料。
+    tickets：[{"ticket_id": 1140, "booking_id": "...", "attempts": 1, "appt_time": "14:00"}, ...]
+    失敗只記 log（D-1 還可以用 ?source=zendesk 重掃）。
+    """
+    tickets = [t for t in tickets if t.get("ticket_id")]
+    if not requester_id or not tickets:
+        return False
+
+    times = [t["appt_time"] for t in tickets if t.get("appt_time")]
+    entry = {
+        "requester_id": int(requester_id),
+        "line_user_id": line_user_id,
+        "name": (user or {}).get("name") or "貴賓",
+        "phone": phone,
+        "appt_date": appt_date,
+        "appt_time": min(times) if times else "",
+        "tickets": {
+            str(int(t["ticket_id"])): {"booking_id": t.get("booking_id"), "attempts": int(t.get("attempts") or 0)}
+            for t in tickets
+        },
+    }
+    expire_at = _expire_at(appt_date)
+    try:
+        _merge(
+            keys=[f"{MANIFEST_PREFIX}{appt_date}"],
+            args=[str(int(requester_id)), json.dumps(entry, ensure_ascii=False), expire_at],
+        )
+        pipe = redis_conn.pipeline()
+        for t in tickets:
+            if not t.get("booking_id"):
+                continue
+            key = f"{BOOKING_PREFIX}{t['booking_id']}"
+            pipe.set(key, f"{appt_date}|{int(requester_id)}|{int(t['ticket_id'])}")
+            pipe.expireat(key, expire_at)
+        pipe.execute()
+    except Exception as e:
+        app.logger.error(
+            f"[voice_manifest] 寫入失敗 appt_date={appt_date} requester_id={requester_id}: {e}"
+        )
+        return False
+    return True
+
+
+def remove_booking_from_manifest(booking_id: str | None) -> bool:
+    """
+    病人按「確認回診」或「取消約診」時呼叫：把這筆約診從 D-1 名單拿掉，回傳有沒有拿掉。
+    """
+    if not booking_id:
+        return False
+    try:
+        ref = redis_conn.get(f"{BOOKING_PREFIX}{booking_id}")
+        if not ref:
+            return False
+        ref = ref.decode() if isinstance(ref, bytes) else ref
+        appt_date, requester_id, ticket_id = ref.split("|")
+        removed = bool(_remove(keys=[f"{MANIFEST_PREFIX}{appt_date}"], args=[requester_id, ticket_id]))
+        redis_conn.delete(f"{BOOKING_PREFIX}{booking_id}")
+    except Exception as e:
+        app.logger.warning(f"[voice_manifest] 移除失敗 booking_id={booking_id}: {e}")
+        return False
+
+    if removed:
+        app.logger.info(
+            f"[voice_manifest] 已從 D-1 名單移除 booking_id={booking_id} ticket_id={ticket_id} date={appt_date}"
+        )
+    return removed
+
+
+def iter_manifest(appt_date: str):
+    """
+    用 HSCAN 一批一批讀出這天還留在名單上的人（不一次載入全部）。
+    每筆：{"requester_id", "line_user_id", "appt_date", "appt_time", "ticket_ids", "dial_target"}
+    """
+    for _, raw in redis_conn.hscan_iter(f"{MANIFEST_PREFIX}{appt_date}", count=200):
+        try:
+            entry = json.loads(raw)
+        except Exception:
+            app.logger.error(f"[voice_manifest] 名單資料壞掉，略過: {raw!r}")
+            continue
+        tickets = entry.get("tickets") or {}
+        if not tickets:
+            continue
+        yield {
+            "requester_id": entry["requester_id"],
+            "line_user_id": entry.get("line_user_id") or "U_auto",
+            "appt_date": entry.get("appt_date") or appt_date,
+            "appt_time": entry.get("appt_time") or None,
+            "ticket_ids": sorted(int(tid) for tid in tickets),
+            "dial_target": {
+                "patient_name": entry.get("name") or "貴賓",
+                "phone": entry.get("phone"),
+                "requester_id": entry["requester_id"],
+                "ticket_attempts": {tid: int(t.get("attempts") or 0) for tid, t in tickets.items()},
+            },
+        }
+
+
+def get_manifest_status(appt_date: str) -> dict:
+    key = f"{MANIFEST_PREFIX}{appt_date}"
+    return {
+        "appt_date": appt_date,
+        "ready": manifest_ready(appt_date),
+        "scan_done": bool(redis_conn.exists(f"{READY_PREFIX}{appt_date}")),
+        "groups_pending": int(redis_conn.get(f"{PENDING_PREFIX}{appt_date}") or 0),
+        "dirty": bool(redis_conn.exists(f"{DIRTY_PREFIX}{appt_date}")),
+        "requesters": redis_conn.hlen(key),
+        "ttl_sec": redis_conn.ttl(key),
+    }
@@ -0,0 +1,171 @@
+# voice_outcomes.py
+import json
+import time
+import uuid
+from datetime import datetime
+
+from flask import current_app as app
+
+from queue_core import redis_conn
+
+STREAM_KEY = "linebot:voice:outcomes"            # STREAM：dial / status / final 每一筆事件
+STREAM_MAXLEN = 100000
+CALL_PREFIX = "linebot:voice:outcome:"           # HASH：每通電話的摘要
+DAY_PREFIX = "linebot:voice:outcomes:day:"       # ZSET：那天撥出的 call_id，score = 撥號時間
+KEEP_SEC = 30 * 24 * 60 * 60
+
+# 這些狀態代表對方有接起來（算 connect）
+_CONNECTED_STATUSES = {"answered", "connected", "success", "completed", "ok"}
+
+
+def _day(ts: float) -> str:
+    return datetime.fromtimestamp(ts).strftime("%Y-%m-%d")
+
+
+def _log(pipe, kind: str, call_id: str, ts: float, **fields) -> None:
+    entry = {"type": kind, "call_id": call_id, "ts": f"{ts:.3f}"}
+    entry.update({k: str(v) for k, v in fields.items() if v is not None})
+    pipe.xadd(STREAM_KEY, entry, maxlen=STREAM_MAXLEN, approximate=True)
+
+
+def record_dial(
+    call_id: str | None,
+    ticket_ids: list[int],
+    appt_date: str,
+    requested_at: float,
+    latency_ms: float,
+    ok: bool,
+) -> None:
+    """
+    LiveHub dialout 打完呼叫：撥號時間、LiveHub 回應耗時、有沒有接受。
+    沒拿到 call_id（撥號失敗）也記一筆，connect rate 的分母才對。
+    """
+    call_id = call_id or f"dialfail:{uuid.uuid4().hex[:12]}"
+    key = f"{CALL_PREFIX}{call_id}"
+    try:
+        pipe = redis_conn.pipeline()
+        _log(pipe, "dial", call_id, requested_at, latency_ms=round(latency_ms, 1), ok=int(ok), appt_date=appt_date)
+        pipe.hset(key, mapping={
+            "ticket_ids": json.dumps([int(t) for t in ticket_ids if t]),
+            "appt_date": appt_date or "",
+            "dial_requested_at": requested_at,
+            "livehub_latency_ms": round(latency_ms, 1),
+            "dial_ok": int(ok),
+        })
+        if not ok:
+            pipe.hset(key, mapping={"final_status": "dialout_failed", "final_outcome": "failed", "final_at": time.time()})
+        pipe.expire(key, KEEP_SEC)
+        day_key = f"{DAY_PREFIX}{_day(requested_at)}"
+        pipe.zadd(day_key, {call_id: requested_at})
+        pipe.expire(day_key, KEEP_SEC)
+        pipe.execute()
+    except Exception as e:
+        app.logger.warning(f"[voice_outcomes] 記錄撥號失敗 call_id={call_id}: {e}")
+
+
+def record_status(call_id: str, status: str, ts: float) -> None:
+    """
+    每個 LiveHub webhook 都記一筆狀態變化；第一次出現接通狀態時記 answered_at。
+    """
+    key = f"{CALL_PREFIX}{call_id}"
+    status = (status or "").strip().lower()
+    try:
+        pipe = redis_conn.pipeline()
+        _log(pipe, "status", call_id, ts, status=status)
+        pipe.hsetnx(key, "first_event_at", ts)
+        pipe.hincrby(key, "transitions", 1)
+        pipe.hset(key, "last_status", status)
+        if status in _CONNECTED_STATUSES:
+            pipe.hsetnx(key, "answered_at", ts)
+        pipe.expire(key, KEEP_SEC)
+        # 不是從 dialer 撥出的（例如 demo），用第一個 event 的時間歸到那天
+        day_key = f"{DAY_PREFIX}{_day(ts)}"
+        pipe.zadd(day_key, {call_id: ts}, nx=True)
+        pipe.expire(day_key, KEEP_SEC)
+        pipe.execute()
+    except Exception as e:
+        app.logger.warning(f"[voice_outcomes] 記錄狀態失敗 call_id={call_id}: {e}")
+
+
+def record_final(call_id: str, status: str, outcome: str) -> None:
+    """
+    一通電話的最終結果（flush_voice_call 回寫 Zendesk 時）。outcome：success / failed / attempted
+    """
+    key = f"{CALL_PREFIX}{call_id}"
+    now = time.time()
+    try:
+        pipe = redis_conn.pipeline()
+        _log(pipe, "final", call_id, now, status=status, outcome=outcome)
+        pipe.hset(key, mapping={"final_status": (status or "").strip().lower(), "final_outcome": outcome, "final_at": now})
+        pipe.expire(key, KEEP_SEC)
+        pipe.execute()
+    except Exception as e:
+        app.logger.warning(f"[voice_outcomes] 記錄結果失敗 call_id={call_id}: {e}")
+
+
+def _percentiles(values: list[float]) -> dict:
+    if not values:
+        return {"count": 0, "p50": None, "p90": None, "p99": None, "max": None}
+    values = sorted(values)
+
+    def pick(p: float) -> float:
+        return round(values[min(len(values) - 1, int(round(p * (len(values) - 1))))], 1)
+
+    return {"count": len(values), "p50": pick(0.5), "p90": pick(0.9), "p99": pick(0.99), "max": round(values[-1], 1)}
+
+
+def get_day_summary(day: str) -> dict:
+    """
+    某天（撥號日，YYYY-MM-DD）所有通話的統計：
+    - dialed / accepted（LiveHub 接受）/ connected（有接起來）/ connect_rate
+    - livehub_latency_ms：dialout API 的回應時間
+    - time_to_answer_sec：撥號到接起來；time_to_final_sec：撥號到最終結果
+    - outcomes：最終結果分布（還沒結束的算 pending）
+    """
+    call_ids = redis_conn.zrange(f"{DAY_PREFIX}{day}", 0, -1) or []
+    pipe = redis_conn.pipeline()
+    for cid in call_ids:
+        pipe.hgetall(f"{CALL_PREFIX}{cid.decode() if isinstance(cid, bytes) else cid}")
+    rows = pipe.execute() if call_ids else []
+
+    dialed = accepted = connected = 0
+    latency, to_answer, to_final = [], [], []
+    outcomes: dict[str, int] = {}
+    statuses: dict[str, int] = {}
+    for raw in rows:
+        row = {(k.decode() if isinstance(k, bytes) else k): (v.decode() if isinstance(v, bytes) else v)
+               for k, v in (raw or {}).items()}
+        if not row:
+            continue
+        started = float(row["dial_requested_at"]) if row.get("dial_requested_at") else None
+        if started is not None:
+            dialed += 1
+            if row.get("livehub_latency_ms"):
+                latency.append(float(row["livehub_latency_ms"]))
+            if row.get("dial_ok") == "1":
+                accepted += 1
+        if row.get("answered_at") or row.get("final_outcome") == "success":
+            connected += 1
+        if row.get("answered_at") and started is not None:
+            to_answer.append(float(row["answered_at"]) - started)
+        if row.get("final_at") and started is not None:
+            to_final.append(float(row["final_at"]) - started)
+        outcome = row.get("final_outcome") or "pending"
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        final_status = row.get("final_status") or row.get("last_status")
+        if final_status:
+            statuses[final_status] = statuses.get(final_status, 0) + 1
+
+    return {
+        "date": day,
+        "calls": len(rows),
+        "dialed": dialed,
+        "accepted": accepted,
+        "connected": connected,
+        "connect_rate": round(connected / dialed, 4) if dialed else 0.0,
+        "livehub_latency_ms": _percentiles(latency),
+        "time_to_answer_sec": _percentiles(to_answer),
+        "time_to_final_sec": _percentiles(to_final),
+        "outcomes": outcomes,
+        "final_statuses": statuses,
+    }
@@ -0,0 +1,123 @@
+# voice_retry.py
+import json
+import time
+from datetime import datetime
+
+from flask import current_app as app
+
+from queue_core import redis_conn
+from voice_dialer import submit_dial
+
+from config import VOICE_RETRY_BACKOFF_SEC, VOICE_RETRY_MAX_ATTEMPTS
+
+RETRY_KEY = "linebot:voice:retry"             # ZSET：group -> 什麼時候重撥（epoch 秒）
+ITEMS_KEY = "linebot:voice:retry:items"       # HASH：group -> {"line_user_id", "appt_date", "ticket_ids", "dials"}
+COUNT_KEY = "linebot:voice:retry:dials"       # HASH：group -> 這組已經撥過幾次（含第一次）
+COUNT_TTL_SEC = 7 * 24 * 60 * 60
+
+# 同一組只能被一個 feeder 拿走：ZREM 成功的人才送去撥
+_CLAIM_LUA = """
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 1 then
+    local item = redis.call('HGET', KEYS[2], ARGV[1])
+    redis.call('HDEL', KEYS[2], ARGV[1])
+    return item
+end
+return false
+"""
+_claim = redis_conn.register_script(_CLAIM_LUA)
+
+
+def _group(appt_date: str, ticket_ids: list[int]) -> str:
+    return f"{appt_date}:" + ",".join(str(int(t)) for t in sorted(ticket_ids) if t)
+
+
+def _backoff_sec(dials: int) -> int:
+    """
+    第 n 次沒接通 → 等 VOICE_RETRY_BACKOFF_SEC[n-1] 秒（超過列表長度就用最後一個）。
+    """
+    steps = [int(x) for x in VOICE_RETRY_BACKOFF_SEC.split(",") if x.strip()] or [1800]
+    return steps[min(max(dials, 1), len(steps)) - 1]
+
+
+def schedule_retry(
+    line_user_id: str,
+    appt_date: str,
+    ticket_ids: list[int],
+    reason: str,
+) -> bool:
+    """
+    沒接 / 忙線 / 撥號失敗時呼叫，排一次重撥；回傳有沒有排。
+    - 次數上限：這組實際撥過的次數（COUNT_KEY，含第一次）到 VOICE_RETRY_MAX_ATTEMPTS 就不再排
+      （不看 Zendesk reminder_attempts：D-3 LINE 提醒、D-1 撥號前鎖單都會 +1，撥第一通前就已經好幾次了）
+    - 重撥時間過了約診日就不排（D-1 提醒已經沒意義）
+    """
+    ids = [int(t) for t in ticket_ids if t]
+    if not ids or not appt_date:
+        return False
+
+    group = _group(appt_date, ids)
+    dials = int(redis_conn.hget(COUNT_KEY, group) or 1)
+    if dials >= VOICE_RETRY_MAX_ATTEMPTS:
+        app.logger.info(f"[voice_retry] 已達重撥上限，不再排 group={group} dials={dials} reason={reason}")
+        return False
+
+    due = time.time() + _backoff_sec(dials)
+    try:
+        appt_day = datetime.strptime(appt_date, "%Y-%m-%d")
+    except ValueError:
+        appt_day = None
+    if appt_day and due >= appt_day.timestamp():
+        app.logger.info(f"[voice_retry] 重撥時間超過約診日，不排 group={group} reason={reason}")
+        return False
+
+    item = {"line_user_id": line_user_id, "appt_date": appt_date, "ticket_ids": ids, "dials": dials}
+    pipe = redis_conn.pipeline()
+    pipe.hset(ITEMS_KEY, group, json.dumps(item, ensure_ascii=False))
+    pipe.zadd(RETRY_KEY, {group: due})
+    # 第一次撥號沒記過次數，先補上（feed 時再 +1）
+    pipe.hsetnx(COUNT_KEY, group, dials)
+    pipe.expire(COUNT_KEY, COUNT_TTL_SEC)
+    pipe.execute()
+    app.logger.info(
+        f"[voice_retry] 排重撥 group={group} reason={reason} dials={dials} due_in={int(due - time.time())}s"
+    )
+    return True
+
+
+def feed_due_retries() -> int:
+    """
+    到時間的重撥送進 voice_dialer 的佇列（不用重掃 Zendesk），回傳送了幾組。
+    /cron/voice-dialer/pump 每次都會先呼叫。
+    """
+    now = time.time()
+    due = redis_conn.zrangebyscore(RETRY_KEY, "-inf", now) or []
+    fed = 0
+    for group in due:
+        group = group.decode() if isinstance(group, bytes) else group
+        raw = _claim(keys=[RETRY_KEY, ITEMS_KEY], args=[group])
+        if not raw:
+            continue
+        item = json.loads(raw)
+        pipe = redis_conn.pipeline()
+        pipe.hincrby(COUNT_KEY, group, 1)
+        pipe.expire(COUNT_KEY, COUNT_TTL_SEC)
+        pipe.execute()
+        # 約診時間由 voice_dialer 查第一次排入時記下的；撥過的次數讓重撥排在還沒撥過的人後面
+        submit_dial(item["line_user_id"], item["appt_date"], item["ticket_ids"], attempts=item.get("dials", 1))
+        fed += 1
+    if fed:
+        app.logger.info(f"[voice_retry] 送出到期重撥 {fed} 組")
+    return fed
+
+
+def get_retry_status() -> dict:
+    now = time.time()
+    rows = redis_conn.zrange(RETRY_KEY, 0, -1, withscores=True) or []
+    return {
+        "scheduled": len(rows),
+        "due": sum(1 for _, s in rows if s <= now),
+        "next": [
+            {"group": (g.decode() if isinstance(g, bytes) else g), "due_in_sec": round(s - now)}
+            for g, s in rows[:20]
+        ],
+    }
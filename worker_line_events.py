@@ -0,0 +1,12 @@
+from dotenv import load_dotenv
+load_dotenv()
+
+from rq import Worker
+from queue_core import redis_conn, line_event_queue
+from app import app
+
+# LINE_WEBHOOK_MODE=rq 時，callback 收到的 event 由這個 worker 處理
+if __name__ == "__main__":
+    with app.app_context():
+        worker = Worker([line_event_queue], connection=redis_conn)
+        worker.work()
@@ -0,0 +1,367 @@
+# worker_pool.py
+"""
+RQ worker pool：一個指令依 queue 長度開 / 關多個 worker process，不用手動多開幾份 worker_*.py。
+
+啟動（預設管 reminders / voice_calls / line_events 三個 queue）：
+    python worker_pool.py
+    python worker_pool.py reminders voice_calls
+
+- 每個 queue 的 worker 數在 min ~ max 之間，依 queue 長度調整（WORKER_POOL_QUEUES，例：reminders:1:4）
+  目標數 = ceil(排隊中的 job / WORKER_POOL_JOBS_PER_WORKER)，變多馬上開，變少要持續 WORKER_POOL_SCALE_DOWN_SEC 才一次關一個
+- worker 掛掉（非正常結束）會自動補開，連續掛掉會越等越久再開
+- SIGTERM / Ctrl-C：叫每個 worker 做完手上的 job 再結束（rq warm shutdown），
+  超過 WORKER_POOL_DRAIN_TIMEOUT_SEC 還沒結束才強制停
+- 每個 worker 的處理量（成功 / 失敗數、每分鐘 job 數、忙碌比例）定期印 log，也寫到 Redis 給 GET /workers/pool 看
+
+voice_calls 開再多 worker 也不會超過 VOICE_MAX_INFLIGHT_CALLS（由 voice_dialer 控制同時通話數）。
+"""
+from dotenv import load_dotenv
+load_dotenv()
+
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import signal
+import socket
+import time
+
+from rq import Queue, Worker
+
+from queue_core import redis_conn
+
+from config import (
+    WORKER_POOL_QUEUES,
+    WORKER_POOL_JOBS_PER_WORKER,
+    WORKER_POOL_CHECK_SEC,
+    WORKER_POOL_SCALE_DOWN_SEC,
+    WORKER_POOL_DRAIN_TIMEOUT_SEC,
+    WORKER_POOL_REPORT_SEC,
+)
+
+STATUS_KEY = "linebot:worker_pool:status"   # HASH：supervisor（host:pid）-> 最近一次的 pool 狀態（JSON）
+RESTART_BACKOFF_MAX_SEC = 60
+
+
+def _log(msg: str) -> None:
+    print(f"[worker_pool] {msg}", flush=True)
+
+
+def parse_pool_spec(spec: str) -> dict[str, tuple[int, int]]:
+    """
+    "reminders:1:4,voice_calls:1:2" → {"reminders": (1, 4), "voice_calls": (1, 2)}
+    只寫名字就是 1:1。
+    """
+    out = {}
+    for part in (spec or "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        name, _, rest = part.partition(":")
+        lo, _, hi = rest.partition(":")
+        lo = int(lo or 1)
+        hi = max(int(hi or lo), lo)
+        out[name.strip()] = (lo, hi)
+    return out
+
+
+def _run_worker(queue_name: str) -> None:
+    """
+    子 process：跟 worker_*.py 一樣，在 app context 裡跑一個 rq Worker。
+    自己開一個 process group，Ctrl-C 只送到 supervisor，由它決定怎麼關（避免 rq 收到兩次訊號變 cold shutdown）。
+    """
+    os.setpgrp()
+    load_dotenv()
+
+    from app import app
+
+    name = f"pool-{queue_name}-{socket.gethostname()}-{os.getpid()}"
+    with app.app_context():
+        worker = Worker([Queue(queue_name, connection=redis_conn)], connection=redis_conn, name=name)
+        # enqueue_in 的 job（例如 flush_voice_call）要有 scheduler 才會被搬回 queue；多個 worker 只有一個會拿到 scheduler 鎖
+        worker.work(with_scheduler=True)
+
+
+class _Slot:
+    def __init__(self, queue_name: str, process):
+        self.queue_name = queue_name
+        self.process = process
+        self.started_at = time.time()
+        self.stopping = False
+        self.last_done = 0
+        self.last_report_at = self.started_at
+
+    @property
+    def worker_name(self) -> str:
+        return f"pool-{self.queue_name}-{socket.gethostname()}-{self.process.pid}"
+
+
+class WorkerPool:
+    def __init__(self, pools: dict[str, tuple[int, int]]):
+        self.pools = pools
+        self.ctx = multiprocessing.get_context("spawn")
+        self.slots: dict[str, list[_Slot]] = {q: [] for q in pools}
+        self.queues = {q: Queue(q, connection=redis_conn) for q in pools}
+        self.below_since: dict[str, float | None] = {q: None for q in pools}
+        self.crashes: dict[str, list[float]] = {q: [] for q in pools}
+        self.next_spawn_at: dict[str, float] = {q: 0.0 for q in pools}
+        self.restarts: dict[str, int] = {q: 0 for q in pools}
+        self.draining = False
+        self.supervisor_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.last_report_at = time.time()
+
+    # ---------- process 管理 ----------
+
+    def _spawn(self, queue_name: str) -> None:
+        p = self.ctx.Process(target=_run_worker, args=(queue_name,), name=f"rq-{queue_name}", daemon=False)
+        p.start()
+        self.slots[queue_name].append(_Slot(queue_name, p))
+        _log(f"開 worker queue={queue_name} pid={p.pid}（現有 {len(self.slots[queue_name])}）")
+
+    def _stop(self, slot: _Slot) -> None:
+        # rq：第一次 SIGTERM = 做完手上的 job 再結束
+        if slot.stopping or not slot.process.is_alive():
+            return
+        slot.stopping = True
+        try:
+            os.kill(slot.process.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    def _reap(self) -> None:
+        now = time.time()
+        for queue_name, slots in self.slots.items():
+            alive = []
+            for slot in slots:
+                if slot.process.is_alive():
+                    alive.append(slot)
+                    continue
+                code = slot.process.exitcode
+                slot.process.join(timeout=0)
+                if slot.stopping or self.draining:
+                    _log(f"worker 已結束 queue={queue_name} pid={slot.process.pid} exitcode={code}")
+                    continue
+                # 不是我們叫它停的 → 當作掛掉，下一輪補開；連續掛掉就拉長等待
+                recent = [t for t in self.crashes[queue_name] if now - t < 300] + [now]
+                self.crashes[queue_name] = recent
+                self.restarts[queue_name] += 1
+                wait = min(2 ** (len(recent) - 1), RESTART_BACKOFF_MAX_SEC)
+                self.next_spawn_at[queue_name] = now + wait
+                _log(
+                    f"worker 掛掉 queue={queue_name} pid={slot.process.pid} exitcode={code}，"
+                    f"{wait}s 後補開（5 分鐘內第 {len(recent)} 次）"
+                )
+            self.slots[queue_name] = alive
+
+    # ---------- 調整大小 ----------
+
+    def _desired(self, queue_name: str, depth: int) -> int:
+        lo, hi = self.pools[queue_name]
+        want = math.ceil(depth / max(WORKER_POOL_JOBS_PER_WORKER, 1))
+        return max(lo, min(hi, want))
+
+    def _pick_idle(self, queue_name: str, running: list[_Slot]) -> _Slot:
+        # 優先關閒著的 worker（正在跑 job 的讓它做完），都在忙就關最新開的
+        for slot in reversed(running):
+            w = self._find_worker(slot)
+            if w is not None and w.get_state() == "idle":
+                return slot
+        return running[-1]
+
+    def _scale(self, queue_name: str, depth: int) -> int:
+        desired = self._desired(queue_name, depth)
+        running = [s for s in self.slots[queue_name] if not s.stopping]
+        now = time.time()
+
+        if len(running) < desired:
+            self.below_since[queue_name] = None
+            if now < self.next_spawn_at[queue_name]:
+                return desired
+            for _ in range(desired - len(running)):
+                self._spawn(queue_name)
+        elif len(running) > desired:
+            since = self.below_since[queue_name]
+            if since is None:
+                self.below_since[queue_name] = now
+            elif now - since >= WORKER_POOL_SCALE_DOWN_SEC:
+                slot = self._pick_idle(queue_name, running)
+                _log(f"縮小 queue={queue_name} depth={depth} {len(running)} → {len(running) - 1}，停 pid={slot.process.pid}")
+                self._stop(slot)
+                self.below_since[queue_name] = now
+        else:
+            self.below_since[queue_name] = None
+        return desired
+
+    # ---------- 處理量 ----------
+
+    def _find_worker(self, slot: _Slot):
+        try:
+            return Worker.find_by_key(Worker.redis_worker_namespace_prefix + slot.worker_name, connection=redis_conn)
+        except Exception:
+            return None
+
+    def _worker_stats(self, slot: _Slot, now: float, interval: float) -> dict:
+        w = self._find_worker(slot)
+        done = int(getattr(w, "successful_job_count", 0) or 0) if w else 0
+        failed = int(getattr(w, "failed_job_count", 0) or 0) if w else 0
+        working = float(getattr(w, "total_working_time", 0) or 0) if w else 0.0
+        uptime = max(now - slot.started_at, 1e-6)
+        recent = done + failed - slot.last_done
+        stats = {
+            "name": slot.worker_name,
+            "pid": slot.process.pid,
+            "state": w.get_state() if w else "starting",
+            "stopping": slot.stopping,
+            "uptime_sec": round(uptime),
+            "succeeded": done,
+            "failed": failed,
+            "jobs_per_min": round((done + failed) / uptime * 60, 2),
+            "recent_jobs_per_min": round(recent / max(interval, 1e-6) * 60, 2),
+            "busy_pct": round(min(working / uptime, 1.0) * 100, 1),
+        }
+        return stats
+
+    def _report(self, depths: dict[str, int], desired: dict[str, int], log: bool) -> None:
+        now = time.time()
+        status = {
+            "host": socket.gethostname(),
+            "pid": os.getpid(),
+            "updated_at": now,
+            "draining": self.draining,
+            "queues": {},
+        }
+        for queue_name, slots in self.slots.items():
+            lo, hi = self.pools[queue_name]
+            workers = []
+            for slot in slots:
+                workers.append(self._worker_stats(slot, now, now - slot.last_report_at))
+                if log:
+                    slot.last_done = workers[-1]["succeeded"] + workers[-1]["failed"]
+                    slot.last_report_at = now
+            status["queues"][queue_name] = {
+                "depth": depths.get(queue_name),
+                "desired": desired.get(queue_name),
+                "min": lo,
+                "max": hi,
+                "restarts": self.restarts[queue_name],
+                "workers": workers,
+            }
+            if log:
+                total = round(sum(w["recent_jobs_per_min"] for w in workers), 2)
+                _log(
+                    f"queue={queue_name} depth={depths.get(queue_name)} workers={len(workers)}/{desired.get(queue_name)} "
+                    f"jobs/min={total} restarts={self.restarts[queue_name]}"
+                )
+                for w in workers:
+                    _log(
+                        f"  {w['name']} state={w['state']} ok={w['succeeded']} failed={w['failed']} "
+                        f"jobs/min={w['recent_jobs_per_min']} (avg {w['jobs_per_min']}) busy={w['busy_pct']}%"
+                    )
+        try:
+            redis_conn.hset(STATUS_KEY, self.supervisor_id, json.dumps(status, ensure_ascii=False))
+        except Exception as e:
+            _log(f"寫入狀態失敗: {e}")
+
+    # ---------- 主迴圈 ----------
+
+    def _on_signal(self, signum, frame) -> None:
+        if not self.draining:
+            _log(f"收到 {signal.Signals(signum).name}，等 worker 做完手上的 job 再結束")
+            self.draining = True
+
+    def run(self) -> None:
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+        _log(f"啟動 supervisor={self.supervisor_id} pools={self.pools}")
+
+        while not self.draining:
+            self._reap()
+            depths, desired = {}, {}
+            for queue_name, q in self.queues.items():
+                try:
+                    depths[queue_name] = q.count
+                except Exception as e:
+                    _log(f"查 queue 長度失敗 queue={queue_name}: {e}")
+                    depths[queue_name] = 0
+                desired[queue_name] = self._scale(queue_name, depths[queue_name])
+
+            log = time.time() - self.last_report_at >= WORKER_POOL_REPORT_SEC
+            self._report(depths, desired, log)
+            if log:
+                self.last_report_at = time.time()
+            time.sleep(WORKER_POOL_CHECK_SEC)
+
+        self.drain()
+
+    def drain(self) -> None:
+        for slots in self.slots.values():
+            for slot in slots:
+                self._stop(slot)
+
+        deadline = time.time() + WORKER_POOL_DRAIN_TIMEOUT_SEC
+        while time.time() < deadline:
+            self._reap()
+            if not any(self.slots.values()):
+                break
+            time.sleep(1)
+
+        # 超時還沒結束：再送一次 SIGTERM（rq cold shutdown，手上的 job 會被中斷），再不行就 SIGKILL
+        leftover = [s for slots in self.slots.values() for s in slots if s.process.is_alive()]
+        for slot in leftover:
+            _log(f"drain 超時，強制停止 queue={slot.queue_name} pid={slot.process.pid}")
+            try:
+                os.kill(slot.process.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for slot in leftover:
+            slot.process.join(timeout=10)
+            if slot.process.is_alive():
+                slot.process.kill()
+                slot.process.join()
+
+        try:
+            redis_conn.hdel(STATUS_KEY, self.supervisor_id)
+        except Exception:
+            pass
+        _log("所有 worker 已結束")
+
+
+def get_pool_status(max_age_sec: float = 300) -> dict:
+    """
+    所有 supervisor 最近一次回報的狀態（GET /workers/pool 用）；太久沒更新的當作已經不在，順手清掉。
+    """
+    now = time.time()
+    out = {}
+    for sid, raw in (redis_conn.hgetall(STATUS_KEY) or {}).items():
+        sid = sid.decode() if isinstance(sid, bytes) else sid
+        try:
+            status = json.loads(raw)
+        except Exception:
+            continue
+        age = now - float(status.get("updated_at") or 0)
+        if age > max_age_sec:
+            redis_conn.hdel(STATUS_KEY, sid)
+            continue
+        status["age_sec"] = round(age, 1)
+        out[sid] = status
+    return out
+
+
+def main():
+    p = argparse.ArgumentParser(description="RQ worker pool（依 queue 長度自動調整 worker 數）")
+    p.add_argument("queues", nargs="*", help="只管這些 queue（預設 WORKER_POOL_QUEUES 全部）")
+    args = p.parse_args()
+
+    pools = parse_pool_spec(WORKER_POOL_QUEUES)
+    if args.queues:
+        unknown = [q for q in args.queues if q not in pools]
+        if unknown:
+            raise SystemExit(f"WORKER_POOL_QUEUES 裡沒有 {unknown}，可以用：{', '.join(pools)}")
+        pools = {q: pools[q] for q in args.queues}
+
+    WorkerPool(pools).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -8,4 +8,5 @@ from app import app
 if __name__ == "__main__":
     with app.app_context():
         worker = Worker([voice_call_queue], connection=redis_conn)
-        worker.work()
+        # flush_voice_call 用 enqueue_in 延後回寫，需要 worker 順便跑 RQ scheduler
+        worker.work(with_scheduler=True)
@@ -31,11 +31,15 @@ from config import (
     ZENDESK_REMINDER_STATE_CANCELLED,
     ZENDESK_CF_LAST_VOICE_ATTEMPT_DATE,
     APPOINTMENT_DURATION_MINUTES,
+    ZENDESK_JOB_POLL_TIMEOUT_SEC,
+    ZENDESK_JOB_POLL_INTERVAL_SEC,
 )
 
 from bookings_core import (
     parse_booking_datetime_to_local,
 )
+from singleflight import singleflight
+from voice_dedupe import claim_voice_outcomes, release_voice_outcomes
 
 # ===================== Zendesk Helper：用 line_user_id 查使用者 =====================
 
@@ -432,6 +436,29 @@ def get_zendesk_user_by_id(user_id: int) -> dict | None:
     return user
 
 
+def get_zendesk_users_by_ids(user_ids: list[int]) -> dict[int, dict]:
+    """
+    一次 GET 多個使用者（users/show_many，每次最多 100 個），回傳 {user_id: user}；失敗的那批略過。
+    """
+    ids = sorted({int(u) for u in user_ids if u})
+    if not ids:
+        return {}
+
+    base_url, headers = _build_zendesk_headers()
+    url = f"{base_url}/api/v2/users/show_many.json"
+    out: dict[int, dict] = {}
+    for i in range(0, len(ids), 100):
+        chunk = ids[i:i + 100]
+        try:
+            resp = requests.get(url, headers=headers, params={"ids": ",".join(str(u) for u in chunk)}, timeout=10)
+            resp.raise_for_status()
+            for u in (resp.json() or {}).get("users") or []:
+                out[int(u["id"])] = u
+        except Exception as e:
+            app.logger.error(f"[get_zendesk_users_by_ids] 取得使用者失敗 ids={chunk}: {e}")
+    return out
+
+
 def get_line_user_id_from_ticket(ticket: dict, appt: dict | None = None) -> str | None:
     """
     優先順序：
@@ -527,6 +554,21 @@ def get_line_user_id_from_ticket(ticket: dict, appt: dict | None = None) -> str
 #     return 0, None
 
 def search_zendesk_user_by_line_id(line_user_id: str, retries: int = 3, sleep_sec: float = 0.8):
+    """
+    同一個 line_user_id 同時只查一次 Zendesk（singleflight），其他人等同一個結果。
+    回傳格式跟 _search_zendesk_user_by_line_id 一樣：(count, user)
+    """
+    if not line_user_id:
+        return 0, None
+    return singleflight(
+        f"zd:user:{line_user_id}",
+        lambda: _search_zendesk_user_by_line_id(line_user_id, retries=retries, sleep_sec=sleep_sec),
+        encode=list,
+        decode=tuple,
+    )
+
+
+def _search_zendesk_user_by_line_id(line_user_id: str, retries: int = 3, sleep_sec: float = 0.8):
     """
     用 external_id 精準查 Zendesk user（比 /search.json 穩定）。
     回傳：
@@ -890,13 +932,14 @@ def mark_zendesk_ticket_cancelled(ticket_id: int):
     except Exception as e:
         app.logger.error(f"[mark_zendesk_ticket_cancelled] 更新失敗: {e}")
 
-def mark_zendesk_ticket_queued(ticket_id: int, ticket: dict | None = None):
+def mark_zendesk_ticket_queued(ticket_id: int, ticket: dict | None = None) -> bool:
     """
     將提醒狀態改成「已排入外撥」，並把 reminder_attempts + 1。
+    回傳是否更新成功（失敗只記 log，不 raise）。
     """
     if not ticket_id:
         app.logger.warning("[mark_zendesk_ticket_queued] 缺少 ticket_id")
-        return
+        return False
 
     base_url, headers = _build_zendesk_headers()
     url = f"{base_url}/api/v2/tickets/{ticket_id}.json"
@@ -929,10 +972,104 @@ def mark_zendesk_ticket_queued(ticket_id: int, ticket: dict | None = None):
         resp = requests.put(url, headers=headers, json=payload, timeout=10)
         resp.raise_for_status()
         app.logger.info(f"[mark_zendesk_ticket_queued] 更新成功 ticket_id={ticket_id}")
+        return True
     except Exception as e:
         app.logger.error(f"[mark_zendesk_ticket_queued] 更新失敗: {e}")
+        return False
+
+
+
+def _update_many_and_wait(updates: list[dict], tag: str) -> dict[int, bool] | None:
+    """
+    PUT tickets/update_many，等 Zendesk 的 job_status 跑完再回傳每張的結果 {ticket_id: 成功與否}。
+    update_many 回 200 只代表 job 排進去了，真正有沒有寫進去要看 job_status.results。
+    PUT 失敗 / 等太久還沒跑完（不知道結果）回傳 None。
+    """
+    base_url, headers = _build_zendesk_headers()
+    url = f"{base_url}/api/v2/tickets/update_many.json"
+    try:
+        resp = requests.put(url, headers=headers, json={"tickets": updates}, timeout=10)
+        resp.raise_for_status()
+        job = (resp.json() or {}).get("job_status") or {}
+    except Exception as e:
+        app.logger.error(f"[{tag}] update_many failed ticket_ids={[u['id'] for u in updates]}: {e}")
+        return None
+
+    deadline = time.time() + ZENDESK_JOB_POLL_TIMEOUT_SEC
+    while job.get("status") not in ("completed", "failed", "killed"):
+        if not job.get("id") or time.time() >= deadline:
+            app.logger.error(
+                f"[{tag}] update_many job 沒在 {ZENDESK_JOB_POLL_TIMEOUT_SEC}s 內完成 "
+                f"job_id={job.get('id')} status={job.get('status')}"
+            )
+            return None
+        time.sleep(ZENDESK_JOB_POLL_INTERVAL_SEC)
+        try:
+            r = requests.get(f"{base_url}/api/v2/job_statuses/{job['id']}.json", headers=headers, timeout=10)
+            r.raise_for_status()
+            job = (r.json() or {}).get("job_status") or job
+        except Exception as e:
+            app.logger.warning(f"[{tag}] 查 job_status 失敗 job_id={job.get('id')}: {e}")
+
+    results = {int(u["id"]): False for u in updates}
+    for item in job.get("results") or []:
+        try:
+            tid = int(item.get("id"))
+        except (TypeError, ValueError):
+            continue
+        if tid in results:
+            results[tid] = not item.get("error") and bool(item.get("success") or item.get("status") == "Updated")
+
+    failed = [tid for tid, ok in results.items() if not ok]
+    if failed:
+        app.logger.error(f"[{tag}] update_many job={job.get('id')} status={job.get('status')} 失敗 ticket_ids={failed}")
+    return results
+
+
+def mark_zendesk_tickets_queued(ticket_attempts: dict[int, int]) -> bool:
+    """
+    mark_zendesk_ticket_queued 的整組版：一次 update_many 把整組改成「已排入外撥」。
+    ticket_attempts：{ticket_id: 目前的 reminder_attempts}（scheduler 掃描時就有），每張各自 + 1。
+    update_many 沒寫進去的 ticket 改用單張 PUT 再寫一次；全部寫好才回傳 True。
+    """
+    if not ticket_attempts:
+        return False
+
+    new_attempts = {int(tid): int(attempts or 0) + 1 for tid, attempts in ticket_attempts.items() if tid}
+    tickets = [
+        {
+            "id": tid,
+            "custom_fields": [
+                {"id": ZENDESK_CF_REMINDER_STATE, "value": ZENDESK_REMINDER_STATE_QUEUED},
+                {"id": ZENDESK_CF_REMINDER_ATTEMPTS, "value": attempts},
+            ],
+        }
+        for tid, attempts in new_attempts.items()
+    ]
+
+    app.logger.info(f"[mark_zendesk_tickets_queued] 更新 ticket_ids={list(new_attempts)}")
+    results = _update_many_and_wait(tickets, "mark_zendesk_tickets_queued")
+    retry = [t for t in tickets if not (results or {}).get(t["id"])]
+    if not retry:
+        return True
+
+    base_url, headers = _build_zendesk_headers()
+    ok = True
+    for t in retry:
+        try:
+            resp = requests.put(
+                f"{base_url}/api/v2/tickets/{t['id']}.json",
+                headers=headers,
+                json={"ticket": {"custom_fields": t["custom_fields"]}},
+                timeout=10,
+            )
+            resp.raise_for_status()
+        except Exception as e:
+            app.logger.error(f"[mark_zendesk_tickets_queued] 單張補寫失敗 ticket_id={t['id']}: {e}")
+            ok = False
+    return ok
+
 
-    
 def search_zendesk_tickets_for_reminder():
     """
     找出：
@@ -1029,6 +1166,11 @@ def mark_zendesk_ticket_voice_attempted(
     if not ticket_id:
         return False
 
+    # 防重送先看 Redis（同一個 call_id / ticket / status 回寫過就不再碰 Zendesk）
+    if not claim_voice_outcomes(call_id, [ticket_id], call_status):
+        app.logger.info(f"[mark_voice_attempted] duplicate webhook ignored (redis) ticket_id={ticket_id} call_id={call_id}")
+        return True
+
     base_url, headers = _build_zendesk_headers()
     url_get = f"{base_url}/api/v2/tickets/{ticket_id}.json"
     url_put = f"{base_url}/api/v2/tickets/{ticket_id}.json"
@@ -1040,6 +1182,7 @@ def mark_zendesk_ticket_voice_attempted(
         ticket = resp.json().get("ticket", {})
     except Exception as e:
         app.logger.error(f"[mark_voice_attempted] GET ticket failed ticket_id={ticket_id}: {e}")
+        release_voice_outcomes(call_id, [ticket_id], call_status)
         return False
 
     # 2) 防重送：last_call_id 一樣就跳過
@@ -1086,8 +1229,113 @@ def mark_zendesk_ticket_voice_attempted(
         return True
     except Exception as e:
         app.logger.error(f"[mark_voice_attempted] PUT failed ticket_id={ticket_id}: {e}")
+        release_voice_outcomes(call_id, [ticket_id], call_status)
         return False
 
+def get_zendesk_tickets_by_ids(ticket_ids: list[int]) -> dict[int, dict]:
+    """
+    一次 GET 多張 ticket（show_many，每次最多 100 張），回傳 {ticket_id: ticket}；失敗的那批略過。
+    """
+    ids = [int(t) for t in ticket_ids if t]
+    if not ids:
+        return {}
+
+    base_url, headers = _build_zendesk_headers()
+    url = f"{base_url}/api/v2/tickets/show_many.json"
+    out: dict[int, dict] = {}
+    for i in range(0, len(ids), 100):
+        chunk = ids[i:i + 100]
+        try:
+            resp = requests.get(url, headers=headers, params={"ids": ",".join(str(t) for t in chunk)}, timeout=10)
+            resp.raise_for_status()
+            for t in (resp.json() or {}).get("tickets") or []:
+                out[int(t["id"])] = t
+        except Exception as e:
+            app.logger.error(f"[get_zendesk_tickets_by_ids] failed ids={chunk}: {e}")
+    return out
+
+
+def mark_zendesk_tickets_voice_attempted(
+    ticket_ids: list[int],
+    call_id: str,
+    call_status: str,
+    attempted_date: str,
+) -> dict[int, int] | None:
+    """
+    跟 mark_zendesk_ticket_voice_attempted 一樣的回寫，但整組 ticket 一起做：
+    - show_many 一次 GET 整組（防重送：last_call_id 一樣的略過）
+    - update_many 一次 PUT 整組（每張 ticket 各自的 attempts + 1、internal note），等 job_status 確認每張都寫進去
+    回傳這次有更新的 {ticket_id: 更新後的 attempts}（全部都是重送 → {}）；
+    有任何一張沒寫進去回傳 None（寫成功的保留防重送記號，下次 flush 只補寫失敗的）。
+    """
+    # 先用 Redis 擋掉已經回寫過的 (call_id, ticket, status)，全部都寫過就完全不碰 Zendesk
+    new_ids = claim_voice_outcomes(call_id, ticket_ids, call_status)
+    if not new_ids:
+        app.logger.info(f"[mark_voice_attempted_many] duplicate webhook ignored (redis) ticket_ids={ticket_ids} call_id={call_id}")
+        return {}
+
+    tickets = get_zendesk_tickets_by_ids(new_ids)
+    if not tickets:
+        app.logger.error(f"[mark_voice_attempted_many] GET tickets failed ticket_ids={new_ids}")
+        release_voice_outcomes(call_id, new_ids, call_status)
+        return None
+    missing = [tid for tid in new_ids if tid not in tickets]
+    if missing:
+        # 這批沒拿到的下次再寫
+        release_voice_outcomes(call_id, missing, call_status)
+
+    updates = []
+    new_attempts: dict[int, int] = {}
+    for tid, ticket in tickets.items():
+        last_call_id = _get_ticket_cf_value(ticket, ZENDESK_CF_LAST_CALL_ID, "") or ""
+        if str(last_call_id) == str(call_id):
+            app.logger.info(f"[mark_voice_attempted_many] duplicate webhook ignored ticket_id={tid} call_id={call_id}")
+            continue
+
+        attempts = _get_ticket_cf_value(ticket, ZENDESK_CF_REMINDER_ATTEMPTS, 0) or 0
+        try:
+            attempts = int(attempts)
+        except Exception:
+            attempts = 0
+        attempts += 1
+        new_attempts[tid] = attempts
+
+        note_body = (
+            f"[Voice v1] 已收到 LiveHub 回呼\n"
+            f"- callId: {call_id}\n"
+            f"- status: {call_status}\n"
+            f"- attempted_date: {attempted_date}\n"
+            f"- attempts: {attempts}\n"
+        )
+        updates.append(
+            {
+                "id": tid,
+                "comment": {"body": note_body, "public": False},
+                "custom_fields": [
+                    {"id": ZENDESK_CF_LAST_CALL_ID, "value": str(call_id)},
+                    {"id": ZENDESK_CF_REMINDER_ATTEMPTS, "value": attempts},
+                    {"id": ZENDESK_CF_LAST_VOICE_ATTEMPT_DATE, "value": attempted_date},
+                ],
+            }
+        )
+
+    if not updates:
+        return {}
+
+    app.logger.info(f"[mark_voice_attempted_many] PUT tickets={list(new_attempts)} call_id={call_id}")
+    results = _update_many_and_wait(updates, "mark_voice_attempted_many")
+    if results is None:
+        release_voice_outcomes(call_id, new_ids, call_status)
+        return None
+
+    failed = [tid for tid, ok in results.items() if not ok]
+    if failed:
+        # 寫成功的留著防重送記號；失敗的放掉，整通回傳 None 讓 flush 之後再試（只會補寫失敗的那幾張）
+        release_voice_outcomes(call_id, failed, call_status)
+        return None
+    return new_attempts
+
+
 # voice 回寫webhook相關 
 def mark_zendesk_ticket_voice_succeeded(
     ticket_id: int,
@@ -1107,6 +1355,11 @@ def mark_zendesk_ticket_voice_succeeded(
     if not ticket_id:
         return False
 
+    # 防重送先看 Redis（同一個 call_id / ticket / status 回寫過就不再碰 Zendesk）
+    if not claim_voice_outcomes(call_id, [ticket_id], call_status):
+        app.logger.info(f"[mark_voice_success] duplicate webhook ignored (redis) ticket_id={ticket_id} call_id={call_id}")
+        return True
+
     base_url, headers = _build_zendesk_headers()
     url_get = f"{base_url}/api/v2/tickets/{ticket_id}.json"
     url_put = f"{base_url}/api/v2/tickets/{ticket_id}.json"
@@ -1117,6 +1370,7 @@ def mark_zendesk_ticket_voice_succeeded(
         ticket = resp.json().get("ticket", {})
     except Exception as e:
         app.logger.error(f"[mark_voice_success] GET ticket failed ticket_id={ticket_id}: {e}")
+        release_voice_outcomes(call_id, [ticket_id], call_status)
         return False
 
     last_call_id = _get_ticket_cf_value(ticket, ZENDESK_CF_LAST_CALL_ID, "") or ""
@@ -1160,6 +1414,7 @@ def mark_zendesk_ticket_voice_succeeded(
         return True
     except Exception as e:
         app.logger.error(f"[mark_voice_success] PUT failed ticket_id={ticket_id}: {e}")
+        release_voice_outcomes(call_id, [ticket_id], call_status)
         return False
 
 # voice 回寫webhook相關
@@ -1180,6 +1435,11 @@ def mark_zendesk_ticket_voice_failed(
     if not ticket_id:
         return False
 
+    # 防重送先看 Redis（同一個 call_id / ticket / status 回寫過就不再碰 Zendesk）
+    if not claim_voice_outcomes(call_id, [ticket_id], call_status):
+        app.logger.info(f"[mark_voice_failed] duplicate webhook ignored (redis) ticket_id={ticket_id} call_id={call_id}")
+        return True
+
     base_url, headers = _build_zendesk_headers()
     url_get = f"{base_url}/api/v2/tickets/{ticket_id}.json"
     url_put = f"{base_url}/api/v2/tickets/{ticket_id}.json"
@@ -1190,6 +1450,7 @@ def mark_zendesk_ticket_voice_failed(
         ticket = resp.json().get("ticket", {})
     except Exception as e:
         app.logger.error(f"[mark_voice_failed] GET ticket failed ticket_id={ticket_id}: {e}")
+        release_voice_outcomes(call_id, [ticket_id], call_status)
         return False
 
     last_call_id = _get_ticket_cf_value(ticket, ZENDESK_CF_LAST_CALL_ID, "") or ""
@@ -1232,4 +1493,5 @@ def mark_zendesk_ticket_voice_failed(
         return True
     except Exception as e:
         app.logger.error(f"[mark_voice_failed] PUT failed ticket_id={ticket_id}: {e}")
+        release_voice_outcomes(call_id, [ticket_id], call_status)
         return False